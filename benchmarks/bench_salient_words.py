@@ -0,0 +1,50 @@
+""" Benchmark leave-one-out surprise scoring, from 10 to 10,000 unique words.
+
+Compares the vectorized scoring in get_salient_words against the original
+per-word loop (one np.median and one scipy cosine per word).
+
+Usage:
+    python -m benchmarks.bench_salient_words
+"""
+import time
+import numpy as np
+
+from scipy import spatial
+from src.journal_imager.get_salient_words import leave_one_out_centroids, cosine_similarities
+
+def score_loop(vectors):
+    """ The original scoring: rebuild the rest of the vectors and take their median, per word. """
+    similarities = []
+    for i in range(len(vectors)):
+        rest = np.median([vectors[j] for j in range(len(vectors)) if j != i], axis=0)
+        similarities.append(1 - spatial.distance.cosine(vectors[i], rest))
+    return np.array(similarities)
+
+def score_vectorized(vectors, centroid='median'):
+    """ The vectorized scoring, including top-k selection. """
+    similarities = cosine_similarities(vectors, leave_one_out_centroids(vectors, centroid))
+    k = min(18, len(vectors))
+    return np.argpartition(similarities, k - 1)[:k]
+
+def best_of(function, *args, repeat=3):
+    """ Best wall-clock time of a few runs, in seconds. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f"{'words':>8} {'loop (s)':>10} {'median (s)':>11} {'mean (s)':>10} {'trimmed (s)':>12} {'speed-up':>9}")
+    for n_words in (10, 100, 1000, 10000):
+        vectors = rng.normal(size=(n_words, 50)).astype(np.float32)
+
+        # The loop is quadratic, so it is only timed up to 1,000 words
+        loop = best_of(score_loop, vectors, repeat=1) if n_words <= 1000 else float('nan')
+        median = best_of(score_vectorized, vectors, 'median')
+        mean = best_of(score_vectorized, vectors, 'mean')
+        trimmed = best_of(score_vectorized, vectors, 'trimmed_mean')
+
+        print(f"{n_words:>8} {loop:>10.4f} {median:>11.4f} {mean:>10.4f} {trimmed:>12.4f} {loop / median:>8.0f}x")
@@ -0,0 +1,57 @@
+""" Synthetic data for the benchmarks: embeddings, journals and a stand-in image backend. """
+import numpy as np
+
+from pathlib import Path
+from src.journal_imager.load_glove import compile_glove
+from src.journal_imager.stub_server import start_stub_server
+
+def make_vocabulary(n_words):
+    """ Made-up words that are not stopwords: 'w0', 'w1', ... """
+    return [f'w{idx}' for idx in range(n_words)]
+
+def make_embedding(directory, n_words=20000, dim=50, seed=0, dtype='float32', max_words=None):
+    """ Write and compile a GloVe-style embedding of random vectors.
+
+    Args:
+        directory (str): Where to write glove.6B.<dim>d.txt and its compiled store.
+        n_words (int): Vocabulary size.
+        dim (int): Vector size.
+        seed (int): Random seed.
+        dtype (str): Storage type of the compiled store, see load_glove.compile_glove.
+        max_words (int): Vocabulary cut of the compiled store.
+
+    Returns:
+        pathlib.Path: The directory, ready for load_glove(directory).
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    vectors = np.random.default_rng(seed).normal(size=(n_words, dim)).astype(np.float32)
+    with open(directory / f'glove.6B.{dim}d.txt', 'w') as f:
+        for word, vector in zip(make_vocabulary(n_words), vectors):
+            f.write(word + ' ' + ' '.join(f'{value:.5f}' for value in vector) + '\n')
+    compile_glove(directory / f'glove.6B.{dim}d.txt', dtype=dtype, max_words=max_words)
+    return directory
+
+def make_journal(n_entries, vocabulary, words_per_entry=12, seed=0):
+    """ Make journal entries whose words follow a Zipf distribution, like real text.
+
+    Args:
+        n_entries (int): Number of entries.
+        vocabulary (list): Words to draw from; earlier words are more frequent.
+        words_per_entry (int): Words per entry, on average.
+        seed (int): Random seed.
+
+    Returns:
+        list: The entries, as strings.
+    """
+
+    rng = np.random.default_rng(seed)
+    ranks = np.minimum(rng.zipf(1.3, size=n_entries * words_per_entry), len(vocabulary)) - 1
+    words = [vocabulary[rank] for rank in ranks]
+    return ['Today, ' + ' '.join(words[idx:idx + words_per_entry]) + '.'
+            for idx in range(0, len(words), words_per_entry)]
+
+def start_backend(latency=0.0, jitter=0.0, error_rate=0.0):
+    """ Start a stub /generate server with the given per-image latency, jitter and error rate; returns (server, url). """
+    return start_stub_server(latency=latency, jitter=jitter, error_rate=error_rate)
@@ -0,0 +1,249 @@
+""" Load-test the Dash app with many simulated users.
+
+Every user writes a few journal entries, clicks Generate and polls until the images
+are in, all through the same /_dash-update-component requests the browser sends.
+Images come from the stub backend (src/journal_imager/stub_server.py), with
+configurable latency, jitter and error rate.
+
+By default the app runs in this process, on a threaded server, with its journal and
+images in a temporary directory and a synthetic embedding instead of GloVe. Point
+--app-url at a running app (e.g. under gunicorn with some number of workers) to
+load-test that instead; --backend-url is then what its users paste as ngrok URL.
+
+The report gives, per kind of request, the throughput and p50/p95/p99/max latency,
+and the same for whole generations (click to last image).
+
+Usage:
+    python -m benchmarks.load_test --users 20 --entries 5 --latency 0.5 --jitter 0.5
+    python -m benchmarks.load_test --app-url http://127.0.0.1:8050 --users 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import requests
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks import fixtures
+
+class DashClient:
+    """ Calls the app's callbacks over HTTP, like the browser does. """
+
+    def __init__(self, app_url, dependencies):
+        self.app_url = app_url.rstrip('/')
+        self.session = requests.Session()
+        self.dependencies = dependencies
+
+    def find(self, trigger):
+        """ Get the callback triggered by an input ('component.property'), as listed by /_dash-dependencies. """
+        for dependency in self.dependencies:
+            if any(item['id'] + '.' + item['property'] == trigger for item in dependency['inputs']):
+                return dependency
+        raise KeyError(f'No callback is triggered by {trigger}.')
+
+    def call(self, dependency, values, changed):
+        """ Call a callback.
+
+        Args:
+            dependency (dict): The callback, from find().
+            values (dict): Value of every input and state, by 'component.property'; missing ones are None.
+            changed (str): The input that triggered the call, 'component.property'.
+
+        Returns:
+            dict: The outputs that were updated, by component and then property.
+        """
+
+        def with_values(items):
+            return [{**item, 'value': values.get(item['id'] + '.' + item['property'])} for item in items]
+
+        outputs = [dict(zip(('id', 'property'), part.split('.', 1))) for part in _split_outputs(dependency['output'])]
+        payload = {
+            'output': dependency['output'],
+            'outputs': outputs if dependency['output'].startswith('..') else outputs[0],
+            'inputs': with_values(dependency['inputs']),
+            'state': with_values(dependency['state']),
+            'changedPropIds': [changed],
+        }
+        response = self.session.post(self.app_url + '/_dash-update-component', json=payload, timeout=300)
+        if response.status_code == 204:
+            return {}  # nothing to update
+        response.raise_for_status()
+        return response.json()['response']
+
+def fetch_dependencies(app_url):
+    """ Get the app's callbacks, as listed by /_dash-dependencies, once it has finished its first-request setup.
+
+    Until a first request has set the app up, /_dash-dependencies can list only some of its
+    callbacks, so the page is requested first; the users then share the one list.
+    """
+
+    app_url = app_url.rstrip('/')
+    requests.get(app_url + '/', timeout=60).raise_for_status()
+    response = requests.get(app_url + '/_dash-dependencies', timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+def _split_outputs(output):
+    # '..a.x...b.y..' for several outputs, 'a.x' for one
+    return output[2:-2].split('...') if output.startswith('..') else [output]
+
+class Recorder:
+    """ Latencies per kind of request, and errors, from all users. """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def timed(self, kind, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        except Exception:
+            with self._lock:
+                self.errors[kind] += 1
+            raise
+        finally:
+            with self._lock:
+                self.latencies[kind].append(time.perf_counter() - start)
+
+    def add(self, kind, seconds):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+
+def run_user(user, app_url, dependencies, backend_url, options, recorder):
+    """ One user: write entries, click Generate and poll until the generation is done. """
+
+    client = DashClient(app_url, dependencies)
+    add_entry = client.find('input_journal_entry.value')
+    generate = client.find('generate_button.n_clicks')
+    poll = client.find('generation_poll.n_intervals')
+
+    date = time.strftime('%Y-%m-%d')
+    vocabulary = options.vocabulary
+    entries = []
+    for text in fixtures.make_journal(options.entries, vocabulary, seed=user):
+        text = f'User {user}: {text}'
+        recorder.timed('add_entry', client.call, add_entry,
+                       {'input_journal_entry.value': text, 'date_select.value': date}, 'input_journal_entry.value')
+        entries.append({'Time': time.strftime('%H:%M:%S'), 'Entry': text})
+        time.sleep(options.think_time)
+
+    started = time.perf_counter()
+    response = recorder.timed('generate_click', client.call, generate, {
+        'date_select.value': date,
+        'generate_button.n_clicks': 1,
+        'entries_table.data': entries,
+        'n_images.value': options.images,
+        'guidance_scale.value': 7.5,
+        'num_inference_steps.value': 20,
+        'ngrok_url.value': backend_url,
+        'image_style.value': 'photo of ',
+    }, 'generate_button.n_clicks')
+    job = response['generation_job']['data']
+
+    # Poll like the page's dcc.Interval, until the poll callback turns itself off
+    for n_intervals in range(1, int(options.timeout / options.poll_interval) + 1):
+        time.sleep(options.poll_interval)
+        response = recorder.timed('poll', client.call, poll,
+                                  {'generation_poll.n_intervals': n_intervals, 'generation_job.data': job, 'date_select.value': date},
+                                  'generation_poll.n_intervals')
+        if response.get('generation_poll', {}).get('disabled'):
+            recorder.add('generation', time.perf_counter() - started)
+            return
+    raise TimeoutError(f'User {user}: generation did not finish within {options.timeout} seconds.')
+
+def start_app(work_dir):
+    """ Run the app in this process on a threaded server, keeping its data in work_dir; returns its URL. """
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    os.environ['JOURNAL_IMAGER_PRELOAD_MODEL'] = '0'
+    import src.journal_imager.app as app_module
+    import src.journal_imager.image_cache as ic
+    import src.journal_imager.journal_storage as js
+    import src.journal_imager.load_glove as lg
+    import src.journal_imager.model_registry as mr
+
+    # Keep the journal, images and image cache out of the package directory
+    app_module.storage = js.get_storage(work_dir / 'journal_entries')
+    app_module.base_path = work_dir
+    app_module.doc_frequency_path = work_dir / 'journal_entries' / 'doc_frequency.npz'
+    ic.CACHE_DIR = work_dir / 'image_cache'
+
+    # A synthetic embedding instead of downloading GloVe
+    mr.set_model(lg.load_glove(fixtures.make_embedding(work_dir / 'glove')))
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app_module.app.server, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+def report(recorder, elapsed):
+    """ Print throughput and latency percentiles per kind of request. """
+
+    total = sum(len(latencies) for kind, latencies in recorder.latencies.items() if kind != 'generation')
+    print(f"\n{total} requests in {elapsed:.1f} s: {total / elapsed:.1f} requests/s\n")
+    print(f"{'request':<15} {'count':>6} {'errors':>7} {'per s':>7} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+    for kind in ('add_entry', 'generate_click', 'poll', 'generation'):
+        latencies = np.array(recorder.latencies.get(kind, [])) * 1000
+        if len(latencies) == 0:
+            continue
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"{kind:<15} {len(latencies):>6} {recorder.errors[kind]:>7} {len(latencies) / elapsed:>7.1f} "
+              f"{p50:>10.1f} {p95:>10.1f} {p99:>10.1f} {latencies.max():>10.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate concurrent users of the Dash app.')
+    parser.add_argument('--users', type=int, default=10, help='Concurrent users.')
+    parser.add_argument('--entries', type=int, default=5, help='Entries each user writes before clicking Generate.')
+    parser.add_argument('--images', type=int, default=3, help='Images per generation.')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Seconds between a user\'s entries.')
+    parser.add_argument('--poll-interval', type=float, default=0.25, help='Seconds between progress polls.')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds a generation may take.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds the stub backend takes per image.')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Up to this many extra seconds per image.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of images the stub backend fails.')
+    parser.add_argument('--app-url', help='Load-test a running app instead of one in this process.')
+    parser.add_argument('--backend-url', help='Image backend for the users to use; defaults to a stub backend started here.')
+    options = parser.parse_args(argv)
+    options.vocabulary = fixtures.make_vocabulary(20000)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        backend = None
+        backend_url = options.backend_url
+        if backend_url is None:
+            backend, backend_url = fixtures.start_backend(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate)
+        app_url = options.app_url or start_app(Path(work_dir))
+        dependencies = fetch_dependencies(app_url)
+
+        recorder = Recorder()
+        failures = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options.users) as executor:
+            futures = [executor.submit(run_user, user, app_url, dependencies, backend_url, options, recorder) for user in range(options.users)]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"User failed: {e}")
+        elapsed = time.perf_counter() - start
+
+        if backend is not None:
+            backend.shutdown()
+
+    report(recorder, elapsed)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+""" Benchmark every stage from journal entry to image, on synthetic data.
+
+Stages:
+    load_glove       open the compiled embedding (20,000 words; --dim, --dtype and --max-words pick the variant)
+    tokenize         tokenize a journal of N entries
+    surprise         get_most_surprising_words on a journal of N entries
+    surprise_range   get_most_surprising_words_range on N entries, streamed from a generator
+    expand           add 3 related words to each of N salient-word triples (IVF index)
+    append_entry     append one entry to a day that already has N entries
+    update_journal   append and read back a day that already has N entries
+    generate         generate N images from the stub backend, with --latency seconds per image
+
+Each case runs in a fresh process, so its peak RSS is its own. For every case the
+runner reports throughput (entries, appends or images per second), p50 and p99
+latency per call, and the peak RSS.
+
+Results can be saved with --save and compared against a saved run with --compare;
+the run then fails if any case's p50 got more than --tolerance slower.
+
+Usage:
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --stage surprise --sizes 10 1000 100000
+    python -m benchmarks.run_benchmarks --dim 300 --dtype int8
+    python -m benchmarks.run_benchmarks --save baseline.json
+    python -m benchmarks.run_benchmarks --compare baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import fixtures
+
+DEFAULT_SIZES = {
+    'load_glove': [20000],
+    'tokenize': [10, 1000, 100000],
+    'surprise': [10, 100, 1000, 10000, 100000],
+    'surprise_range': [1000, 100000, 1000000],
+    'expand': [1, 6, 100],
+    'append_entry': [10, 1000, 100000],
+    'update_journal': [10, 1000, 100000],
+    'generate': [1, 4, 8],
+}
+
+def time_calls(function, repeat, min_seconds=0.5):
+    """ Time function() at least repeat times, and for at least min_seconds in total.
+
+    Returns:
+        list: Seconds per call.
+    """
+    times = []
+    started = time.perf_counter()
+    while len(times) < repeat or time.perf_counter() - started < min_seconds:
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_load_glove(size, work_dir, options):
+    return time_calls(lambda: _load_model(work_dir, options), repeat=10), 1
+
+def bench_tokenize(size, work_dir, options):
+    import src.journal_imager.tokenize_entries as te
+    model = _load_model(work_dir, options)
+    journal = fixtures.make_journal(size, model.index_to_key)
+    return time_calls(lambda: te.unique_tokens(journal, vocabulary=model.key_to_index), repeat=5), size
+
+def bench_surprise(size, work_dir, options):
+    import src.journal_imager.get_salient_words as gsw
+    model = _load_model(work_dir, options)
+    journal = fixtures.make_journal(size, model.index_to_key)
+    return time_calls(lambda: gsw.get_most_surprising_words(journal, model, 6), repeat=5), size
+
+def bench_surprise_range(size, work_dir, options):
+    import src.journal_imager.get_salient_words as gsw
+    model = _load_model(work_dir, options)
+
+    # Entries are made 1,000 at a time as they are consumed, so the journal itself is never in memory
+    def stream():
+        for seed in range(0, size, 1000):
+            yield from fixtures.make_journal(min(1000, size - seed), model.index_to_key, seed=seed)
+
+    return time_calls(lambda: gsw.get_most_surprising_words_range(stream(), model, 6), repeat=3), size
+
+def bench_expand(size, work_dir, options):
+    import src.journal_imager.nearest_words as nw
+    model = _load_model(work_dir, options)
+    index = nw.NearestWords.build(model)
+    rng = np.random.default_rng(0)
+    triples = [list(rng.choice(model.index_to_key, size=3, replace=False)) for _ in range(size)]
+    return time_calls(lambda: nw.expand_triples(index, triples, 3), repeat=20), size
+
+def bench_append_entry(size, work_dir, options):
+    import src.journal_imager.update_journal as uj
+    entries_path = _make_day(size, work_dir)
+    texts = iter(fixtures.make_journal(100000, fixtures.make_vocabulary(1000), seed=1))
+    return time_calls(lambda: uj.append_entry(next(texts), entries_path), repeat=50), 1
+
+def bench_update_journal(size, work_dir, options):
+    import src.journal_imager.update_journal as uj
+    entries_path = _make_day(size, work_dir)
+    texts = iter(fixtures.make_journal(100000, fixtures.make_vocabulary(1000), seed=1))
+    return time_calls(lambda: uj.update_journal(next(texts), entries_path), repeat=10), 1
+
+def bench_generate(size, work_dir, options):
+    import src.journal_imager.generate_image as gi
+    server, url = fixtures.start_backend(latency=options.latency)
+    img_dir = work_dir / 'images'
+    img_dir.mkdir()
+    prompts = [f'prompt {idx}' for idx in range(size)]
+    img_paths = [img_dir / f'img_{idx}.png' for idx in range(size)]
+    try:
+        return time_calls(lambda: gi.generate_images(url, prompts, 7.5, 20, img_paths, cache=False), repeat=5), size
+    finally:
+        server.shutdown()
+
+STAGES = {
+    'load_glove': bench_load_glove,
+    'tokenize': bench_tokenize,
+    'surprise': bench_surprise,
+    'surprise_range': bench_surprise_range,
+    'expand': bench_expand,
+    'append_entry': bench_append_entry,
+    'update_journal': bench_update_journal,
+    'generate': bench_generate,
+}
+
+def _load_model(work_dir, options):
+    import src.journal_imager.load_glove as lg
+    return lg.load_glove(work_dir / 'glove', dim=options.dim, dtype=options.dtype, max_words=options.max_words)
+
+def _make_day(n_entries, work_dir):
+    # A day that already has n_entries entries, dated today so appends go to it
+    import src.journal_imager.update_journal as uj
+    entries_path = work_dir / 'journal_entries'
+    day_dir = entries_path / datetime.now().strftime('%Y-%m-%d')
+    day_dir.mkdir(parents=True)
+    journal = fixtures.make_journal(n_entries, fixtures.make_vocabulary(1000))
+    uj.write_entries([{'Time': '12:00:00', 'Entry': text} for text in journal], day_dir / 'entries.csv')
+    return entries_path
+
+def peak_rss_mb():
+    """ Peak resident set size of this process, in MB. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+def run_case(stage, size, shared_dir, options):
+    """ Run one stage at one size; meant to be the only work of its process.
+
+    Returns:
+        dict: 'stage', 'size', 'calls', 'throughput' (units per second), 'p50_ms', 'p99_ms' and 'peak_rss_mb'.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        (work_dir / 'glove').symlink_to(Path(shared_dir) / 'glove')
+        times, units = STAGES[stage](size, work_dir, options)
+
+    times = np.array(times)
+    return {
+        'stage': stage,
+        'size': size,
+        'calls': len(times),
+        'throughput': units * len(times) / times.sum(),
+        'p50_ms': float(np.percentile(times, 50) * 1000),
+        'p99_ms': float(np.percentile(times, 99) * 1000),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def compare(results, baseline, tolerance):
+    """ Find the cases whose p50 latency regressed by more than tolerance (0.2 = 20%) against baseline. """
+    previous = {(result['stage'], result['size']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['stage'], result['size']))
+        if before is not None and result['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append((result, before))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the journal-to-image pipeline on synthetic data.')
+    parser.add_argument('--stage', nargs='+', choices=list(STAGES), default=list(STAGES), help='Stages to run.')
+    parser.add_argument('--sizes', nargs='+', type=int, help="Sizes to run every stage at, instead of each stage's defaults.")
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the stub backend takes per image.')
+    parser.add_argument('--dim', type=int, default=50, help='Vector size of the synthetic embedding.')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'int8'], default='float32', help='Storage type of the embedding.')
+    parser.add_argument('--max-words', type=int, help='Vocabulary cut of the embedding.')
+    parser.add_argument('--save', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare against results saved with --save.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p50 slow-down with --compare (0.2 = 20%%).')
+    options = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as shared_dir:
+        # The embedding is compiled once; each case then opens it like the app does
+        fixtures.make_embedding(Path(shared_dir) / 'glove', dim=options.dim, dtype=options.dtype, max_words=options.max_words)
+
+        print(f"{'stage':<15} {'size':>7} {'calls':>6} {'throughput/s':>13} {'p50 (ms)':>10} {'p99 (ms)':>10} {'peak RSS (MB)':>14}")
+        for stage in options.stage:
+            for size in options.sizes or DEFAULT_SIZES[stage]:
+                # A fresh process per case, so imports, caches and peak RSS don't carry over
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(run_case, stage, size, shared_dir, options).result()
+                results.append(result)
+                print(f"{stage:<15} {size:>7} {result['calls']:>6} {result['throughput']:>13.1f} "
+                      f"{result['p50_ms']:>10.3f} {result['p99_ms']:>10.3f} {result['peak_rss_mb']:>14.1f}")
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for result, before in regressions:
+            print(f"Regression: {result['stage']} at {result['size']}: p50 {before['p50_ms']:.3f} ms -> {result['p50_ms']:.3f} ms")
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
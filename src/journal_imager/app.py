@@ -1,21 +1,35 @@
 # Import packages
-import pandas as pd
-import re
+import atexit
+import os
+import threading
 
-from dash import Dash, html, dcc, callback, Input, Output, State, dash_table, callback_context
-from datetime import datetime
+from dash import Dash, html, dcc, callback, Input, Output, State, dash_table, callback_context, no_update, Patch
+from datetime import datetime, timedelta
 from pathlib import Path
-from natsort import natsorted
 
 import src.journal_imager.update_journal as uj
-import src.journal_imager.load_glove as lg
+import src.journal_imager.journal_storage as js
+import src.journal_imager.date_index as di
+import src.journal_imager.model_registry as mr
+import src.journal_imager.salience_index as si
 import src.journal_imager.get_salient_words as gsw
+import src.journal_imager.doc_frequency as dfreq
+import src.journal_imager.nearest_words as nw
 import src.journal_imager.generate_image as gi
+import src.journal_imager.generation_jobs as gj
+import src.journal_imager.metrics as mt
+import src.journal_imager.gallery as gl
 
 
 # Initialize the app
 app = Dash(__name__)
 
+# Serve stage timings on /metrics (timed with JOURNAL_IMAGER_METRICS=1; JOURNAL_IMAGER_PROFILE_DIR dumps a profile per request)
+mt.install(app.server)
+
+# Let browsers keep the gallery's content-hashed images and thumbnails for good
+gl.install(app.server)
+
 # Paths
 base_path = Path(__file__).parent
 entries_path = base_path / 'journal_entries'
@@ -26,6 +40,60 @@ current_date = datetime.now().strftime('%Y-%m-%d')
 today_entries_dir = entries_path / current_date
 today_entries_dir.mkdir(exist_ok=True)
 
+# Journal storage: entries.csv per day, or SQLite with JOURNAL_IMAGER_STORAGE=sqlite
+storage = js.get_storage(entries_path)
+
+# Dates to choose from in the date dropdown (newest first), kept up to date as days are added
+date_index = di.DateIndex(storage)
+
+# Start loading the embedding model in the background, so the first Generate click doesn't wait for it.
+# JOURNAL_IMAGER_PRELOAD_MODEL=deferred boots without touching the model (fast worker starts) and starts
+# warming it once the first request is being served; 0 loads it on the first Generate click.
+preload_mode = os.environ.get('JOURNAL_IMAGER_PRELOAD_MODEL', '1')
+if preload_mode == '1':
+    mr.preload_model()
+elif preload_mode == 'deferred':
+    warm_started = False
+
+    @app.server.before_request
+    def warm_model():
+        global warm_started
+        if not warm_started:
+            warm_started = True
+            mr.preload_model()
+
+# Words and vectors of the entries seen so far, kept up to date as entries are added and deleted
+salience_index = si.SalienceIndex()
+
+def get_salience_index():
+    """Returns the salience index, attaching the model to it once the model is loaded."""
+    if salience_index.model is None and mr.is_model_ready():
+        salience_index.set_model(mr.get_model())
+    return salience_index
+
+# In how many days of the journal each word occurs, to favour words the user rarely writes.
+# Loaded (or built) with the model on the first generation, kept current as entries change here,
+# and synced with storage before every generation, for days changed before it was loaded or by other workers.
+doc_frequency = None
+doc_frequency_path = entries_path / dfreq.FILE_NAME
+doc_frequency_lock = threading.Lock()
+
+def get_doc_frequency():
+    """Returns the document-frequency table, loading it on first use and re-reading the days that changed in storage since."""
+    global doc_frequency
+    with doc_frequency_lock:
+        if doc_frequency is None:
+            doc_frequency = dfreq.load_or_build(storage, mr.get_model(), doc_frequency_path)
+        else:
+            doc_frequency.sync(storage)
+            doc_frequency.save_if_changed(doc_frequency_path)
+    return doc_frequency
+
+@atexit.register
+def save_doc_frequency():
+    if doc_frequency is not None and doc_frequency.changed:
+        doc_frequency.save(doc_frequency_path)
+
 
 # App layout
 app.layout = html.Div(
@@ -125,15 +193,15 @@ app.layout = html.Div(
                                 html.P("Select Date:"),
                                 dcc.Dropdown(
                                     id = "date_select",
-                                    # Get list of all paths in entries_path, then get the last directory in each path,
-                                    # which is the date, which becomes the label and value for the dropdown
-                                    options = [{"label": date, "value": date} for date in \
-                                               natsorted([re.search(r"/([^/]+)$", str(path)).group(1) \
-                                                          for path in entries_path.iterdir() if path.is_dir()],
-                                                          reverse=True)],
+                                    # Each date becomes the label and value for the dropdown; today is always selectable
+                                    options = date_index.options(include=current_date),
                                     value = datetime.now().strftime('%Y-%m-%d'),
                                     clearable = False
                                 ),
+                                dcc.Interval(
+                                    id = "date_index_interval",
+                                    interval = 60 * 1000
+                                ),
                                 html.Br()
                             ]
                         ),
@@ -168,6 +236,25 @@ app.layout = html.Div(
                                     ],
                                     style={'width':'30%'}
                                 ),
+                                html.P("Words From:"),
+                                html.Div(
+                                    id = "salience_span_container",
+                                    children = [
+                                        dcc.Dropdown(
+                                            id = "salience_span",
+                                            # Number of days, ending on the selected date
+                                            options = [
+                                                {"label": "The selected day", "value": 1},
+                                                {"label": "The week up to it", "value": 7},
+                                                {"label": "The month up to it", "value": 30},
+                                                {"label": "The year up to it", "value": 365},
+                                            ],
+                                            value = 1,
+                                            clearable = False
+                                        )
+                                    ],
+                                    style={'width':'30%'}
+                                ),
                                 html.P("Number of Images:"),
                                 dcc.Slider(
                                     id = "n_images",
@@ -178,6 +265,16 @@ app.layout = html.Div(
                                     included = False
                                 ),
                                 html.Br(),
+                                html.P("Related Words per Image:"),
+                                dcc.Slider(
+                                    id = "n_related_words",
+                                    min = 0,
+                                    max = 3,
+                                    step = 1,
+                                    value = 0,
+                                    included = False
+                                ),
+                                html.Br(),
                                 html.P("Closeness to Text (%):"),
                                 dcc.Slider(
                                     id = "guidance_scale",
@@ -231,6 +328,35 @@ app.layout = html.Div(
                                     children = "Generate",
                                     disabled=True
                                 ),
+                                html.Button(
+                                    id = "cancel_button",
+                                    children = "Cancel",
+                                    style = {
+                                        'margin-left': '5px'
+                                    }
+                                ),
+                                html.P(
+                                    id = "generation_status"
+                                ),
+                                dcc.Store(
+                                    id = "generation_job"
+                                ),
+                                dcc.Interval(
+                                    id = "generation_poll",
+                                    interval = 1000,
+                                    disabled = True
+                                ),
+                                html.P(
+                                    id = "model_status",
+                                    style = {
+                                        'color': 'grey',
+                                        'font-size': 'small'
+                                    }
+                                ),
+                                dcc.Interval(
+                                    id = "model_status_interval",
+                                    interval = 1000
+                                ),
                                 html.Br()                                
                             ]
                         )
@@ -265,9 +391,15 @@ app.layout = html.Div(
                                 'padding': '5px'
                             },
                             style_as_list_view = True,
+                            # Rows also carry their storage 'id', which is not shown
+                            columns=[{'name': 'Time', 'id': 'Time'}, {'name': 'Entry', 'id': 'Entry'}],
                             editable=True,
                             row_deletable=True,
                         ),
+                        # The day's entries as stored when the table was last read, to tell which rows this tab deleted or edited
+                        dcc.Store(
+                            id = 'stored_entries'
+                        ),
                         html.Br(),
                         html.Div(
                             id = "gen_image_container",
@@ -282,48 +414,119 @@ app.layout = html.Div(
 )
 
 ## Callbacks
+def read_table(date):
+    """Reads a day for the entries table, with row ids.
+
+    Args:
+        date (str): The day, 'YYYY-MM-DD'.
+
+    Returns:
+        tuple: The table's rows (a placeholder for today until its first entry), and the stored entries to diff the table against.
+    """
+    entries = storage.read_day(date, ids=True)
+    rows = entries
+    if not entries and date == datetime.now().strftime('%Y-%m-%d'):
+        rows = [{'Time': datetime.now().strftime('%H:%M:%S'), 'Entry': uj.PLACEHOLDER_ENTRY}]
+    return rows, {'date': date, 'entries': entries}
+
 # Update journal entries table with today's entries
 @callback(
     Output(component_id='entries_table', component_property='data'),
     Output(component_id='input_journal_entry', component_property='value'),
+    Output(component_id='stored_entries', component_property='data'),
     Input(component_id='input_journal_entry', component_property='value'),
-    Input(component_id='date_select', component_property='value')
+    Input(component_id='date_select', component_property='value'),
+    State(component_id='stored_entries', component_property='data')
 )
-def update_journal(input_text, date_select, entries_path = entries_path):
-    
-    # If date is today, use update_journal function
-    if date_select == datetime.now().strftime('%Y-%m-%d'):
-        entries_dict = uj.update_journal(input_text, entries_path)
-    else:
-        date_select_entries = entries_path / date_select / 'entries.csv'
-        df = pd.read_csv(date_select_entries, sep=',')
-        entries_dict = df.to_dict('records')
+@mt.timed('callback.update_journal')
+def update_journal(input_text, date_select, stored_entries, entries_path = entries_path):
+
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    # New entry for today: append it to the file, and only send the new row to the table
+    if date_select == today and callback_context.triggered_id == 'input_journal_entry':
+        had_entries = storage.has_entries(today)
+        entry = storage.append_entry(input_text)
+        if entry is None:
+            return no_update, '', no_update # Empty or repeated entry, nothing written
+        if not had_entries:
+            date_index.add(today) # First entry of the day: list the day in the date dropdown
+        if get_salience_index().has_day(today):
+            salience_index.add_entry(today, entry['Entry'])
+        if doc_frequency is not None:
+            doc_frequency.add_entry(today, entry['Entry'])
+            doc_frequency.save_if_changed(doc_frequency_path)
+        if had_entries and stored_entries is not None and stored_entries['date'] == today:
+            # The new row is in both the table and its stored entries, so the table update it causes writes nothing
+            entries_patch = Patch()
+            entries_patch.append(entry)
+            stored_patch = Patch()
+            stored_patch['entries'].append(entry)
+            return entries_patch, '', stored_patch
 
-    return entries_dict, '' # Return today's entries and clear input box
+    # Read the day, with row ids
+    entries_dict, stored_entries = read_table(date_select)
 
-# Delete entry
+    return entries_dict, '', stored_entries # Return today's entries and clear input box
+
+# Delete or edit entries
 @callback(
         Output(component_id='generate_button', component_property='children'),
+        Output(component_id='entries_table', component_property='data', allow_duplicate=True),
+        Output(component_id='stored_entries', component_property='data', allow_duplicate=True),
         Input(component_id='entries_table', component_property='data'),
-        State(component_id='date_select', component_property='value')
+        State(component_id='date_select', component_property='value'),
+        State(component_id='stored_entries', component_property='data'),
+        prevent_initial_call=True
 )
-def delete_entry(entries_dict, date_select):
+@mt.timed('callback.delete_entry')
+def delete_entry(entries_dict, date_select, stored_entries):
+
+    # Ignore the placeholder shown before the first entry
+    rows = [row for row in (entries_dict or []) if row.get('Entry') != uj.PLACEHOLDER_ENTRY]
+
+    # Without this tab's stored entries there is nothing to tell its changes by: show the day as stored, and write nothing
+    if stored_entries is None or stored_entries['date'] != date_select:
+        table, stored_entries = read_table(date_select)
+        return "Generate", table, stored_entries
 
-    # Convert to dataframe
-    entries = pd.DataFrame.from_records(entries_dict)
+    # Only write the rows that were deleted or edited; loading a day writes nothing
+    stored = {entry['id']: entry for entry in stored_entries['entries']}
+    deleted, edited = js.diff_rows(stored, rows)
 
-    # Get path to entries.csv
-    date_entries = entries_path / date_select / 'entries.csv'
+    table = no_update
+    if deleted or edited:
+        try:
+            moved = storage.update_rows(date_select, deleted, edited, stored)
+        except js.StaleRowsError:
+            # The day changed since this tab read it (e.g. in another tab): show it as it is now, rather than overwrite it
+            table, stored_entries = read_table(date_select)
+            return "Generate", table, stored_entries
 
-    # Delete entry
-    if not entries.empty:
-        if entries['Entry'][0] == "No entries yet - add your first entry for today!":
-            entries = entries.iloc[1:] # Delete default entry
-            return "Generate"
-        # Save to csv
-        entries.to_csv(date_entries, index=False)
+        if moved:
+            # Row ids moved (entries.csv was rewritten): give the table the new ones
+            table, stored_entries = read_table(date_select)
+        else:
+            stored_entries = {'date': date_select,
+                              'entries': [{**entry, **edited.get(entry['id'], {})} for entry in stored_entries['entries']
+                                          if entry['id'] not in deleted]}
+        if doc_frequency is not None:
+            doc_frequency.set_day(date_select, [row.get('Entry') for row in rows])
+            doc_frequency.save_if_changed(doc_frequency_path)
 
-    return "Generate"
+    # Keep the salience index in line with the table (only entries that changed are re-tokenized)
+    get_salience_index().set_day(date_select, rows)
+
+    return "Generate", table, (stored_entries if deleted or edited else no_update)
+
+# Keep the date dropdown current: after new entries, and now and then for days added elsewhere (or a new day starting)
+@callback(
+    Output(component_id='date_select', component_property='options'),
+    Input(component_id='entries_table', component_property='data'),
+    Input(component_id='date_index_interval', component_property='n_intervals')
+)
+def update_date_options(entries_dict, n_intervals):
+    return date_index.options(include=datetime.now().strftime('%Y-%m-%d'))
 
 # Disable input box if date is not today
 @callback(
@@ -347,44 +550,39 @@ def button_on_off(ngrok_url):
     else:
         return False
 
-# Generate image
+# Show whether the embedding model is loaded, and stop polling once it is
 @callback(
-    Output(component_id='gen_image_container', component_property='children'),
-    Output(component_id='generate_button', component_property='n_clicks'),
-    [
-    Input(component_id='date_select', component_property='value'),
-    Input(component_id='generate_button', component_property='n_clicks'),
-    State(component_id='entries_table', component_property='data'),
-    State(component_id='n_images', component_property='value'),
-    State(component_id='guidance_scale', component_property='value'),
-    State(component_id='num_inference_steps', component_property='value'),
-    State(component_id='ngrok_url', component_property='value'),
-    State(component_id='image_style', component_property='value')
-    ]
+    Output(component_id='model_status', component_property='children'),
+    Output(component_id='model_status_interval', component_property='disabled'),
+    Input(component_id='model_status_interval', component_property='n_intervals')
 )
-def generate_image(date_select, n_clicks, entries_table, n_images, guidance_scale, num_inference_steps, ngrok_url, image_style):
-    
-    # Create directory for images
-    img_dir = base_path / "assets/gen_images" / date_select
-    img_dir.mkdir(parents=True, exist_ok=True)
+def show_model_status(n_intervals):
+    status = mr.model_status()
+    if status == 'ready':
+        get_salience_index() # Build the words of the entries seen so far
+        nw.build_in_background(mr.get_model()) # Open or build the related-words index, off the generation path
+    return "Text model: " + status, status == 'ready'
 
-    def image_layout(img_files):
-        """Returns a list of image components.
-        
-        Args:
-            date_select (str): Date selected in date_select dropdown.
-            n_images (int): Number of images to display.
-        
-        Returns:
-            list: List of image components.
-        """
-        return [
-            html.Img(
+def image_layout(date, images):
+    """Returns a list of image components: thumbnails, each linking to its full-size image.
+    
+    Args:
+        date (str): The day the images are of.
+        images (list): The day's gallery entries, from gallery.day_images.
+    
+    Returns:
+        list: List of image components.
+    """
+    return [
+        html.A(
+            href = app.get_asset_url(f"gen_images/{date}/{image['full']}"),
+            target = "_blank",
+            children = html.Img(
                 id = {
                     'type': 'gen_image',
                     'index': idx
                 },
-                src = re.search(r"\/assets\/.*", str(image_path)).group(0),
+                src = app.get_asset_url(f"gen_images/{date}/{image['thumb']}"),
                 style= {
                     'display':'inline-block',
                     'float':'center',
@@ -395,50 +593,155 @@ def generate_image(date_select, n_clicks, entries_table, n_images, guidance_scal
                     'borderRadius':'15px'
                     }
             )
-            for idx, image_path in enumerate(img_files)
-        ]
+        )
+        for idx, image in enumerate(images)
+    ]
 
-    # If the callback is triggered but the button hasn't been clicked yet (i.e., only date_select has changed)
-    if n_clicks is None or n_clicks == 0:
-        img_files = [img_file for img_file in img_dir.glob("*.png")]
-        return image_layout(img_files), 0
-    
-    ## If the callback is triggered and the button has been clicked
-    # Load the model
-    try:
-        model.most_similar('hello')
-    except NameError:
-        print("Loading model...")
-        model = lg.load_glove()
+@mt.timed('generation')
+def run_generation(job, date_select, entries, n_images, guidance_scale, num_inference_steps, ngrok_url, image_style, n_related_words=0, span_days=1):
+    """Generates the images for a day, from its own words or those of the span_days days up to it. Runs in the background as a generation job."""
+
+    img_dir = base_path / "assets/gen_images" / date_select
+    img_dir.mkdir(parents=True, exist_ok=True)
 
-    # Get the text from the entries table
-    entries = pd.DataFrame.from_records(entries_table)['Entry'].to_list()
+    # Get the model (only loaded on the first click, if it wasn't preloaded at startup), and the journal's document frequencies
+    with mt.span('wait_for_model'):
+        mr.get_model()
+    get_doc_frequency()
 
     # Get most salient words and split into triples
-    most_salient = gsw.get_most_surprising_words(entries, model, n_images)
+    if span_days > 1:
+        # A range of days ending on the selected one: the entries are streamed from storage, not held in memory
+        start_date = (datetime.strptime(date_select, '%Y-%m-%d') - timedelta(days=span_days - 1)).strftime('%Y-%m-%d')
+        with mt.span('salient_words'):
+            most_salient = gsw.get_most_surprising_words_range((entry['Entry'] for entry in storage.read_range(start_date, date_select)),
+                                                               mr.get_model(), n_images,
+                                                               doc_frequency=doc_frequency)
+    else:
+        # Make sure the index has the entries from the table; normally they were indexed as they were added
+        get_salience_index().set_day(date_select, entries)
+        with mt.span('salient_words'):
+            most_salient = salience_index.most_surprising(date_select, n_images, doc_frequency=doc_frequency)
     most_salient_triples = [most_salient[i:i+3] for i in range(0, len(most_salient), 3)]
 
+    # Add the words closest to each triple; until the neighbour index is built (in the background, see show_model_status), the triples are used as they are
+    if n_related_words:
+        nearest = nw.get_index(mr.get_model(), build=False)
+        if nearest is None:
+            nw.build_in_background(mr.get_model())
+            print("The related-words index is still being built; generating without related words.")
+        else:
+            most_salient_triples = nw.expand_triples(nearest, most_salient_triples[:n_images], n_related_words)
+    prompts = [image_style + ', '.join(triple) for triple in most_salient_triples[:n_images]]
+    job.set_total(len(prompts))
+
+    if job.cancelled:
+        return
+
     # Delete any existing images
-    for img_file in img_dir.glob("*.png"):
-        img_file.unlink()
+    gl.clear_day(img_dir)
 
-    
-    # Generate new images
-    for image in range(n_images):
-        # Generate image
-        print("Generating image " + str(image))
-        gi.generate_image(ngrok_url,
-                          image_style + ', '.join(most_salient_triples[image]),
-                          guidance_scale,
-                          int(round(num_inference_steps)),
-                          img_path = img_dir / f"image_{image+1}_{datetime.now().strftime('%H-%M-%S')}.png"
+    # Give every image its thumbnail and gallery entry as it is written, before the poll shows it
+    def image_done(idx, img_path):
+        gl.add_image(img_path)
+        job.image_done(idx, img_path)
+
+    # Generate new images, all requests in flight at once
+    timestamp = datetime.now().strftime('%H-%M-%S')
+    print("Generating " + str(len(prompts)) + " images")
+    with mt.span('generate_images'):
+        gi.generate_images(ngrok_url,
+                           prompts,
+                           guidance_scale,
+                           int(round(num_inference_steps)),
+                           img_paths = [img_dir / f"image_{image+1}_{timestamp}.png" for image in range(len(prompts))],
+                           max_workers = n_images,
+                           on_image = image_done,
+                           cancel = job.cancel_event
         )
+
+# Generate image
+@callback(
+    Output(component_id='gen_image_container', component_property='children'),
+    Output(component_id='generate_button', component_property='n_clicks'),
+    Output(component_id='generation_job', component_property='data'),
+    Output(component_id='generation_poll', component_property='disabled'),
+    [
+    Input(component_id='date_select', component_property='value'),
+    Input(component_id='generate_button', component_property='n_clicks'),
+    State(component_id='entries_table', component_property='data'),
+    State(component_id='n_images', component_property='value'),
+    State(component_id='guidance_scale', component_property='value'),
+    State(component_id='num_inference_steps', component_property='value'),
+    State(component_id='ngrok_url', component_property='value'),
+    State(component_id='image_style', component_property='value'),
+    State(component_id='n_related_words', component_property='value'),
+    State(component_id='salience_span', component_property='value')
+    ]
+)
+@mt.timed('callback.generate_image')
+def generate_image(date_select, n_clicks, entries_table, n_images, guidance_scale, num_inference_steps, ngrok_url, image_style, n_related_words, salience_span):
     
-    # Get list of image files
-    img_files = [img_file for img_file in img_dir.glob("*.png")]
+    # If the callback is triggered but the button hasn't been clicked yet (i.e., only date_select has changed)
+    if n_clicks is None or n_clicks == 0:
+        return image_layout(date_select, gl.day_images(base_path / "assets/gen_images" / date_select)), 0, None, True
+    
+    ## If the callback is triggered and the button has been clicked
+    # Hand the work to a background job, and poll it for images
+    entries = [entry for entry in (entries_table or []) if entry.get('Entry') != uj.PLACEHOLDER_ENTRY]
+    job_id = gj.submit_job(run_generation, date_select, entries, n_images, guidance_scale, num_inference_steps, ngrok_url, image_style, n_related_words or 0, salience_span or 1)
+
+    return no_update, 0, {'id': job_id, 'date': date_select}, False
+
+# Show the progress of the generation job, adding images as they are written
+@callback(
+    Output(component_id='gen_image_container', component_property='children', allow_duplicate=True),
+    Output(component_id='generation_status', component_property='children'),
+    Output(component_id='generation_poll', component_property='disabled', allow_duplicate=True),
+    Input(component_id='generation_poll', component_property='n_intervals'),
+    State(component_id='generation_job', component_property='data'),
+    State(component_id='date_select', component_property='value'),
+    prevent_initial_call=True
+)
+def poll_generation(n_intervals, job_info, date_select):
+
+    job = gj.get_job(job_info['id']) if job_info else None
+    if job is None:
+        return no_update, '', True
 
-    # Return list of image components
-    return image_layout(img_files), 0
+    progress = job.progress()
+    n_done = len(progress['completed'])
+    if progress['status'] == 'queued':
+        status = "Waiting for other generations to finish..."
+    elif progress['status'] == 'running':
+        status = f"Generated {n_done} of {progress['total'] if progress['total'] is not None else '?'} images..."
+    elif progress['status'] == 'cancelled':
+        status = f"Cancelled after {n_done} images."
+    elif progress['status'] == 'failed':
+        status = "Generation failed: " + progress['error']
+    else:
+        status = ''
+
+    # Only show the job's images once there are any (until then the old images stay), and only for its own date;
+    # the day's gallery lists the job's images as they are written
+    if job_info['date'] != date_select or (n_done == 0 and not job.finished):
+        images = no_update
+    else:
+        images = image_layout(date_select, gl.day_images(base_path / "assets/gen_images" / date_select))
+
+    return images, status, job.finished
+
+# Cancel the generation job
+@callback(
+    Output(component_id='generation_status', component_property='children', allow_duplicate=True),
+    Input(component_id='cancel_button', component_property='n_clicks'),
+    State(component_id='generation_job', component_property='data'),
+    prevent_initial_call=True
+)
+def cancel_generation(n_clicks, job_info):
+    if job_info and gj.cancel_job(job_info['id']):
+        return "Cancelling..."
+    return no_update
 
 
 # Run the app
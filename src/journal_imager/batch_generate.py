@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import src.journal_imager.doc_frequency as dfreq
+import src.journal_imager.gallery as gl
+import src.journal_imager.generate_image as gi
+import src.journal_imager.get_salient_words as gsw
+import src.journal_imager.journal_storage as js
+import src.journal_imager.load_glove as lg
+
+# Written in a day's image directory once all of its images are there; a rerun skips the day if nothing changed
+MANIFEST_NAME = 'batch.json'
+
+# Written when a day's images are started, so an interrupted run can pick up where it stopped
+PENDING_NAME = 'batch.pending.json'
+
+# The embedding, storage and document frequencies of a worker process, opened once by _init_worker
+_worker = {}
+
+def _init_worker(entries_path, backend, glove_options):
+    # Every worker memory-maps the same compiled store, so the vectors are in memory once, in the page cache
+    _worker['storage'] = js.get_storage(entries_path, backend)
+    _worker['model'] = lg.load_glove(**glove_options)
+    # Brought up to date and saved by run_batch before the workers start, so they only read it
+    _worker['doc_frequency'] = dfreq.DocumentFrequency.load(_worker['model'], Path(entries_path) / dfreq.FILE_NAME)
+
+def day_prompts(date, n_images, image_style):
+    """ Tokenize a day's entries and build its prompts from the most surprising words. Runs in a worker process.
+
+    Words are weighted by how rarely the journal uses them, like in the app, so both pick the same words for a day.
+
+    Args:
+        date (str): The day, 'YYYY-MM-DD'.
+        n_images (int): The number of images for the day.
+        image_style (str): Prefix of every prompt, e.g. 'photo of '.
+
+    Returns:
+        tuple: The date and its prompts (at most n_images).
+    """
+
+    texts = [entry['Entry'] for entry in _worker['storage'].read_day(date)]
+    words = gsw.get_most_surprising_words(texts, _worker['model'], n_images, doc_frequency=_worker['doc_frequency'])
+    triples = [words[i:i+3] for i in range(0, len(words), 3)]
+    return date, [image_style + ', '.join(triple) for triple in triples[:n_images]]
+
+def day_manifest(prompts, guidance_scale, num_inference_steps, ngrok_url):
+    """ Describe what a day's images were generated from, to tell on a rerun whether they are still current. """
+    return {'prompts': prompts, 'guidance_scale': guidance_scale, 'num_inference_steps': num_inference_steps, 'backend': ngrok_url}
+
+def pending_images(img_dir, manifest):
+    """ Get the images of a day that still have to be generated.
+
+    Args:
+        img_dir (Path): The day's image directory.
+        manifest (dict): The day's manifest, from day_manifest().
+
+    Returns:
+        list: (prompt, img_path) pairs. Empty if the day is done; all prompts (with old images deleted) if the
+        day's prompts or settings changed since its images were generated.
+    """
+
+    img_paths = [img_dir / f'image_{idx + 1}.png' for idx in range(len(manifest['prompts']))]
+    manifest_file = img_dir / MANIFEST_NAME
+    if manifest_file.exists() and json.loads(manifest_file.read_text()) == manifest:
+        return []
+
+    # An interrupted run of the same prompts keeps its images; anything else starts over
+    pending_file = img_dir / PENDING_NAME
+    if not (pending_file.exists() and json.loads(pending_file.read_text()) == manifest):
+        img_dir.mkdir(parents=True, exist_ok=True)
+        gl.clear_day(img_dir)
+        manifest_file.unlink(missing_ok=True)
+        pending_file.write_text(json.dumps(manifest))
+
+    return [(prompt, img_path) for prompt, img_path in zip(manifest['prompts'], img_paths) if not img_path.exists()]
+
+def run_batch(ngrok_url, dates, entries_path, output_path, n_images=3, image_style='photo of ', guidance_scale=7.5,
+              num_inference_steps=50, workers=None, concurrency=4, queue_size=None, backend=None, glove_options=None):
+    """ Generate the images of many days: the days are scored in a process pool, and the images are
+    requested by a fixed number of threads, fed through a bounded queue.
+
+    Each day's images go to output_path/<date>/image_<n>.png, with their thumbnails, like the app's. A day is marked done with
+    a manifest of its prompts and settings, so a rerun (e.g. after an interruption) only generates the
+    images that are missing or whose day changed.
+
+    Args:
+        ngrok_url (str): The URL of the generation backend.
+        dates (list): The days to generate images for, 'YYYY-MM-DD'.
+        entries_path (str): Path to journal entries directory.
+        output_path (str): Directory the per-day image directories go in.
+        n_images (int): Images per day.
+        image_style (str): Prefix of every prompt.
+        guidance_scale (float): The guidance scale to generate with.
+        num_inference_steps (int): The number of inference steps to generate with.
+        workers (int): Processes scoring days; 0 scores them in this process. Defaults to the number of CPUs.
+        concurrency (int): Requests in flight to the backend at once.
+        queue_size (int): Images waiting for a request thread, at most. Defaults to 4 * concurrency.
+        backend (str): Storage backend, see journal_storage.get_storage.
+        glove_options (dict): Keyword arguments for load_glove, e.g. {'dim': 300, 'dtype': 'int8'}.
+
+    Returns:
+        dict: Counts of 'days', 'days_skipped', 'images' (generated) and 'failed' (to be retried by a rerun).
+    """
+
+    output_path = Path(output_path)
+    glove_options = glove_options or {}
+    counts = {'days': len(dates), 'days_skipped': 0, 'images': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    # Download and compile the embedding here if needed, and bring the document frequencies up to date, so the workers only open them
+    model = lg.load_glove(**glove_options)
+    dfreq.load_or_build(js.get_storage(entries_path, backend), model, Path(entries_path) / dfreq.FILE_NAME)
+
+    # Images left per day; when a day's last image is written, its manifest marks it done
+    days_left = {}
+    manifests = {}
+
+    def finish_image(date, ok):
+        with counts_lock:
+            counts['images' if ok else 'failed'] += 1
+            days_left[date] -= 1
+            day_done = days_left[date] == 0
+        if day_done:
+            img_dir = output_path / date
+            if all(img_dir.joinpath(f'image_{idx + 1}.png').exists() for idx in range(len(manifests[date]['prompts']))):
+                (img_dir / MANIFEST_NAME).write_text(json.dumps(manifests[date]))
+                (img_dir / PENDING_NAME).unlink(missing_ok=True)
+
+    # Request threads: take images off the queue until they get None
+    images = queue.Queue(maxsize=queue_size or 4 * concurrency)
+
+    def send_requests():
+        while True:
+            item = images.get()
+            if item is None:
+                return
+            date, prompt, img_path = item
+            try:
+                gi.generate_image(ngrok_url, prompt, guidance_scale, num_inference_steps, img_path)
+                gl.add_image(img_path)
+                finish_image(date, True)
+            except Exception as e:
+                print(f'{date}: generating {img_path.name} failed: {e}')
+                finish_image(date, False)
+
+    senders = [threading.Thread(target=send_requests, name=f'batch-sender-{idx}', daemon=True) for idx in range(concurrency)]
+    for sender in senders:
+        sender.start()
+
+    # Workers are spawned rather than forked, since the request threads are already running; 0 workers scores here
+    if workers == 0:
+        _init_worker(entries_path, backend, glove_options)
+        pool = contextlib.nullcontext(types.SimpleNamespace(map=map))
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(entries_path, backend, glove_options))
+
+    try:
+        with pool as scorer:
+            # Days are scored in parallel; their images are queued as each day comes back, in date order
+            for date, prompts in scorer.map(day_prompts, dates, [n_images] * len(dates), [image_style] * len(dates)):
+                manifest = manifests[date] = day_manifest(prompts, guidance_scale, num_inference_steps, ngrok_url)
+                pending = pending_images(output_path / date, manifest) if prompts else []
+                with counts_lock:
+                    if not pending:
+                        counts['days_skipped'] += 1
+                        continue
+                    days_left[date] = len(pending)
+                for prompt, img_path in pending:
+                    images.put((date, prompt, img_path)) # blocks while the backend is behind
+    finally:
+        for _ in senders:
+            images.put(None)
+        for sender in senders:
+            sender.join()
+
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate the images for a range of journal days.')
+    parser.add_argument('url', help='URL of the generation backend (e.g. the ngrok URL of the Colab notebook)')
+    parser.add_argument('--start', default='0000-00-00', help='first day, YYYY-MM-DD (default: the first day of the journal)')
+    parser.add_argument('--end', default='9999-99-99', help='last day, YYYY-MM-DD (default: the last day of the journal)')
+    parser.add_argument('--images', type=int, default=3, help='images per day')
+    parser.add_argument('--style', default='photo of ', help="prompt prefix, e.g. 'abstract art of '")
+    parser.add_argument('--guidance-scale', type=float, default=7.5)
+    parser.add_argument('--steps', type=int, default=50, help='inference steps')
+    parser.add_argument('--workers', type=int, default=None, help='processes scoring days; 0 scores them in this process (default: number of CPUs)')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight to the backend')
+    parser.add_argument('--entries-path', default=Path(__file__).parent / 'journal_entries')
+    parser.add_argument('--output-path', default=Path(__file__).parent / 'assets/gen_images')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default=None, help='default: JOURNAL_IMAGER_STORAGE, or csv')
+    parser.add_argument('--glove-path', default=None, help='directory of the GloVe embeddings (default: assets/glove.6B)')
+    parser.add_argument('--dim', type=int, choices=[50, 100, 200, 300], default=None, help='default: JOURNAL_IMAGER_GLOVE_DIM, or 50')
+    parser.add_argument('--dtype', choices=lg.DTYPES, default=None, help='default: JOURNAL_IMAGER_GLOVE_DTYPE, or float32')
+    args = parser.parse_args(argv)
+
+    storage = js.get_storage(args.entries_path, args.storage)
+    dates = [date for date in reversed(storage.list_dates()) if args.start <= date <= args.end]
+    print(f'Generating images for {len(dates)} days...')
+
+    counts = run_batch(args.url, dates, args.entries_path, args.output_path,
+                       n_images=args.images, image_style=args.style, guidance_scale=args.guidance_scale,
+                       num_inference_steps=args.steps, workers=args.workers, concurrency=args.concurrency,
+                       backend=args.storage, glove_options={'glove_path': args.glove_path, 'dim': args.dim, 'dtype': args.dtype})
+
+    print(f"Generated {counts['images']} images; {counts['days_skipped']} of {counts['days']} days were already done.")
+    if counts['failed']:
+        print(f"{counts['failed']} images failed; run again to retry them.")
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    # python -m src.journal_imager.batch_generate https://12345abcde.ngrok-free.app --start 2023-01-01 --end 2023-06-30
+    raise SystemExit(main())
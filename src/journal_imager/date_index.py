@@ -0,0 +1,62 @@
+import bisect
+import threading
+
+class DateIndex:
+    """ The dates of the journal, newest first, kept in memory for the date dropdown.
+
+    The dates are listed from storage once. After that, add() inserts a new day in place,
+    and changes made some other way (another process, a deleted day) are noticed through
+    storage.dates_version(), which is a single stat or query rather than a scan of all days.
+    Between changes, options() returns the same cached list.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._dates = None      # oldest first, so new days are appended
+        self._version = None
+        self._options = {}      # date that must be included -> dropdown options
+        self._lock = threading.Lock()
+
+    def dates(self):
+        """ Get the dates that have entries, newest first. """
+        with self._lock:
+            self._refresh()
+            return self._dates[::-1]
+
+    def add(self, date):
+        """ Record that a day got its first entry. """
+        with self._lock:
+            self._refresh()
+            idx = bisect.bisect_left(self._dates, date)
+            if idx == len(self._dates) or self._dates[idx] != date:
+                self._dates.insert(idx, date)
+                self._options.clear()
+            # The storage's version moved on because of this day; don't rescan for it
+            self._version = self.storage.dates_version()
+
+    def options(self, include=None):
+        """ Get the dropdown options, newest first.
+
+        Args:
+            include (str): A date to list even if it has no entries yet, e.g. today.
+
+        Returns:
+            list: Options as {'label': date, 'value': date}; the same list object until the dates change.
+        """
+        with self._lock:
+            self._refresh()
+            options = self._options.get(include)
+            if options is None:
+                dates = self._dates
+                if include is not None and include not in dates:
+                    dates = sorted(dates + [include])
+                options = self._options[include] = [{'label': date, 'value': date} for date in reversed(dates)]
+            return options
+
+    def _refresh(self):
+        # Rescan only when the storage says the dates changed
+        version = self.storage.dates_version()
+        if self._dates is None or version != self._version:
+            self._dates = sorted(self.storage.list_dates())
+            self._version = version
+            self._options.clear()
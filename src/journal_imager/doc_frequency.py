@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+import src.journal_imager.journal_storage as js
+import src.journal_imager.metrics as mt
+import src.journal_imager.tokenize_entries as te
+from src.journal_imager.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# File in the journal directory the table is kept in
+FILE_NAME = 'doc_frequency.npz'
+
+def vocabulary_hash(model):
+    """ Fingerprint a model's vocabulary, so a table built for another vocabulary is not used with it. """
+    return hashlib.sha1('\n'.join(model.index_to_key).encode('utf-8')).hexdigest()
+
+class DocumentFrequency:
+    """ In how many days of the journal each word of the embedding's vocabulary occurs.
+
+    counts[i] is the number of days that use the word model.index_to_key[i]. The distinct words
+    of every day are kept as well, so adding an entry, or editing or deleting a day, only
+    changes the counts of the words that came or went. Only those per-day word sets are
+    saved; the counts are rebuilt from them with one bincount when the table is loaded.
+
+    Every day also remembers the storage version (see day_versions) its words were read at,
+    so sync() re-reads exactly the days that changed since, wherever they were changed.
+
+    Words a user writes (almost) every day get an inverse document frequency (idf) near 1,
+    words they rarely use a higher one; get_salient_words uses it to weight surprise.
+    """
+
+    def __init__(self, model, days=None):
+        self.model = model
+        self.days = {} if days is None else days                 # date -> set of word indices
+        self.versions = {}                                       # date -> storage version the day was read at
+        self.counts = np.zeros(len(model.index_to_key), dtype=np.int32)
+        for indices in self.days.values():
+            self.counts[list(indices)] += 1
+        self.changed = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def n_days(self):
+        return len(self.days)
+
+    def add_entry(self, date, text):
+        """ Count the words of a new entry for a day. """
+        with self._lock:
+            indices = self._indices([text])
+            day = self.days.setdefault(date, set())
+            new = indices - day
+            if new:
+                self.counts[list(new)] += 1
+                day |= new
+                self.changed = True
+
+    def set_day(self, date, texts):
+        """ Bring a day in line with its entries, e.g. after entries were edited or deleted; no texts removes the day. """
+        with self._lock:
+            indices = self._indices(texts)
+            day = self.days.get(date, set())
+            added, removed = indices - day, day - indices
+            if added or removed:
+                self.counts[list(added)] += 1
+                self.counts[list(removed)] -= 1
+                self.changed = True
+            if indices:
+                self.days[date] = indices
+            else:
+                self.days.pop(date, None)
+
+    def sync(self, storage):
+        """ Bring the table in line with storage: re-read the days whose version changed (or that are new), and drop the days that are gone.
+
+        Entries added or edited through add_entry and set_day don't update a day's version, so the
+        day is re-read once by the next sync; that also catches changes made by other processes.
+        """
+        # Versions are taken before the entries are read, so a change in between is picked up by the next sync
+        versions = storage.day_versions()
+        with self._lock:
+            known = dict(self.versions)
+            gone = (set(self.days) | set(known)) - set(versions)
+        for date, version in versions.items():
+            if known.get(date) != version:
+                self.set_day(date, [entry['Entry'] for entry in storage.read_day(date)])
+                with self._lock:
+                    self.versions[date] = version
+                    self.changed = True
+        for date in gone:
+            self.set_day(date, [])
+            with self._lock:
+                self.versions.pop(date, None)
+                self.changed = True
+
+    def idf(self, words):
+        """ Get the smoothed inverse document frequency of some words: log((1 + n_days) / (1 + days with the word)) + 1.
+
+        Args:
+            words (list): Words in the model's vocabulary.
+
+        Returns:
+            numpy.ndarray: One idf per word, at least 1.
+        """
+
+        df = self.counts[[self.model.key_to_index[word] for word in words]]
+        return np.log((1 + self.n_days) / (1 + df)) + 1
+
+    def save(self, path):
+        """ Write the per-day word sets to an .npz file (written to a temporary name first, then renamed). """
+        with self._lock:
+            # Days without words have no word set, but keep their version
+            dates = sorted(set(self.days) | set(self.versions))
+            sets = [np.fromiter(sorted(self.days.get(date, ())), dtype=np.int32) for date in dates]
+            versions = [self.versions.get(date, '') for date in dates]
+            offsets = np.zeros(len(sets) + 1, dtype=np.int64)
+            np.cumsum([len(indices) for indices in sets], out=offsets[1:])
+            indices = np.concatenate(sets) if sets else np.empty(0, dtype=np.int32)
+            self.changed = False
+            self._saved_at = time.monotonic()
+
+        # A temporary name per process and thread, so concurrent savers (app workers, the batch command) don't write each other's
+        path = Path(path)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, dates=np.array(dates, dtype=str), versions=np.array(versions, dtype=str), offsets=offsets, indices=indices,
+                     vocabulary=vocabulary_hash(self.model))
+        tmp_path.replace(path)
+
+    def save_if_changed(self, path, min_interval=30):
+        """ Save if anything changed, at most once every min_interval seconds. """
+        if self.changed and time.monotonic() - self._saved_at >= min_interval:
+            self.save(path)
+
+    @classmethod
+    def load(cls, model, path):
+        """ Read a table written by save().
+
+        Returns:
+            DocumentFrequency: The table, or None if there is none, or it was built for another vocabulary.
+        """
+
+        path = Path(path)
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            if str(data['vocabulary']) != vocabulary_hash(model):
+                return None
+            dates, offsets, indices = data['dates'], data['offsets'], data['indices']
+            # Tables saved before versions were kept have every day re-read by the next sync
+            versions = data['versions'] if 'versions' in data.files else [''] * len(dates)
+
+        table = cls(model)
+        table.days = {str(date): set(indices[offsets[idx]:offsets[idx + 1]].tolist())
+                      for idx, date in enumerate(dates) if offsets[idx + 1] > offsets[idx]}
+        table.versions = {str(date): str(version) for date, version in zip(dates, versions) if version}
+        table.counts = np.bincount(indices, minlength=len(model.index_to_key)).astype(np.int32)
+        return table
+
+    def _indices(self, texts):
+        return {self.model.key_to_index[word] for word in te.iter_tokens(texts, vocabulary=self.model.key_to_index)}
+
+def load_or_build(storage, model, path):
+    """ Load the table for a model from path, bring it up to date with storage, and save it if that changed anything.
+
+    Args:
+        storage (CsvStorage or SqliteStorage): The journal.
+        model (gensim.models.keyedvectors.KeyedVectors): The embedding the table is keyed by.
+        path (str): The table's file, normally entries_path / FILE_NAME.
+
+    Returns:
+        DocumentFrequency: The table.
+    """
+
+    with mt.span('load_doc_frequency'):
+        table = DocumentFrequency.load(model, path) or DocumentFrequency(model)
+        table.sync(storage)
+        if table.changed or not Path(path).exists():
+            table.save(path)
+    return table
+
+
+if __name__ == '__main__':
+    # Rebuild the table from scratch, e.g. after editing entries.csv files by hand: python -m src.journal_imager.doc_frequency
+    import src.journal_imager.load_glove as lg
+
+    parser = argparse.ArgumentParser(description='Rebuild the document-frequency table of the journal.')
+    parser.add_argument('--entries-path', default=Path(__file__).parent / 'journal_entries')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default=None)
+    args = parser.parse_args()
+
+    table = DocumentFrequency(lg.load_glove())
+    table.sync(js.get_storage(args.entries_path, args.storage))
+    table.save(Path(args.entries_path) / FILE_NAME)
+    print(f'Counted the words of {table.n_days} days.')
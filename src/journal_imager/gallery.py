@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from flask import request
+from natsort import natsorted
+
+import src.journal_imager.image_cache as ic
+import src.journal_imager.metrics as mt
+from src.journal_imager.write_image import save_thumbnail, thumbnail_format
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, only threads of one process are kept from each other
+    fcntl = None
+
+# Per day, the images of the gallery are listed in gallery.json, and served from gallery/ under
+# content-hashed names (a full-size link and a thumbnail each), e.g. gallery/image_1.3f2a9c0d1e4b5a67.webp
+MANIFEST_NAME = 'gallery.json'
+FILES_DIR = 'gallery'
+
+# Names that change whenever their content does, so browsers can keep them for good
+HASHED_NAME = re.compile(r'\.[0-9a-f]{16}\.(png|webp|jpg)$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Manifests read so far: image directory -> (manifest's (mtime, size), images)
+_manifests = {}
+_lock = threading.Lock()
+
+@contextmanager
+def _day_locked(img_dir):
+    # Around every change to a day's gallery: threads of this process take turns on _lock, and
+    # processes (the app and the batch command) on an exclusive flock of the day's directory itself
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(img_dir, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+def content_hash(path):
+    """ Get the first 16 hex digits of the SHA-256 of a file. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+def add_image(img_path):
+    """ Add an image that was just written to its day's gallery.
+
+    The image gets a content-hashed hard link and a downscaled thumbnail in the day's gallery/
+    directory, and an entry in the day's manifest (replacing the entry of an older image of
+    the same name).
+
+    Args:
+        img_path (str): The image, in its day's image directory.
+
+    Returns:
+        dict: The image's entry: 'name', and 'full' and 'thumb' relative to the image directory.
+    """
+
+    img_path = Path(img_path)
+    img_dir = img_path.parent
+    (img_dir / FILES_DIR).mkdir(exist_ok=True)
+
+    with mt.span('thumbnail'):
+        digest = content_hash(img_path)
+        full = f'{FILES_DIR}/{img_path.stem}.{digest}.png'
+        thumb = f'{FILES_DIR}/{img_path.stem}.{digest}{thumbnail_format()[1]}'
+        if not (img_dir / full).exists():
+            ic.link_or_copy(img_path, img_dir / full)
+        if not (img_dir / thumb).exists():
+            save_thumbnail(img_path, img_dir / thumb)
+
+    entry = {'name': img_path.name, 'full': full, 'thumb': thumb}
+    with _day_locked(img_dir):
+        manifest = _read_manifest(img_dir)
+        old = manifest.get(img_path.name)
+        manifest[img_path.name] = entry
+        _write_manifest(img_dir, manifest)
+
+    # The files of the image this one replaces are not listed anymore
+    if old is not None and old != entry:
+        for name in (old['full'], old['thumb']):
+            (img_dir / name).unlink(missing_ok=True)
+
+    return entry
+
+def day_images(img_dir):
+    """ Get the images of a day's gallery, in natural order of their names.
+
+    The manifest is read once and then cached, so a call costs one stat of the manifest.
+    A directory from before manifests (or written by other tools) gets its manifest and
+    thumbnails built on first use, which is the only time it is scanned.
+
+    Args:
+        img_dir (str): The day's image directory.
+
+    Returns:
+        list: Entries as returned by add_image().
+    """
+
+    img_dir = Path(img_dir)
+    manifest_file = img_dir / MANIFEST_NAME
+    try:
+        stat = manifest_file.stat()
+    except FileNotFoundError:
+        img_files = natsorted(img_dir.glob('*.png')) if img_dir.exists() else []
+        for img_file in img_files:
+            add_image(img_file)
+        if not img_files:
+            return []
+        stat = manifest_file.stat()
+
+    with _lock:
+        cached = _manifests.get(img_dir)
+        if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+            images = natsorted(_read_manifest(img_dir).values(), key=lambda entry: entry['name'])
+            cached = _manifests[img_dir] = ((stat.st_mtime_ns, stat.st_size), images)
+        return cached[1]
+
+def clear_day(img_dir):
+    """ Delete a day's images, with their gallery files and manifest. """
+    img_dir = Path(img_dir)
+    if not img_dir.exists():
+        return
+    with _day_locked(img_dir):
+        for img_file in img_dir.glob('*.png'):
+            img_file.unlink()
+        shutil.rmtree(img_dir / FILES_DIR, ignore_errors=True)
+        (img_dir / MANIFEST_NAME).unlink(missing_ok=True)
+        _manifests.pop(img_dir, None)
+
+def install(server, prefix='/assets/gen_images/'):
+    """ Serve the gallery's content-hashed files with long-lived, immutable cache headers.
+
+    Args:
+        server (flask.Flask): The app's server, e.g. app.server.
+        prefix (str): URL path the image directories are served under.
+
+    Returns:
+        None
+    """
+
+    @server.after_request
+    def cache_hashed_images(response):
+        if response.status_code in (200, 304) and request.path.startswith(prefix) and HASHED_NAME.search(request.path):
+            response.headers['Cache-Control'] = IMMUTABLE
+            response.headers.pop('Expires', None)
+        return response
+
+def _read_manifest(img_dir):
+    # Image name -> entry; empty if there is no manifest yet
+    try:
+        with open(img_dir / MANIFEST_NAME, encoding='utf-8') as f:
+            return {entry['name']: entry for entry in json.load(f)}
+    except FileNotFoundError:
+        return {}
+
+def _write_manifest(img_dir, manifest):
+    # Written to a temporary name first, so readers never see half a manifest
+    images = natsorted(manifest.values(), key=lambda entry: entry['name'])
+    tmp_file = img_dir / f'.{MANIFEST_NAME}.{os.getpid()}.{threading.get_ident()}.part'
+    tmp_file.write_text(json.dumps(images), encoding='utf-8')
+    os.replace(tmp_file, img_dir / MANIFEST_NAME)
+    stat = (img_dir / MANIFEST_NAME).stat()
+    _manifests[img_dir] = ((stat.st_mtime_ns, stat.st_size), images)
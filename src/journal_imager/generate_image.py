@@ -1,35 +1,534 @@
 import requests
-import base64
-import io
-from PIL import Image
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from requests.adapters import HTTPAdapter
 
-def generate_image(ngrok_url, prompt, guidance_scale, num_inference_steps, img_path):
+import src.journal_imager.image_cache as ic
+import src.journal_imager.metrics as mt
+from src.journal_imager.write_image import save_image, save_image_stream
+
+# (connect, read) timeout in seconds for a single image; diffusion on a Colab GPU can take a while
+DEFAULT_TIMEOUT = (10, 300)
+
+# One keep-alive session per backend URL, shared by all threads
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Backends that answered the batch endpoint with "not found", so only the single-prompt endpoint is used for them
+_batch_unsupported = set()
+
+# Status codes meaning the backend has no batch endpoint (e.g. an older Colab notebook)
+BATCH_UNSUPPORTED_STATUS = (404, 405, 501)
+
+# Bytes read from the response at a time, while streaming an image to disk
+CHUNK_SIZE = 64 * 1024
+
+# Seconds between checks for cancellation while waiting for images
+CANCEL_POLL_INTERVAL = 0.25
+
+# Most seconds a single request may take in total, on top of the (connect, read) timeout between bytes
+REQUEST_DEADLINE = 600
+
+# Transient failures are retried: connection errors, timeouts, and these statuses
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRIES = 2
+
+# Retry n waits a random time up to BACKOFF * 2 ** n seconds (at most MAX_BACKOFF), so clients don't retry in lockstep
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+# If an image takes longer than this percentile of the backend's recent latencies, a duplicate request is sent
+# and whichever answers first is used; until HEDGE_MIN_SAMPLES latencies are known, there is no hedging
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 8
+LATENCY_WINDOW = 100
+
+# After BREAKER_FAILURES transient failures in a row a backend gets no requests for BREAKER_RESET seconds;
+# then one trial request decides whether it is back
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30
+
+class BackendUnavailable(requests.RequestException):
+    """ The backend's circuit breaker is open: it failed repeatedly, so it isn't sent requests for now. """
+
+class CircuitBreaker:
+    """ Stops sending requests to a backend that keeps failing, and lets one through now and then to see if it is back.
+
+    Closed: requests go through, and transient failures in a row are counted. Open (after
+    `failures` of them): requests are refused for `reset_after` seconds. Half-open: one trial
+    request goes through; its success closes the breaker, its failure opens it again. A trial
+    whose outcome is never recorded does not keep the breaker half-open: another one goes
+    through `reset_after` seconds later.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failed = 0               # transient failures in a row
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Check whether a request may be sent now; when not closed, only one caller per `reset_after` seconds gets to. """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_after:
+                self.state = 'half-open'
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        """ Record that the backend answered (even with an error that is not its fault, like a 404). """
+        with self._lock:
+            self.state = 'closed'
+            self.failed = 0
+
+    def record_failure(self):
+        """ Record a failure of the backend: a connection error, a timeout, a status in RETRY_STATUS or a malformed answer. """
+        with self._lock:
+            self.failed += 1
+            if self.state == 'half-open' or self.failed >= self.failures:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+# Per backend URL: its circuit breaker, and the latencies of its recent successful requests
+_breakers = {}
+_latencies = {}
+_backends_lock = threading.Lock()
+
+def get_breaker(ngrok_url):
+    """ Get the circuit breaker of a backend, creating it on first use. """
+    with _backends_lock:
+        breaker = _breakers.get(ngrok_url)
+        if breaker is None:
+            breaker = _breakers[ngrok_url] = CircuitBreaker()
+        return breaker
+
+def record_latency(ngrok_url, seconds):
+    """ Remember how long a successful image request to a backend took, for hedge_delay(). """
+    with _backends_lock:
+        _latencies.setdefault(ngrok_url, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+def hedge_delay(ngrok_url):
+    """ Get the HEDGE_PERCENTILE percentile of a backend's recent latencies, or None if too few are known. """
+    with _backends_lock:
+        latencies = sorted(_latencies.get(ngrok_url, ()))
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE / 100))]
+
+def is_transient(error):
+    """ Check whether a failed request is worth retrying (and counts against the backend's circuit breaker). """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+def _time_left(give_up_at):
+    return None if give_up_at is None else give_up_at - time.monotonic()
+
+def _bounded_timeout(timeout, give_up_at):
+    # requests' timeout, shortened so that it ends by give_up_at
+    time_left = _time_left(give_up_at)
+    if time_left is None:
+        return timeout
+    if time_left <= 0:
+        raise requests.Timeout('Deadline passed.')
+    if isinstance(timeout, tuple):
+        return tuple(time_left if part is None else min(part, time_left) for part in timeout)
+    return time_left if timeout is None else min(timeout, time_left)
+
+def _until(chunks, give_up_at, finished=None):
+    # The read timeout only bounds the wait for each chunk; this bounds the whole body, and stops a hedged request that lost
+    for chunk in chunks:
+        if give_up_at is not None and time.monotonic() > give_up_at:
+            raise requests.Timeout('Deadline passed while receiving the image.')
+        if finished is not None and finished.is_set():
+            raise requests.ConnectionError('Another request for the image finished first.')
+        yield chunk
+
+def get_session(ngrok_url, pool_size=8):
+    """ Get the pooled HTTP session for a backend, creating it on first use.
+
+    Reusing the session keeps TCP/TLS connections to the backend open between requests.
+
+    Args:
+        ngrok_url (str): The URL of the ngrok server.
+        pool_size (int): The maximum number of open connections to the backend.
+
+    Returns:
+        requests.Session: The session for ngrok_url.
+    """
+
+    with _sessions_lock:
+        session = _sessions.get(ngrok_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[ngrok_url] = session
+
+    return session
+
+def generate_image(ngrok_url, prompt, guidance_scale, num_inference_steps, img_path, timeout=DEFAULT_TIMEOUT, cache=True,
+                   deadline=REQUEST_DEADLINE, retries=RETRIES, hedge=True, hedge_after=None, cancel=None):
     """ Given a prompt, generate an image.
 
+    If the same image (same prompt, parameters and backend) was generated before, it is
+    taken from the image cache without contacting the backend.
+
+    Transient failures (connection errors, timeouts, and statuses in RETRY_STATUS) are retried
+    after a jittered exponential backoff, and count against the backend's circuit breaker. A
+    request that takes longer than usual for the backend is hedged: a duplicate is sent, and
+    whichever answers first is used.
+
     Args:
         ngrok_url (str): The URL of the ngrok server.
         prompt (str): The prompt to generate the image from.
         guidance_scale (float): The guidance scale to use when generating the image.
         num_inference_steps (int): The number of inference steps to use when generating the image.
         img_path (str): The path to save the generated image to.
+        timeout (float or tuple): Seconds to wait for the backend, as requests' (connect, read) timeout.
+        cache (bool): Whether to use the image cache.
+        deadline (float): Seconds the image may take in all, including retries; None for no limit.
+        retries (int): Times a transient failure is retried.
+        hedge (bool): Whether to send a duplicate request when the first one is slow.
+        hedge_after (float): Seconds before the duplicate is sent. Defaults to hedge_delay(ngrok_url).
+        cancel (threading.Event): If set, no more retries are made.
 
     Returns:
         None
+
+    Raises:
+        BackendUnavailable: If the backend's circuit breaker is open.
+        requests.Timeout: If the deadline passed.
     """
-    
-    # Send a request to the Colab notebook
-    response = requests.post(ngrok_url + '/generate',
-                             json = {
-                                 'prompt': prompt,
-                                 'guidance_scale': guidance_scale,
-                                 'num_inference_steps': num_inference_steps
-                                 }
-    )
-
-    # Get the image string from the response
-    img_str = dict(response.json())['image']
-
-    # base64 to image
-    img_bytes = base64.b64decode(img_str[2::])
-    img = Image.open(io.BytesIO(img_bytes))
-    img.save(img_path)
\ No newline at end of file
+
+    # Serve the image from the cache if possible
+    key = ic.cache_key(prompt, guidance_scale, num_inference_steps, ngrok_url)
+    if cache and ic.get_cached_image(key, img_path):
+        return
+
+    breaker = get_breaker(ngrok_url)
+    give_up_at = None if deadline is None else time.monotonic() + deadline
+    payload = {'prompt': prompt, 'guidance_scale': guidance_scale, 'num_inference_steps': num_inference_steps}
+    if hedge and hedge_after is None:
+        hedge_after = hedge_delay(ngrok_url)
+
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            raise BackendUnavailable(f'{ngrok_url} failed {breaker.failures} times in a row; not sending requests for now.')
+
+        try:
+            _request_image(ngrok_url, payload, img_path, timeout, give_up_at, hedge_after if hedge else None)
+        except Exception as e:
+            if not is_transient(e):
+                # An error status means the backend answered and the request itself is at fault;
+                # anything else (like a malformed image) is the backend's. Either way, no retry
+                (breaker.record_success if isinstance(e, requests.HTTPError) else breaker.record_failure)()
+                raise
+            breaker.record_failure()
+
+            # Back off before retrying, unless that would run past the deadline
+            backoff = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+            time_left = _time_left(give_up_at)
+            if attempt == retries or (time_left is not None and time_left <= backoff):
+                raise
+            print(f'Generating an image failed, retrying in {backoff:.1f} seconds: {e}')
+            if cancel is None:
+                time.sleep(backoff)
+            elif cancel.wait(backoff):
+                raise
+            continue
+
+        breaker.record_success()
+        break
+
+    if cache:
+        ic.put_cached_image(key, img_path)
+
+def _request_image(ngrok_url, payload, img_path, timeout, give_up_at, hedge_after):
+    # One attempt at an image: a request, plus a duplicate if it is still running after hedge_after seconds.
+    # Each request writes to its own file; the first to finish moves it to img_path, and the other is abandoned.
+    img_path = Path(img_path)
+    results = queue.Queue()
+    finished = threading.Event()
+    finish_lock = threading.Lock()
+
+    def send(n):
+        part_path = img_path.with_name(f'.{img_path.name}.{n}.hedge')
+        start = time.monotonic()
+        try:
+            # Timed until the response headers arrive
+            with mt.span('generate_request'):
+                response = get_session(ngrok_url).post(ngrok_url + '/generate', json=payload,
+                                                       timeout=_bounded_timeout(timeout, give_up_at), stream=True)
+
+            # Decode the image from the response into the file as it arrives (timed including the download)
+            with response, mt.span('write_image'):
+                response.raise_for_status()
+                save_image_stream(_until(response.iter_content(CHUNK_SIZE), give_up_at, finished), part_path)
+
+            with finish_lock:
+                if finished.is_set():
+                    part_path.unlink(missing_ok=True)
+                    return
+                os.replace(part_path, img_path)
+                finished.set()
+            record_latency(ngrok_url, time.monotonic() - start)
+            results.put(None)
+        except Exception as e:
+            part_path.unlink(missing_ok=True)
+            results.put(e)
+
+    # The requests run in daemon threads, so an abandoned one doesn't hold up the caller
+    threading.Thread(target=send, args=(0,), name='generate-request', daemon=True).start()
+    sent = 1
+    failed = 0
+    while True:
+        wait_for = _time_left(give_up_at)
+        hedge_in = None if hedge_after is None or sent > 1 else hedge_after
+        if hedge_in is not None:
+            wait_for = hedge_in if wait_for is None else min(wait_for, hedge_in)
+        if wait_for is not None and wait_for <= 0:
+            finished.set()
+            raise requests.Timeout(f'No image from {ngrok_url} before the deadline.')
+
+        try:
+            error = results.get(timeout=wait_for)
+        except queue.Empty:
+            if hedge_in is not None and (give_up_at is None or time.monotonic() < give_up_at):
+                # Slower than usual: send a duplicate, and take whichever answers first
+                threading.Thread(target=send, args=(1,), name='generate-request-hedge', daemon=True).start()
+                sent = 2
+            continue
+
+        if error is None:
+            return
+        failed += 1
+        if failed == sent:
+            raise error
+
+def generate_images_batch(ngrok_url, prompts, guidance_scale, num_inference_steps, img_paths,
+                          timeout=DEFAULT_TIMEOUT, on_image=None, cache=True, cancel=None, deadline=None):
+    """ Generate one image per prompt with a single request to the backend's batch endpoint.
+
+    All prompts are sent in one POST to /generate_batch, so the backend can batch them on the GPU.
+    The backend streams the images back as newline-delimited JSON, one line per image as it is
+    ready: {"index": 0, "image": "b'...'"}, or {"index": 0, "error": "..."} if that image failed.
+
+    Args:
+        ngrok_url (str): The URL of the ngrok server.
+        prompts (list): The prompts to generate images from.
+        guidance_scale (float): The guidance scale to use when generating the images.
+        num_inference_steps (int): The number of inference steps to use when generating the images.
+        img_paths (list): The paths to save the generated images to, one per prompt.
+        timeout (float or tuple): Timeout for the request, as requests' (connect, read) timeout; the read
+            timeout applies to the wait for each streamed image.
+        on_image (callable): Called as on_image(index, img_path) for every image, as soon as it is written.
+        cache (bool): Whether to add the generated images to the image cache.
+        cancel (threading.Event): If set while images are streaming in, the rest are not waited for.
+        deadline (float): Seconds the whole batch may take; None for no limit.
+
+    Returns:
+        list: The indices of the prompts whose images were generated, in the order they arrived.
+
+    Raises:
+        requests.HTTPError: If the backend rejects the request, e.g. with 404 if it has no batch endpoint.
+        requests.Timeout: If the deadline passed; the images written before that were passed to on_image.
+    """
+
+    give_up_at = None if deadline is None else time.monotonic() + deadline
+
+    with mt.span('generate_batch_request'):
+        response = get_session(ngrok_url).post(ngrok_url + '/generate_batch',
+                                               json = {
+                                                   'prompts': prompts,
+                                                   'guidance_scale': guidance_scale,
+                                                   'num_inference_steps': num_inference_steps
+                                                   },
+                                               timeout = _bounded_timeout(timeout, give_up_at),
+                                               stream = True
+        )
+
+    completed = []
+    with response:
+        response.raise_for_status()
+
+        # Write each image as soon as its line arrives
+        for line in _until(response.iter_lines(), give_up_at):
+            if cancel is not None and cancel.is_set():
+                break
+            if not line:
+                continue
+            result = json.loads(line)
+            idx = result.get('index')
+            if not isinstance(idx, int) or not 0 <= idx < len(prompts):
+                continue
+            if 'image' not in result:
+                print(f"Generating image {idx} failed: {result.get('error', 'no image in response')}")
+                continue
+
+            with mt.span('write_image'):
+                save_image(result['image'], img_paths[idx])
+            if cache:
+                ic.put_cached_image(ic.cache_key(prompts[idx], guidance_scale, num_inference_steps, ngrok_url), img_paths[idx])
+            completed.append(idx)
+            if on_image is not None:
+                on_image(idx, img_paths[idx])
+
+    return completed
+
+def generate_images(ngrok_url, prompts, guidance_scale, num_inference_steps, img_paths,
+                    max_workers=4, timeout=DEFAULT_TIMEOUT, deadline=None, on_image=None, batch=True, cache=True,
+                    cancel=None, retries=RETRIES):
+    """ Generate one image per prompt, sending the requests concurrently.
+
+    Images that are in the image cache are served from it first, without contacting the backend.
+    If batch is set, all other prompts are first sent in one request to the backend's batch endpoint
+    (see generate_images_batch). Prompts that the batch did not deliver, or all of them if the
+    backend has no batch endpoint, are sent to the single-prompt endpoint concurrently.
+    Each image is written as soon as its response arrives, so the total time is
+    close to that of the slowest image rather than the sum of all of them.
+
+    Args:
+        ngrok_url (str): The URL of the ngrok server.
+        prompts (list): The prompts to generate images from.
+        guidance_scale (float): The guidance scale to use when generating the images.
+        num_inference_steps (int): The number of inference steps to use when generating the images.
+        img_paths (list): The paths to save the generated images to, one per prompt.
+        max_workers (int): The maximum number of requests in flight at once.
+        timeout (float or tuple): Timeout for each request, as requests' (connect, read) timeout.
+        deadline (float): Seconds to wait for all images; images still pending after that are abandoned.
+        on_image (callable): Called as on_image(index, img_path) for every image, as soon as it is written.
+        batch (bool): Whether to try the batch endpoint first.
+        cache (bool): Whether to use the image cache.
+        cancel (threading.Event): If set, no new requests are started and pending images are abandoned.
+        retries (int): Times each single-prompt request is retried after a transient failure.
+
+    Returns:
+        list: The paths of the images that were generated, in the order they completed.
+    """
+
+    if len(prompts) != len(img_paths):
+        raise ValueError('Expected one image path per prompt.')
+
+    if len(prompts) == 0:
+        return []
+
+    completed = []
+    remaining = []
+
+    # Serve what we can from the cache
+    for idx, (prompt, img_path) in enumerate(zip(prompts, img_paths)):
+        if cache and ic.get_cached_image(ic.cache_key(prompt, guidance_scale, num_inference_steps, ngrok_url), img_path):
+            completed.append(img_path)
+            if on_image is not None:
+                on_image(idx, img_path)
+        else:
+            remaining.append(idx)
+
+    if not remaining:
+        return completed
+
+    # The deadline covers the batch request as well as the single-prompt requests after it
+    give_up_at = None if deadline is None else time.monotonic() + deadline
+
+    # Try the batch endpoint, unless this backend is known not to have one, or is failing
+    breaker = get_breaker(ngrok_url)
+    if batch and len(remaining) > 1 and ngrok_url not in _batch_unsupported and breaker.allow():
+        # Images count as delivered as they are written, so those written before the batch fails are kept
+        delivered = []
+
+        def batch_image(i, path):
+            delivered.append(remaining[i])
+            completed.append(path)
+            if on_image is not None:
+                on_image(remaining[i], path)
+
+        try:
+            generate_images_batch(ngrok_url,
+                                  [prompts[idx] for idx in remaining],
+                                  guidance_scale,
+                                  num_inference_steps,
+                                  [img_paths[idx] for idx in remaining],
+                                  timeout=timeout,
+                                  on_image=batch_image,
+                                  cache=cache,
+                                  cancel=cancel,
+                                  deadline=_time_left(give_up_at))
+            breaker.record_success()
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in BATCH_UNSUPPORTED_STATUS:
+                _batch_unsupported.add(ngrok_url)
+            else:
+                print(f"Batch generation failed, falling back to single prompts: {e}")
+            (breaker.record_failure if is_transient(e) else breaker.record_success)()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Batch generation failed, falling back to single prompts: {e}")
+            breaker.record_failure()
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        delivered = set(delivered)
+        remaining = [idx for idx in remaining if idx not in delivered]
+        if not remaining:
+            return completed
+
+    if cancel is not None and cancel.is_set():
+        return completed
+
+    def generate_one(idx):
+        # An image waiting for a free worker only gets what is left of the overall deadline
+        time_left = REQUEST_DEADLINE if give_up_at is None else min(REQUEST_DEADLINE, give_up_at - time.monotonic())
+        if time_left <= 0:
+            raise requests.Timeout('Deadline passed before the request was sent.')
+        generate_image(ngrok_url, prompts[idx], guidance_scale, num_inference_steps, img_paths[idx], timeout, cache,
+                       deadline=time_left, retries=retries, cancel=cancel)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(remaining)), thread_name_prefix='generate-image')
+    try:
+        futures = {executor.submit(generate_one, idx): idx for idx in remaining}
+
+        # Handle images as they complete, checking the deadline and cancellation in between
+        pending = set(futures)
+        while pending:
+            if cancel is not None and cancel.is_set():
+                break
+            wait_for = CANCEL_POLL_INTERVAL if cancel is not None else None
+            if give_up_at is not None:
+                time_left = give_up_at - time.monotonic()
+                if time_left <= 0:
+                    print(f"Gave up on {len(pending)} image(s) after {deadline} seconds.")
+                    break
+                wait_for = time_left if wait_for is None else min(wait_for, time_left)
+
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Generating image {idx} failed: {e}")
+                    continue
+
+                completed.append(img_paths[idx])
+                if on_image is not None:
+                    on_image(idx, img_paths[idx])
+    finally:
+        # Don't wait for requests that missed the deadline or were cancelled; they finish (or time out) in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return completed
@@ -0,0 +1,126 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# How many generation jobs run at once; the rest wait in the executor's queue
+MAX_RUNNING_JOBS = 2
+
+# How many finished jobs are remembered, so their results can still be polled
+MAX_FINISHED_JOBS = 100
+
+_executor = ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS, thread_name_prefix='generation-job')
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+class Job:
+    """ A generation job running in the background, and its progress. """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'     # queued -> running -> done / cancelled / failed
+        self.total = None          # number of images, once known
+        self.completed = []        # paths of the images written so far
+        self.error = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_total(self, total):
+        """ Record how many images the job will generate. """
+        self.total = total
+
+    def image_done(self, idx, img_path):
+        """ Record a written image; matches generate_image.generate_images' on_image callback. """
+        with self._lock:
+            self.completed.append(img_path)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'cancelled', 'failed')
+
+    def progress(self):
+        """ Get a snapshot of the job's progress.
+
+        Returns:
+            dict: 'status', 'total', 'completed' (image paths) and 'error'.
+        """
+        with self._lock:
+            return {'status': self.status, 'total': self.total, 'completed': list(self.completed), 'error': self.error}
+
+def submit_job(work, *args, **kwargs):
+    """ Run work(job, *args, **kwargs) in the background.
+
+    work should report progress through job.set_total() and job.image_done(), and stop
+    early once job.cancelled is set.
+
+    Args:
+        work (callable): The generation work.
+
+    Returns:
+        str: The job id, for get_job() and cancel_job().
+    """
+
+    job = Job()
+    with _jobs_lock:
+        _jobs[job.id] = job
+    _executor.submit(_run, job, work, args, kwargs)
+    return job.id
+
+def get_job(job_id):
+    """ Get a job by id.
+
+    Args:
+        job_id (str): The id from submit_job().
+
+    Returns:
+        Job: The job, or None if it is unknown (e.g. submitted to another server process).
+    """
+
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def cancel_job(job_id):
+    """ Ask a job to stop. Images already being generated still finish; no new ones are started.
+
+    Args:
+        job_id (str): The id from submit_job().
+
+    Returns:
+        bool: True if the job was still queued or running.
+    """
+
+    job = get_job(job_id)
+    if job is None or job.finished:
+        return False
+    job.cancel_event.set()
+    return True
+
+def _run(job, work, args, kwargs):
+    if job.cancelled:
+        status = 'cancelled'
+    else:
+        job.status = 'running'
+        try:
+            work(job, *args, **kwargs)
+            status = 'cancelled' if job.cancelled else 'done'
+        except Exception as e:
+            print(f"Generation job {job.id} failed: {e}")
+            job.error = str(e)
+            status = 'failed'
+
+    # A finished job always has its finish time, e.g. for another job's _prune() to sort by
+    job.finished_at = time.time()
+    job.status = status
+    _prune()
+
+def _prune():
+    # Forget the oldest finished jobs beyond MAX_FINISHED_JOBS
+    with _jobs_lock:
+        finished = sorted((job for job in _jobs.values() if job.finished), key=lambda job: job.finished_at)
+        for job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del _jobs[job.id]
@@ -1,50 +1,224 @@
-import nltk
-import numpy as np
-from scipy import spatial
+from collections import Counter
 
-def get_most_surprising_words(entries, model, n_images):
+import src.journal_imager.metrics as mt
+import src.journal_imager.tokenize_entries as te
+from src.journal_imager.lazy import lazy_import
+
+# numpy is imported when the first words are scored, not when the app starts
+np = lazy_import('numpy')
+
+# Words whose vectors are gathered at a time when scoring a date range
+RANGE_BLOCK_SIZE = 4096
+
+def leave_one_out_centroids(vectors, centroid='median', trim=0.1):
+    """ For each row of a matrix, compute the centroid of all OTHER rows.
+
+    All centroids are computed at once from the column-sorted matrix, instead of
+    building and reducing a new (n - 1) x d matrix for every row.
+
+    Args:
+        vectors (numpy.ndarray): An (n, d) matrix with one word vector per row, n >= 2.
+        centroid (str): 'median', 'mean' or 'trimmed_mean'.
+        trim (float): Fraction of values cut from each end of every column when centroid is 'trimmed_mean'.
+
+    Returns:
+        numpy.ndarray: An (n, d) matrix whose i-th row is the centroid of all rows except i.
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float64)
+    n, d = vectors.shape
+    if n < 2:
+        raise ValueError('At least two vectors are needed for leave-one-out centroids.')
+
+    if centroid == 'mean':
+        return (vectors.sum(axis=0) - vectors) / (n - 1)
+
+    if centroid not in ('median', 'trimmed_mean'):
+        raise ValueError(f"Unknown centroid '{centroid}', expected 'median', 'mean' or 'trimmed_mean'.")
+
+    # Sort every column, and remember the position (rank) of each value in its sorted column
+    order = np.argsort(vectors, axis=0, kind='stable')
+    sorted_vectors = np.take_along_axis(vectors, order, axis=0)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(n)[:, None], (n, d)), axis=0)
+
+    # Leaving out the value at rank r shifts every later value one position down,
+    # so position k of the remaining n - 1 values is position k + (r <= k) of the full column
+    m = n - 1
+
+    if centroid == 'median':
+        lo, hi = (m - 1) // 2, m // 2
+        lower = np.take_along_axis(sorted_vectors, lo + (ranks <= lo), axis=0)
+        upper = np.take_along_axis(sorted_vectors, hi + (ranks <= hi), axis=0)
+        return (lower + upper) / 2
+
+    # Trimmed mean: average positions [start, stop) of the remaining values, using column prefix sums
+    n_trim = min(int(trim * m), (m - 1) // 2)
+    start, stop = n_trim, m - n_trim
+    prefix = np.zeros((n + 1, d))
+    np.cumsum(sorted_vectors, axis=0, out=prefix[1:])
+
+    sums = np.where(
+        ranks >= stop,
+        prefix[stop] - prefix[start],                      # left-out value is above the kept range
+        np.where(
+            ranks < start,
+            prefix[stop + 1] - prefix[start + 1],          # left-out value is below the kept range
+            prefix[stop + 1] - prefix[start] - vectors     # left-out value is inside the kept range
+        )
+    )
+    return sums / (stop - start)
+
+def cosine_similarities(vectors, others):
+    """ Row-wise cosine similarity between two matrices of the same shape.
+
+    Args:
+        vectors (numpy.ndarray): An (n, d) matrix.
+        others (numpy.ndarray): An (n, d) matrix.
+
+    Returns:
+        numpy.ndarray: The n cosine similarities; 0 where either row is all zeros.
+    """
+
+    dots = np.einsum('ij,ij->i', vectors, others)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(others, axis=1)
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+def least_similar(similarities, n_words):
+    """ Get the positions of the n lowest similarities, lowest first.
+
+    Args:
+        similarities (numpy.ndarray): One similarity per word.
+        n_words (int): How many positions to return.
+
+    Returns:
+        numpy.ndarray: The positions of the n_words lowest similarities (fewer if there are fewer words).
+    """
+
+    n_words = min(n_words, len(similarities))
+    if n_words <= 0:
+        return np.array([], dtype=int)
+    lowest = np.argpartition(similarities, n_words - 1)[:n_words]
+    return lowest[np.argsort(similarities[lowest], kind='stable')]
+
+def weight_by_idf(similarities, words, doc_frequency=None):
+    """ Combine the similarities of words with how rarely they occur in the journal.
+
+    The surprise of a word, 1 - similarity, is multiplied by its inverse document frequency,
+    so words written on most days need to stand out more to be picked. The result is
+    negated surprise, so, like the similarities, lower is more surprising.
+
+    Args:
+        similarities (numpy.ndarray): One cosine similarity per word.
+        words (list): The words.
+        doc_frequency (doc_frequency.DocumentFrequency): Document frequencies of the journal. None leaves the similarities as they are.
+
+    Returns:
+        numpy.ndarray: One score per word, lowest for the most surprising.
+    """
+
+    if doc_frequency is None:
+        return similarities
+    return (similarities - 1) * doc_frequency.idf(words)
+
+def word_vectors(model, words):
+    """ Get the vectors of some words as a float64 matrix.
+
+    Only the requested rows are read from the (memory-mapped, possibly float16 or int8)
+    embedding, and only they are converted; int8 rows are multiplied by their scale.
+
+    Args:
+        model (gensim.models.keyedvectors.KeyedVectors): The embedding, e.g. from load_glove.
+        words (list): Words in the model's vocabulary.
+
+    Returns:
+        numpy.ndarray: An (n, d) matrix, one row per word.
+    """
+
+    indices = [model.key_to_index[word] for word in words]
+    vectors = np.asarray(model.vectors[indices], dtype=np.float64)
+    scales = getattr(model, 'vector_scales', None)
+    if scales is not None:
+        vectors *= scales[indices][:, None]
+    return vectors
+
+def get_most_surprising_words(entries, model, n_images, centroid='median', doc_frequency=None):
     """ Given a list of journal entries, return the n most surprising words.
 
     Args:
         entries (list): A list of strings, each string representing a journal entry.
         model (gensim.models.keyedvectors.Word2VecKeyedVectors): embedding structure that contains keys (i.e., words) and their corresponding GloVe embeddings.
+        n_images (int): The number of images the words are for; three words are returned per image.
+        centroid (str): How the rest of the words are summarized: 'median', 'mean' or 'trimmed_mean'.
+        doc_frequency (doc_frequency.DocumentFrequency): If given, words the journal uses on fewer days count as more surprising.
 
     Returns:
         list: A list of the n most surprising words.
     """
 
-    # Download the required NLTK resources
-    nltk.download('stopwords')
-    nltk.download('punkt')
-
-    # Tokenize the text, while removing punctuation and making everything lowercase
-    words = []
-    tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
-    for entry in entries:
-        words.extend(tokenizer.tokenize(entry.lower()))
-
-    # Filter out:
+    # Tokenize the text (lowercase, punctuation removed) and filter out, in one pass:
     # a) words that are not in the model's vocabulary;
     # b) stopwords
-    # c) repeated words
-    words = [word for word in words if word in model.key_to_index]
-    words = [word for word in words if word not in nltk.corpus.stopwords.words('english')]
-    words = list(set(words))
-
-    # If no words left, return empty list
-    if len(words) == 0:
-        return []
-
-    # For each word, compute the median vector of the REST of the words,
-    # and compute the cosine similarity of the word's vector with the median vector
-    word_similarities = {}
-    for word in words:
-        avg_vector_rest = np.median([model[other_token] for other_token in words if other_token != word], axis=0)
-        word_similarities[word] = 1 - spatial.distance.cosine(model[word], avg_vector_rest)
-
-    # Get the n words with the lowest similarity
-    n_words = n_images * 3 # three words per generated image resulted in the coolest images, generally
-    salient_words = sorted(word_similarities.items(), key=lambda word: word[1])[:n_words]
-
-    # Return the salient words
-    return [word for word, cos_sim in salient_words]
\ No newline at end of file
+    # c) repeated words (keeping the order in which they first appear)
+    with mt.span('tokenize'):
+        words = te.unique_tokens(entries, vocabulary=model.key_to_index)
+
+    # If fewer than two words left, there is nothing to compare against
+    if len(words) < 2:
+        return words
+
+    # Stack the word vectors into one matrix, then for each word compute the centroid of the REST
+    # of the words, and the cosine similarity of the word's vector with that centroid
+    with mt.span('score'):
+        vectors = word_vectors(model, words)
+        similarities = cosine_similarities(vectors, leave_one_out_centroids(vectors, centroid))
+
+        # Get the n words with the lowest similarity
+        n_words = n_images * 3 # three words per generated image resulted in the coolest images, generally
+
+        # Return the salient words
+        return [words[idx] for idx in least_similar(weight_by_idf(similarities, words, doc_frequency), n_words)]
+
+def get_most_surprising_words_range(entries, model, n_images, block_size=RANGE_BLOCK_SIZE, doc_frequency=None):
+    """ Get the n most surprising words of many entries, e.g. all entries of a week or a month.
+
+    The entries are consumed one at a time, and only a count per distinct word is kept, so
+    memory is bounded by the vocabulary, however many entries there are. Each word is
+    scored against the centroid of all OTHER word occurrences in the range (the mean,
+    weighted by how often each word occurs); the word vectors are gathered block by block.
+
+    Args:
+        entries (iterable): Strings, each string representing a journal entry; e.g. a generator over storage.read_range().
+        model (gensim.models.keyedvectors.Word2VecKeyedVectors): embedding structure that contains keys (i.e., words) and their corresponding GloVe embeddings.
+        n_images (int): The number of images the words are for; three words are returned per image.
+        block_size (int): Words whose vectors are in memory at a time.
+        doc_frequency (doc_frequency.DocumentFrequency): If given, words the journal uses on fewer days count as more surprising.
+
+    Returns:
+        list: A list of the n most surprising words.
+    """
+
+    # Count the occurrences of every word (in order of first appearance), without keeping the entries
+    with mt.span('tokenize'):
+        counts = Counter(te.iter_tokens(entries, vocabulary=model.key_to_index))
+    words = list(counts)
+
+    if len(words) < 2:
+        return words
+
+    with mt.span('score'):
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(words))
+
+        # Sum of the vectors of all occurrences
+        total = np.zeros(model.vector_size)
+        for start in range(0, len(words), block_size):
+            total += weights[start:start + block_size] @ word_vectors(model, words[start:start + block_size])
+
+        # Similarity of each word to the sum of the other occurrences (the scale of the centroid doesn't change a cosine)
+        similarities = np.empty(len(words))
+        for start in range(0, len(words), block_size):
+            vectors = word_vectors(model, words[start:start + block_size])
+            rest = total - weights[start:start + block_size, None] * vectors
+            similarities[start:start + block_size] = cosine_similarities(vectors, rest)
+
+        return [words[idx] for idx in least_similar(weight_by_idf(similarities, words, doc_frequency), n_images * 3)]
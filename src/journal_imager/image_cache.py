@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+# Cached images live next to the app, outside the publicly served assets directory
+CACHE_DIR = Path(__file__).parent / 'image_cache'
+
+# Total size the cache may grow to before the least recently used images are evicted
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+_evict_lock = threading.Lock()
+
+def cache_key(prompt, guidance_scale, num_inference_steps, backend_id):
+    """ Compute the cache key for a generated image.
+
+    Args:
+        prompt (str): The prompt the image was generated from.
+        guidance_scale (float): The guidance scale used.
+        num_inference_steps (int): The number of inference steps used.
+        backend_id (str): Identifies the backend (and so the model) that generated the image, e.g. its URL.
+
+    Returns:
+        str: A hex SHA-256 digest of the parameters.
+    """
+
+    params = json.dumps([prompt, float(guidance_scale), int(num_inference_steps), backend_id])
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+def get_cached_image(key, img_path, cache_dir=None):
+    """ Copy a cached image to img_path, if there is one.
+
+    Args:
+        key (str): The cache key, from cache_key().
+        img_path (str): The path to put the image at.
+        cache_dir (str): The cache directory. Defaults to CACHE_DIR.
+
+    Returns:
+        bool: True if the image was in the cache and is now at img_path.
+    """
+
+    cached = Path(cache_dir or CACHE_DIR) / (key + '.png')
+    try:
+        # Mark as recently used, so eviction keeps it
+        os.utime(cached)
+        link_or_copy(cached, img_path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+def put_cached_image(key, img_path, cache_dir=None, max_bytes=None):
+    """ Add a generated image to the cache, evicting old images if the cache is over its size bound.
+
+    Args:
+        key (str): The cache key, from cache_key().
+        img_path (str): The path of the generated image.
+        cache_dir (str): The cache directory. Defaults to CACHE_DIR.
+        max_bytes (int): The size bound of the cache. Defaults to MAX_CACHE_BYTES.
+
+    Returns:
+        None
+    """
+
+    cache_dir = Path(cache_dir or CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Copy under a temporary name first, so a half-written image is never served
+    tmp_path = cache_dir / f'{key}.{threading.get_ident()}.tmp'
+    shutil.copyfile(img_path, tmp_path)
+    tmp_path.replace(cache_dir / (key + '.png'))
+
+    evict(cache_dir, max_bytes)
+
+def evict(cache_dir=None, max_bytes=None):
+    """ Delete the least recently used images until the cache fits in max_bytes.
+
+    Args:
+        cache_dir (str): The cache directory. Defaults to CACHE_DIR.
+        max_bytes (int): The size bound of the cache. Defaults to MAX_CACHE_BYTES.
+
+    Returns:
+        int: The number of images deleted.
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+
+    with _evict_lock:
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.png'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+
+    return deleted
+
+def link_or_copy(source, destination):
+    """ Put a hard link to source at destination, or a copy where links aren't possible.
+
+    A hard link costs no copying, and deleting either name later leaves the other intact.
+    """
+
+    destination = Path(destination)
+    try:
+        destination.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
@@ -0,0 +1,434 @@
+import argparse
+import os
+import re
+import sqlite3
+import threading
+
+from datetime import datetime
+from pathlib import Path
+from natsort import natsorted
+
+import src.journal_imager.metrics as mt
+import src.journal_imager.update_journal as uj
+
+# Day directories are named after their date, e.g. journal_entries/2023-06-01/entries.csv
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+class StaleRowsError(RuntimeError):
+    """ Rows to delete or edit are no longer what their ids were read as, e.g. because the day was changed in another tab. """
+
+class CsvStorage:
+    """ Journal entries as one entries.csv per day, in journal_entries/<date>/.
+
+    Every storage backend has the same methods, so the app can use either one.
+    """
+
+    def __init__(self, entries_path):
+        self.entries_path = Path(entries_path)
+        self.entries_path.mkdir(parents=True, exist_ok=True)
+        self._listing = None    # (modification time of entries_path, names of its day directories)
+
+    def entries_file(self, date):
+        return self.entries_path / date / 'entries.csv'
+
+    def append_entry(self, input_text):
+        """ Append an entry to today's entries; see update_journal.append_entry.
+
+        The returned entry has an 'id': its row number in the day's file, counted under the file's lock.
+        """
+        return uj.append_entry(input_text, self.entries_path)
+
+    def has_entries(self, date):
+        """ Check whether a day has any entries, without reading them. """
+        try:
+            return os.path.getsize(self.entries_file(date)) > len('Time,Entry\n')
+        except FileNotFoundError:
+            return False
+
+    def read_day(self, date, ids=False):
+        """ Read all entries of a day, as dictionaries with 'Time' and 'Entry' keys.
+
+        With ids, every entry also has an 'id': its row number in the file, counting from 1.
+        Row numbers stay valid until rows are deleted (see update_rows).
+        """
+        try:
+            entries = uj.read_entries(self.entries_file(date))
+        except FileNotFoundError:
+            return []
+        if ids:
+            for row_id, entry in enumerate(entries, start=1):
+                entry['id'] = row_id
+        return entries
+
+    def write_day(self, date, entries):
+        """ Replace all entries of a day. """
+        self.entries_file(date).parent.mkdir(exist_ok=True)
+        uj.write_entries(entries, self.entries_file(date))
+
+    def update_rows(self, date, deleted, edited, stored=None):
+        """ Delete and edit entries of a day by id, as returned by read_day(date, ids=True).
+
+        A CSV file can't be changed in place, so the day is rewritten, once, and only if there
+        is anything to change. The day is read and rewritten under the lock appends take, so
+        entries appended meanwhile are kept.
+
+        Row numbers shift when rows are deleted, so ids read before another deletion (e.g. in
+        another tab) may point at other rows by now. Every row to change is first checked
+        against the entry its id was read as; if one doesn't match, nothing is written.
+
+        Args:
+            date (str): The day, 'YYYY-MM-DD'.
+            deleted (list): Ids of the entries to delete.
+            edited (dict): Id -> entry with the new 'Time' and 'Entry'.
+            stored (dict): Id -> entry as read with the ids; defaults to only checking that the rows exist.
+
+        Returns:
+            bool: True if the ids of the remaining entries changed, so the day has to be read again.
+
+        Raises:
+            StaleRowsError: If a row to change is gone, or is no longer the entry its id was read as.
+        """
+        if not deleted and not edited:
+            return False
+        if not self.entries_file(date).exists():
+            raise StaleRowsError(f'{date} has no entries to change.')
+        deleted = set(deleted)
+
+        def apply(entries):
+            for row_id in [*deleted, *edited]:
+                if not 1 <= row_id <= len(entries) or (stored is not None and not same_entry(entries[row_id - 1], stored[row_id])):
+                    raise StaleRowsError(f'Row {row_id} of {date} changed since it was read.')
+            return [{'Time': entry['Time'], 'Entry': entry['Entry'], **edited.get(row_id, {})}
+                    for row_id, entry in enumerate(entries, start=1) if row_id not in deleted]
+
+        uj.rewrite_entries(self.entries_file(date), apply)
+        return bool(deleted)
+
+    def list_dates(self):
+        """ List the dates that have a day directory, newest first. """
+        return natsorted(self._day_names(), reverse=True)
+
+    def dates_version(self):
+        """ Get a value that changes whenever list_dates() may have changed, without listing them.
+
+        The version is the names of the day directories. They are only listed again when the
+        directory's modification time changed, i.e. after something was created or removed in
+        it; other files there (like doc_frequency.npz, rewritten on every save) leave it as it was.
+        """
+        mtime = os.stat(self.entries_path).st_mtime_ns
+        listing = self._listing
+        if listing is None or listing[0] != mtime:
+            listing = self._listing = (mtime, tuple(sorted(self._day_names())))
+        return listing[1]
+
+    def _day_names(self):
+        return [entry.name for entry in os.scandir(self.entries_path) if entry.is_dir() and DATE_PATTERN.match(entry.name)]
+
+    def day_versions(self):
+        """ Get, for every date with entries, a value that changes whenever the day's entries change, without reading them.
+
+        A day's version is the size and modification time of its entries.csv.
+        """
+        versions = {}
+        for date in self.list_dates():
+            try:
+                stat = os.stat(self.entries_file(date))
+            except FileNotFoundError:
+                continue
+            versions[date] = f'{stat.st_size}-{stat.st_mtime_ns}'
+        return versions
+
+    def read_range(self, start, end):
+        """ Read all entries from start to end (inclusive, 'YYYY-MM-DD'), oldest first, with a 'Date' key. """
+        for date in reversed(self.list_dates()):
+            if start <= date <= end:
+                for entry in self.read_day(date):
+                    yield {'Date': date, **entry}
+
+    def search(self, text):
+        """ Find entries containing text (case-insensitive), newest first, with a 'Date' key. """
+        text = text.lower()
+        results = []
+        for date in self.list_dates():
+            results.extend({'Date': date, **entry} for entry in self.read_day(date)
+                           if isinstance(entry['Entry'], str) and text in entry['Entry'].lower())
+        return results
+
+class SqliteStorage:
+    """ Journal entries in one SQLite database, indexed by date, with a full-text index over the entries.
+
+    The database runs in WAL mode, so reads don't block the writer, and every thread
+    gets its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            entry TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_date ON entries (date, id);
+
+        -- Bumped whenever a date gets its first entry or loses its last one, so the list of dates can be cached
+        CREATE TABLE IF NOT EXISTS dates_version (version INTEGER NOT NULL);
+        INSERT INTO dates_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM dates_version);
+        CREATE TRIGGER IF NOT EXISTS dates_version_insert AFTER INSERT ON entries
+            WHEN NOT EXISTS (SELECT 1 FROM entries WHERE date = new.date AND id != new.id) BEGIN
+            UPDATE dates_version SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS dates_version_delete AFTER DELETE ON entries
+            WHEN NOT EXISTS (SELECT 1 FROM entries WHERE date = old.date) BEGIN
+            UPDATE dates_version SET version = version + 1;
+        END;
+
+        -- Bumped whenever an entry of a date is added, changed or removed, so per-day summaries can tell they are out of date
+        CREATE TABLE IF NOT EXISTS day_versions (date TEXT PRIMARY KEY, version INTEGER NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS day_versions_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO day_versions VALUES (new.date, 1) ON CONFLICT (date) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS day_versions_update AFTER UPDATE ON entries BEGIN
+            INSERT INTO day_versions VALUES (old.date, 1) ON CONFLICT (date) DO UPDATE SET version = version + 1;
+            INSERT INTO day_versions VALUES (new.date, 1) ON CONFLICT (date) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS day_versions_delete AFTER DELETE ON entries BEGIN
+            INSERT INTO day_versions VALUES (old.date, 1) ON CONFLICT (date) DO UPDATE SET version = version + 1;
+        END;
+    """
+
+    # Keeps the full-text index in sync with the entries table
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5 (entry, content='entries', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts (rowid, entry) VALUES (new.id, new.entry);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts (entries_fts, rowid, entry) VALUES ('delete', old.id, old.entry);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE ON entries BEGIN
+            INSERT INTO entries_fts (entries_fts, rowid, entry) VALUES ('delete', old.id, old.entry);
+            INSERT INTO entries_fts (rowid, entry) VALUES (new.id, new.entry);
+        END;
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        connection = self.connection()
+        connection.executescript(self.SCHEMA)
+        try:
+            connection.executescript(self.FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE
+            self.has_fts = False
+
+    def connection(self):
+        """ Get this thread's connection to the database. """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def append_entry(self, input_text):
+        """ Append an entry to today's entries; see update_journal.append_entry. """
+
+        if input_text is None or len(input_text) < 1:
+            return None
+
+        input_text = ' '.join(input_text.splitlines())
+        now = datetime.now()
+        entry = {'Time': now.strftime('%H:%M:%S'), 'Entry': input_text}
+        date = now.strftime('%Y-%m-%d')
+
+        connection = self.connection()
+        with mt.span('append_entry'):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Check if input text is the same as the last entry
+                last = connection.execute('SELECT entry FROM entries WHERE date = ? ORDER BY id DESC LIMIT 1', (date,)).fetchone()
+                if last is not None and last[0] == input_text:
+                    connection.execute('ROLLBACK')
+                    return None
+
+                entry['id'] = connection.execute('INSERT INTO entries (date, time, entry) VALUES (?, ?, ?)',
+                                                 (date, entry['Time'], entry['Entry'])).lastrowid
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+        return entry
+
+    def has_entries(self, date):
+        """ Check whether a day has any entries, without reading them. """
+        return self.connection().execute('SELECT EXISTS (SELECT 1 FROM entries WHERE date = ?)', (date,)).fetchone()[0] == 1
+
+    def read_day(self, date, ids=False):
+        """ Read all entries of a day, as dictionaries with 'Time' and 'Entry' keys (and 'id' with ids, the row id). """
+        with mt.span('read_entries'):
+            rows = self.connection().execute('SELECT id, time, entry FROM entries WHERE date = ? ORDER BY id', (date,))
+            if ids:
+                return [{'Time': time, 'Entry': entry, 'id': row_id} for row_id, time, entry in rows]
+            return [{'Time': time, 'Entry': entry} for row_id, time, entry in rows]
+
+    def write_day(self, date, entries):
+        """ Replace all entries of a day. """
+        connection = self.connection()
+        with mt.span('write_entries'):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('DELETE FROM entries WHERE date = ?', (date,))
+                connection.executemany('INSERT INTO entries (date, time, entry) VALUES (?, ?, ?)',
+                                       [(date, uj.to_text(entry.get('Time')), uj.to_text(entry.get('Entry'))) for entry in entries])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def update_rows(self, date, deleted, edited, stored=None):
+        """ Delete and edit entries of a day by id; only those rows are touched. See CsvStorage.update_rows.
+
+        Row ids never change, so stored is not needed; an edit of a row that was deleted meanwhile raises StaleRowsError.
+        """
+        if not deleted and not edited:
+            return False
+
+        connection = self.connection()
+        with mt.span('write_entries'):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany('DELETE FROM entries WHERE id = ? AND date = ?', [(row_id, date) for row_id in deleted])
+                for row_id, entry in edited.items():
+                    if connection.execute('UPDATE entries SET time = ?, entry = ? WHERE id = ? AND date = ?',
+                                          (uj.to_text(entry.get('Time')), uj.to_text(entry.get('Entry')), row_id, date)).rowcount == 0:
+                        raise StaleRowsError(f'Row {row_id} of {date} was deleted since it was read.')
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return False
+
+    def list_dates(self):
+        """ List the dates that have entries, newest first. """
+        return [date for date, in self.connection().execute('SELECT DISTINCT date FROM entries ORDER BY date DESC')]
+
+    def dates_version(self):
+        """ Get a value that changes whenever list_dates() may have changed, without listing them. """
+        return self.connection().execute('SELECT version FROM dates_version').fetchone()[0]
+
+    def day_versions(self):
+        """ Get, for every date with entries, a value that changes whenever the day's entries change. See CsvStorage.day_versions. """
+        rows = self.connection().execute('SELECT e.date, COALESCE(v.version, 0) FROM (SELECT DISTINCT date FROM entries) e '
+                                         'LEFT JOIN day_versions v ON v.date = e.date')
+        return {date: str(version) for date, version in rows}
+
+    def read_range(self, start, end):
+        """ Read all entries from start to end (inclusive, 'YYYY-MM-DD'), oldest first, with a 'Date' key. """
+        rows = self.connection().execute('SELECT date, time, entry FROM entries WHERE date BETWEEN ? AND ? ORDER BY date, id',
+                                         (start, end))
+        for date, time, entry in rows:
+            yield {'Date': date, 'Time': time, 'Entry': entry}
+
+    def search(self, text):
+        """ Find entries containing text, newest first, with a 'Date' key. """
+        if self.has_fts:
+            # Quote every word, so the user's text is not parsed as an FTS query
+            query = ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+            if not query:
+                return []
+            rows = self.connection().execute(
+                'SELECT e.date, e.time, e.entry FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid '
+                'WHERE entries_fts MATCH ? ORDER BY e.date DESC, e.id', (query,))
+        else:
+            rows = self.connection().execute('SELECT date, time, entry FROM entries WHERE entry LIKE ? ORDER BY date DESC, id',
+                                             ('%' + text + '%',))
+        return [{'Date': date, 'Time': time, 'Entry': entry} for date, time, entry in rows]
+
+def same_entry(entry, other):
+    """ Check whether two entries have the same time and text, whether read from storage or sent back by the table. """
+    return all(uj.to_text(entry.get(key)) == uj.to_text(other.get(key)) for key in ('Time', 'Entry'))
+
+def diff_rows(stored, rows):
+    """ Compare the rows of a table against the stored entries of a day, by id.
+
+    Rows without a (known) id, such as a placeholder, are ignored; rows can't be added through the table.
+
+    Parameters:
+        stored (dict): Id -> stored entry, with 'Time' and 'Entry' keys.
+        rows (list): The table's rows, as dictionaries with 'id', 'Time' and 'Entry' keys.
+
+    Returns:
+        tuple: The ids of the deleted entries (list), and the edited entries (dict of id -> entry with 'Time' and 'Entry').
+    """
+
+    current = {row['id']: row for row in rows if row.get('id') in stored}
+    deleted = [row_id for row_id in stored if row_id not in current]
+    edited = {}
+    for row_id, row in current.items():
+        entry = {'Time': row.get('Time'), 'Entry': row.get('Entry')}
+        if entry != {'Time': stored[row_id].get('Time'), 'Entry': stored[row_id].get('Entry')}:
+            edited[row_id] = entry
+    return deleted, edited
+
+def get_storage(entries_path, backend=None):
+    """ Get the storage backend for the journal.
+
+    Parameters:
+        entries_path (str): Path to journal entries directory.
+        backend (str): 'csv' or 'sqlite'. Defaults to the JOURNAL_IMAGER_STORAGE environment variable, or 'csv'.
+
+    Returns:
+        CsvStorage or SqliteStorage: The storage backend. The SQLite database is entries_path/journal.db.
+    """
+
+    backend = backend or os.environ.get('JOURNAL_IMAGER_STORAGE', 'csv')
+    if backend == 'csv':
+        return CsvStorage(entries_path)
+    if backend == 'sqlite':
+        return SqliteStorage(Path(entries_path) / 'journal.db')
+    raise ValueError(f"Unknown storage backend '{backend}', expected 'csv' or 'sqlite'.")
+
+def migrate_csv_to_sqlite(entries_path, db_path=None):
+    """ Copy all journal entries from the CSV tree into a SQLite database.
+
+    Days already in the database are skipped, so the migration can be re-run safely.
+
+    Parameters:
+        entries_path (str): Path to journal entries directory.
+        db_path (str): Path to the database. Defaults to entries_path/journal.db.
+
+    Returns:
+        int: The number of entries copied.
+    """
+
+    csv_storage = CsvStorage(entries_path)
+    sqlite_storage = SqliteStorage(db_path or Path(entries_path) / 'journal.db')
+    migrated_dates = set(sqlite_storage.list_dates())
+
+    n_entries = 0
+    for date in reversed(csv_storage.list_dates()):
+        if date in migrated_dates:
+            continue
+        entries = csv_storage.read_day(date)
+        sqlite_storage.write_day(date, entries)
+        n_entries += len(entries)
+
+    return n_entries
+
+
+if __name__ == '__main__':
+    # Migrate the CSV tree: python -m src.journal_imager.journal_storage migrate
+    parser = argparse.ArgumentParser(description='Manage journal entry storage.')
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('--entries-path', default=Path(__file__).parent / 'journal_entries')
+    parser.add_argument('--db-path', default=None)
+    args = parser.parse_args()
+
+    n_entries = migrate_csv_to_sqlite(args.entries_path, args.db_path)
+    print(f'Migrated {n_entries} entries. Run the app with JOURNAL_IMAGER_STORAGE=sqlite to use them.')
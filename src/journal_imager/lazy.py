@@ -0,0 +1,38 @@
+import importlib
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+    """ Stands in for a module, and only imports it when one of its attributes is first used.
+
+    Lets heavy dependencies (gensim, pandas, numpy, PIL) stay out of the app's startup:
+    `np = lazy_import('numpy')` at the top of a module reads like a normal import, but
+    numpy is imported by the first `np.something` instead.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        state = 'imported' if self.__dict__['_module'] is not None else 'not imported yet'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+def lazy_import(name):
+    """ Import a module lazily.
+
+    Args:
+        name (str): The module's full name, e.g. 'gensim.models'.
+
+    Returns:
+        module: The module itself if it is already imported, otherwise a LazyModule for it.
+    """
+
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
@@ -1,58 +1,233 @@
+import argparse
+import os
 import requests
+import shutil
+import tempfile
 import zipfile
-import io
-from gensim.scripts.glove2word2vec import glove2word2vec
-from gensim.models import KeyedVectors
 from pathlib import Path
 
+import src.journal_imager.metrics as mt
+from src.journal_imager.lazy import lazy_import
+
+# numpy and gensim are only imported once the embeddings are loaded, not when the app starts
+np = lazy_import('numpy')
+gensim_models = lazy_import('gensim.models')
+
 # Provide the path to the downloaded and extracted GloVe embeddings
 # %cd src/journal_imager/glove.6B/
 # glove_path = Path.cwd()
 # glove_path = base_path / "glove.6B"
 
-def load_glove():
+# Storage types for the compiled vectors; int8 stores one float32 scale per row next to the codes
+DTYPES = ('float32', 'float16', 'int8')
+
+# Defaults for load_glove(), e.g. JOURNAL_IMAGER_GLOVE_DIM=300 JOURNAL_IMAGER_GLOVE_DTYPE=int8 JOURNAL_IMAGER_GLOVE_WORDS=100000
+DEFAULT_DIM = int(os.environ.get('JOURNAL_IMAGER_GLOVE_DIM', '50'))
+DEFAULT_DTYPE = os.environ.get('JOURNAL_IMAGER_GLOVE_DTYPE', 'float32')
+DEFAULT_MAX_WORDS = int(os.environ['JOURNAL_IMAGER_GLOVE_WORDS']) if os.environ.get('JOURNAL_IMAGER_GLOVE_WORDS') else None
+
+def store_paths(glove_txt_file, output_dir=None, dtype='float32', max_words=None):
+    """ Get the paths of the compiled store for a GloVe .txt file.
+
+    Every variant gets its own files, e.g. glove.6B.300d.top100000.int8.npy; the plain float32
+    store keeps the original names (glove.6B.50d.npy).
+
+    Parameters:
+        glove_txt_file (str): Path to the GloVe .txt file.
+        output_dir (str): Directory of the store. Defaults to the directory of glove_txt_file.
+        dtype (str): One of DTYPES.
+        max_words (int): Vocabulary cut, or None for all words.
+
+    Returns:
+        tuple: Paths to the .npy and .vocab files.
+    """
+
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype '{dtype}', expected one of {', '.join(DTYPES)}.")
+
+    glove_txt_file = Path(glove_txt_file)
+    output_dir = Path(output_dir) if output_dir is not None else glove_txt_file.parent
+    name = glove_txt_file.stem
+    if max_words is not None:
+        name += f'.top{max_words}'
+    if dtype != 'float32':
+        name += f'.{dtype}'
+    return output_dir / (name + '.npy'), output_dir / (name + '.vocab')
+
+def scales_path(vectors_file):
+    """ Get the path of the per-row scales that go with an int8 .npy file. """
+    vectors_file = Path(vectors_file)
+    return vectors_file.with_name(vectors_file.stem + '.scales.npy')
+
+def compile_glove(glove_txt_file, output_dir=None, dtype='float32', max_words=None):
+    """ Compile a GloVe .txt file into a binary store that can be memory-mapped.
+
+    The vectors are written as one contiguous matrix (.npy) and the words as a
+    newline-separated vocabulary file (.vocab), in the same row order. The matrix can be
+    stored as float32, float16 (half the size) or int8 (a quarter, plus one float32 scale
+    per row: row = codes * scale). Rows are converted one at a time straight into the
+    output file, so compiling even the 300d vectors takes little memory.
+    This only has to happen once; afterwards load_glove() opens the store directly.
+
+    Parameters:
+        glove_txt_file (str): Path to the GloVe .txt file (e.g., glove.6B.50d.txt).
+        output_dir (str): Directory to write the store to. Defaults to the directory of glove_txt_file.
+        dtype (str): 'float32', 'float16' or 'int8'.
+        max_words (int): Only keep the first max_words words; GloVe files list the most frequent words first.
+
+    Returns:
+        tuple: Paths to the written .npy and .vocab files.
+    """
+
+    glove_txt_file = Path(glove_txt_file)
+    vectors_file, vocab_file = store_paths(glove_txt_file, output_dir, dtype, max_words)
+
+    # First pass: the number of rows and the vector size, to size the output
+    n_words, dim = 0, None
+    with open(glove_txt_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if max_words is not None and n_words == max_words:
+                break
+            word, _, values = line.rstrip('\n').partition(' ')
+            if values:
+                n_words += 1
+                dim = dim or len(values.split(' '))
+
+    if not n_words:
+        raise ValueError(f'No vectors in {glove_txt_file}.')
+
+    # Write to temporary names first, so a half-written store is never picked up
+    tmp_vectors_file = vectors_file.with_name(vectors_file.name + '.tmp')
+    tmp_vocab_file = vocab_file.with_name(vocab_file.name + '.tmp')
+    tmp_scales_file = scales_path(vectors_file).with_name(scales_path(vectors_file).name + '.tmp')
+
+    # Second pass: parse the text file: first token is the word, the rest are the vector components
+    vectors = np.lib.format.open_memmap(tmp_vectors_file, mode='w+', dtype=dtype, shape=(n_words, dim))
+    scales = np.ones(n_words, dtype=np.float32) if dtype == 'int8' else None
+    words = []
+    with open(glove_txt_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if len(words) == n_words:
+                break
+            word, _, values = line.rstrip('\n').partition(' ')
+            if not values:
+                continue
+            row = np.array(values.split(' '), dtype=np.float32)
+            if scales is not None:
+                # Symmetric quantization: the largest component maps to +-127
+                scale = np.abs(row).max() / 127
+                if scale > 0:
+                    scales[len(words)] = scale
+                row = np.rint(row / scales[len(words)])
+            vectors[len(words)] = row
+            words.append(word)
+
+    vectors.flush()
+    del vectors
+    tmp_vocab_file.write_text('\n'.join(words), encoding='utf-8')
+    if scales is not None:
+        with open(tmp_scales_file, 'wb') as f:
+            np.save(f, scales)
+        tmp_scales_file.replace(scales_path(vectors_file))
+    tmp_vocab_file.replace(vocab_file)
+    tmp_vectors_file.replace(vectors_file)
+
+    return vectors_file, vocab_file
+
+def open_glove(vectors_file, vocab_file):
+    """ Open a compiled GloVe store as memory-mapped KeyedVectors.
+
+    The vectors are not read into memory: pages are loaded on demand and shared
+    between all processes that open the same store. An int8 store's per-row scales are
+    attached as model.vector_scales (None otherwise); use get_salient_words.word_vectors()
+    to get the actual vectors. model.vectors_file is where the store is, for indexes kept beside it.
+
+    Parameters:
+        vectors_file (str): Path to the .npy file written by compile_glove().
+        vocab_file (str): Path to the .vocab file written by compile_glove().
+
+    Returns:
+        gensim.models.keyedvectors.KeyedVectors: embedding structure backed by a read-only memory map.
+    """
+
+    vectors = np.load(vectors_file, mmap_mode='r')
+    words = Path(vocab_file).read_text(encoding='utf-8').split('\n')
+
+    if len(words) != vectors.shape[0]:
+        raise ValueError(f'Vocabulary ({len(words)} words) does not match vectors ({vectors.shape[0]} rows).')
+
+    # Assign the memory map directly, rather than going through add_vectors(), which would copy it
+    model = gensim_models.KeyedVectors(vectors.shape[1], count=0, dtype=vectors.dtype)
+    model.vectors = vectors
+    model.index_to_key = words
+    model.key_to_index = {word: idx for idx, word in enumerate(words)}
+    model.vector_scales = np.load(scales_path(vectors_file)) if vectors.dtype == np.int8 else None
+    model.vectors_file = Path(vectors_file)
+
+    return model
+
+def load_glove(glove_path=None, dim=None, dtype=None, max_words=None):
     """ Load GloVe embeddings.
-    
+
     Parameters:
-        None
+        glove_path (str): Directory holding the GloVe embeddings. Defaults to assets/glove.6B.
+        dim (int): Vector size: 50, 100, 200 or 300. Defaults to JOURNAL_IMAGER_GLOVE_DIM, or 50.
+        dtype (str): 'float32', 'float16' or 'int8'. Defaults to JOURNAL_IMAGER_GLOVE_DTYPE, or 'float32'.
+        max_words (int): Only keep the most frequent max_words words. Defaults to JOURNAL_IMAGER_GLOVE_WORDS, or all.
 
     Returns:
         gensim.models.keyedvectors.Word2VecKeyedVectors: embedding structure that contains keys (i.e., words) and their corresponding GloVe embeddings.
     """
 
+    dim = dim or DEFAULT_DIM
+    dtype = dtype or DEFAULT_DTYPE
+    max_words = max_words or DEFAULT_MAX_WORDS
+
     # Get path to GloVe embeddings
-    glove_path = Path(__file__).parent / "assets/glove.6B"
+    glove_path = Path(glove_path) if glove_path is not None else Path(__file__).parent / "assets/glove.6B"
+    glove_txt_file = glove_path / f"glove.6B.{dim}d.txt"
+    vectors_file, vocab_file = store_paths(glove_txt_file, glove_path, dtype, max_words)
+
+    # Check if GloVe embeddings are already compiled, and if so, skip the download
+    if vectors_file.exists() and vocab_file.exists():
+        with mt.span('load_glove'):
+            return open_glove(vectors_file, vocab_file)
 
     # Check if GloVe embeddings are already downloaded
-    if not glove_path.exists():
+    if not glove_txt_file.exists():
         print('GloVe embeddings not found. Downloading...')
-        
+
         # Provide the url to the GloVe embeddings
         url = 'http://nlp.stanford.edu/data/glove.6B.zip'
 
-        # Download and extract the embeddings
-        response = requests.get(url)
-
-        # Create GloVe directory and extract the embeddings
-        glove_path.mkdir()
-        z = zipfile.ZipFile(io.BytesIO(response.content))
-        z.extractall(glove_path)
-
-        # Delete all files in the GloVe directory except 50d
-        for file in glove_path.iterdir():
-            if file.name != 'glove.6B.50d.txt':
-                file.unlink()
+        # Download the embeddings to a temporary file (the archive is large), and extract only the requested size
+        with mt.span('download_glove'):
+            glove_path.mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryFile(dir=glove_path) as archive:
+                with requests.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    shutil.copyfileobj(response.raw, archive)
+                with zipfile.ZipFile(archive) as z:
+                    z.extract(glove_txt_file.name, glove_path)
 
     else:
         print('GloVe embeddings found.')
 
-    # Check if GloVe embeddings are already converted to Word2Vec format
-    word2vec_output_file = glove_path / (glove_path.name + '.word2vec')
-    if not word2vec_output_file.exists():
-        # Convert GloVe .txt file to Word2Vec file format
-        print('Converting GloVe embeddings to Word2Vec format...')      
-        glove2word2vec(glove_path / "glove.6B.50d.txt", word2vec_output_file)
-    else:
-        print('GloVe embeddings already in Word2Vec format.')
+    # Compile the GloVe .txt file into the binary store (one-time step)
+    print('Compiling GloVe embeddings to binary format...')
+    with mt.span('compile_glove'):
+        compile_glove(glove_txt_file, glove_path, dtype, max_words)
+
+    with mt.span('load_glove'):
+        return open_glove(vectors_file, vocab_file)
+
+
+if __name__ == '__main__':
+    # One-time compile step, e.g. during deployment: python -m src.journal_imager.load_glove --dim 300 --dtype int8
+    parser = argparse.ArgumentParser(description='Download and compile GloVe embeddings.')
+    parser.add_argument('--dim', type=int, choices=[50, 100, 200, 300], default=DEFAULT_DIM)
+    parser.add_argument('--dtype', choices=DTYPES, default=DEFAULT_DTYPE)
+    parser.add_argument('--max-words', type=int, default=DEFAULT_MAX_WORDS, help='keep only the most frequent words')
+    args = parser.parse_args()
 
-    return KeyedVectors.load_word2vec_format(word2vec_output_file, binary=False)
\ No newline at end of file
+    load_glove(dim=args.dim, dtype=args.dtype, max_words=args.max_words)
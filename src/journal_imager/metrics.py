@@ -0,0 +1,182 @@
+import bisect
+import contextlib
+import cProfile
+import functools
+import os
+import threading
+import time
+from pathlib import Path
+
+# Timing is off unless JOURNAL_IMAGER_METRICS=1; a disabled span costs one function call
+_enabled = os.environ.get('JOURNAL_IMAGER_METRICS', '0') == '1'
+
+# Directory to write one cProfile dump per HTTP request to (JOURNAL_IMAGER_PROFILE_DIR); off when unset
+PROFILE_DIR = os.environ.get('JOURNAL_IMAGER_PROFILE_DIR') or None
+
+# Upper bounds of the histogram buckets, in seconds; the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_NO_SPAN = contextlib.nullcontext()
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+class Histogram:
+    """ Counts of observed durations per bucket, with their sum, like a Prometheus histogram. """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """ Record one duration. """
+        idx = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        """ Get the cumulative bucket counts (ending with +Inf), the sum and the count. """
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.perf_counter() - self.start)
+
+def enable(enabled=True):
+    """ Turn timing on or off at runtime (it starts as JOURNAL_IMAGER_METRICS says). """
+    global _enabled
+    _enabled = enabled
+
+def is_enabled():
+    """ Check whether spans are being timed. """
+    return _enabled
+
+def span(name):
+    """ Time a stage of the pipeline.
+
+    Use as `with metrics.span('tokenize'): ...`. The duration is added to the stage's
+    histogram; when timing is disabled, nothing is measured or recorded.
+
+    Args:
+        name (str): The stage, e.g. 'load_glove' or 'generate_request'.
+
+    Returns:
+        A context manager.
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+def timed(name):
+    """ Decorator that times every call of a function as a span. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def observe(name, seconds):
+    """ Add a duration to a stage's histogram, creating the histogram on first use. """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    histogram.observe(seconds)
+
+def get_histogram(name):
+    """ Get a stage's histogram, or None if the stage was never timed. """
+    return _histograms.get(name)
+
+def reset():
+    """ Forget all recorded durations. """
+    with _histograms_lock:
+        _histograms.clear()
+
+def render():
+    """ Render all histograms in the Prometheus text exposition format.
+
+    Returns:
+        str: One journal_imager_stage_seconds histogram, with a 'stage' label per stage.
+    """
+
+    lines = ['# HELP journal_imager_stage_seconds Time spent in each stage of the journal-to-image pipeline.',
+             '# TYPE journal_imager_stage_seconds histogram']
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+
+    for name, histogram in histograms:
+        cumulative, total, count = histogram.snapshot()
+        stage = name.replace('\\', '\\\\').replace('"', '\\"')
+        for bound, bucket_count in zip([*map(repr, BUCKETS), '+Inf'], cumulative):
+            lines.append(f'journal_imager_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+        lines.append(f'journal_imager_stage_seconds_sum{{stage="{stage}"}} {total!r}')
+        lines.append(f'journal_imager_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+def install(server, profile_dir=PROFILE_DIR):
+    """ Add the /metrics route to a Flask server, and time (and optionally profile) every request.
+
+    Args:
+        server (flask.Flask): The server, e.g. a Dash app's app.server.
+        profile_dir (str): If given, each request's cProfile stats are dumped there, named after
+            the time and path of the request (open them with pstats or snakeviz).
+
+    Returns:
+        None
+    """
+
+    import flask
+
+    @server.route('/metrics')
+    def metrics_route():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.before_request
+    def start_request():
+        flask.g.metrics_start = time.perf_counter()
+        if profile_dir is not None and flask.request.path != '/metrics':
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                return  # another profiler is active in this thread
+            flask.g.metrics_profiler = profiler
+
+    @server.after_request
+    def finish_request(response):
+        profiler = flask.g.pop('metrics_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _dump_profile(profiler, profile_dir, flask.request.path)
+        start = flask.g.pop('metrics_start', None)
+        if _enabled and start is not None and flask.request.path != '/metrics':
+            observe('http_request', time.perf_counter() - start)
+        return response
+
+def _dump_profile(profiler, profile_dir, request_path):
+    # e.g. 20230601-120000.123456__dash-update-component-140234.prof (time, path, thread)
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    name = time.strftime('%Y%m%d-%H%M%S') + f'.{time.time_ns() // 1000 % 1000000:06d}_' + request_path.replace('/', '_')
+    profiler.dump_stats(profile_dir / f'{name}-{threading.get_ident()}.prof')
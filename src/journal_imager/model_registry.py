@@ -0,0 +1,129 @@
+import threading
+
+import src.journal_imager.load_glove as lg
+
+# The embedding is loaded at most once per process and shared by all callbacks
+_model = None
+_load_error = None
+_load_lock = threading.Lock()
+_preload_thread = None
+
+def get_model():
+    """ Get the process-wide embedding model, loading it on first use.
+
+    Concurrent callers wait for the same load instead of each loading their own copy.
+
+    Parameters:
+        None
+
+    Returns:
+        gensim.models.keyedvectors.KeyedVectors: embedding structure that contains keys (i.e., words) and their corresponding GloVe embeddings.
+    """
+
+    global _model, _load_error
+
+    # Fast path: model already loaded, no locking needed
+    if _model is not None:
+        return _model
+
+    with _load_lock:
+        if _model is None:
+            print("Loading model...")
+            try:
+                _model = lg.load_glove()
+                _load_error = None
+            except Exception as e:
+                _load_error = e
+                raise
+
+    return _model
+
+def preload_model():
+    """ Start loading the embedding model in a background thread.
+
+    Calling this more than once does not start a second load.
+
+    Parameters:
+        None
+
+    Returns:
+        threading.Thread: The thread loading the model.
+    """
+
+    global _preload_thread
+
+    with _load_lock:
+        if _preload_thread is None or (not _preload_thread.is_alive() and _model is None):
+            _preload_thread = threading.Thread(target=_preload, name='model-preload', daemon=True)
+            _preload_thread.start()
+
+    return _preload_thread
+
+def _preload():
+    # Errors are kept in _load_error and reported through model_status()
+    try:
+        get_model()
+    except Exception:
+        pass
+
+def is_model_ready():
+    """ Check whether the embedding model is loaded.
+
+    Parameters:
+        None
+
+    Returns:
+        bool: True if get_model() will return without loading.
+    """
+
+    return _model is not None
+
+def model_status():
+    """ Describe the state of the embedding model, for display in the UI.
+
+    Parameters:
+        None
+
+    Returns:
+        str: One of 'ready', 'loading', 'not loaded' or 'failed: <error>'.
+    """
+
+    if _model is not None:
+        return 'ready'
+    if _load_lock.locked():
+        return 'loading'
+    if _load_error is not None:
+        return f'failed: {_load_error}'
+    return 'not loaded'
+
+def set_model(model):
+    """ Use the given embedding model instead of loading GloVe, e.g. a small synthetic one for load tests.
+
+    Parameters:
+        model (gensim.models.keyedvectors.KeyedVectors): The embedding model.
+
+    Returns:
+        None
+    """
+
+    global _model, _load_error
+
+    with _load_lock:
+        _model = model
+        _load_error = None
+
+def unload_model():
+    """ Drop the loaded embedding model, so the next get_model() loads it again.
+
+    Parameters:
+        None
+
+    Returns:
+        None
+    """
+
+    global _model, _load_error
+
+    with _load_lock:
+        _model = None
+        _load_error = None
@@ -0,0 +1,359 @@
+import argparse
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import src.journal_imager.metrics as mt
+import src.journal_imager.tokenize_entries as te
+from src.journal_imager.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, concurrent builders each build (into their own temporary files)
+    fcntl = None
+
+# Rows of the vocabulary scored per matrix product in exact search, and normalized per step when building
+BLOCK_SIZE = 65536
+
+def index_dir(vectors_file):
+    """ Get the directory a persisted index for a compiled GloVe store lives in, e.g. glove.6B.50d.neighbours/. """
+    vectors_file = Path(vectors_file)
+    return vectors_file.with_name(vectors_file.stem + '.neighbours')
+
+def unit_vectors(model, block_size=BLOCK_SIZE):
+    """ Get the model's vectors as an L2-normalized float32 matrix.
+
+    The vectors are read, dequantized and normalized one block at a time, so the
+    (memory-mapped) store is never converted as a whole.
+
+    Args:
+        model (gensim.models.keyedvectors.KeyedVectors): The embedding, e.g. from load_glove.
+        block_size (int): Rows per step.
+
+    Returns:
+        numpy.ndarray: An (n, d) matrix whose rows have length 1 (or 0 for all-zero vectors).
+    """
+
+    n, d = model.vectors.shape
+    out = np.empty((n, d), dtype=np.float32)
+    scales = getattr(model, 'vector_scales', None)
+    for start in range(0, n, block_size):
+        block = np.asarray(model.vectors[start:start + block_size], dtype=np.float32)
+        if scales is not None:
+            block = block * scales[start:start + block_size, None]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        out[start:start + block_size] = np.divide(block, norms, out=np.zeros_like(block), where=norms > 0)
+    return out
+
+def top_k(scores, k):
+    """ Get the positions of the k highest scores in every row, highest first.
+
+    Args:
+        scores (numpy.ndarray): An (m, n) matrix.
+        k (int): How many positions per row.
+
+    Returns:
+        numpy.ndarray: An (m, min(k, n)) matrix of column positions.
+    """
+
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=int)
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+class NearestWords:
+    """ Finds the words closest (by cosine similarity) to sets of words, for prompt expansion.
+
+    Queries are answered from a precomputed L2-normalized copy of the vocabulary, so a
+    cosine similarity is a dot product and all queries are scored with one matrix product
+    per block of rows. Optionally the rows are grouped into an inverted file (IVF): the
+    vocabulary is clustered once, and a query only scores the rows of the n_probe
+    clusters whose centroids are closest to it. The index can be saved next to the
+    compiled GloVe store and memory-mapped on the next start.
+    """
+
+    def __init__(self, model, vectors, centroids=None, offsets=None, order=None, n_probe=16):
+        self.model = model
+        self.vectors = vectors          # (n, d) unit rows; grouped by cluster when there is an IVF
+        self.centroids = centroids      # (n_lists, d) unit cluster centroids, or None for exact search
+        self.offsets = offsets          # rows of cluster c are vectors[offsets[c]:offsets[c + 1]]
+        self.order = order              # row of vectors -> word index in the model
+        self.n_probe = n_probe
+
+        # word index -> row of vectors
+        if order is not None:
+            self.position = np.empty(len(order), dtype=np.int64)
+            self.position[order] = np.arange(len(order))
+        else:
+            self.position = None
+
+        # Words never suggested: stopwords and tokens with anything but letters (numbers, punctuation)
+        keys = model.index_to_key
+        self.suggestable = np.fromiter((key.isalpha() and key not in te.STOPWORDS for key in keys), dtype=bool, count=len(keys))
+
+    @classmethod
+    def build(cls, model, n_lists=None, sample_size=50000, iterations=8, seed=0, n_probe=16):
+        """ Build an index for a model.
+
+        Args:
+            model (gensim.models.keyedvectors.KeyedVectors): The embedding, e.g. from load_glove.
+            n_lists (int): Number of IVF clusters; 0 for exact search only. Defaults to about sqrt(n).
+            sample_size (int): Rows the clusters are trained on.
+            iterations (int): Rounds of (spherical) k-means.
+            seed (int): Random seed for the sample and the initial centroids.
+            n_probe (int): Clusters scored per query.
+
+        Returns:
+            NearestWords: The index.
+        """
+
+        vectors = unit_vectors(model)
+        n = len(vectors)
+        n_lists = int(np.sqrt(n)) if n_lists is None else n_lists
+        if n_lists <= 1 or n <= n_lists:
+            return cls(model, vectors, n_probe=n_probe)
+
+        # Spherical k-means on a sample of the rows
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(sample_size, n), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # A cluster that lost all its rows keeps its old centroid
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+
+        # Assign every row to its closest centroid, and store the rows cluster by cluster
+        labels = np.concatenate([np.argmax(vectors[start:start + BLOCK_SIZE] @ centroids.T, axis=1)
+                                 for start in range(0, n, BLOCK_SIZE)])
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+
+        return cls(model, vectors[order], centroids.astype(np.float32), offsets, order, n_probe)
+
+    def save(self, directory):
+        """ Write the index to a directory, as .npy files that load() memory-maps. """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        arrays = {'vectors': self.vectors}
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, offsets=self.offsets, order=self.order)
+        # Write to temporary names first (per process and thread, so concurrent builders don't write each other's),
+        # so a half-written index is never picked up; vectors.npy goes last
+        for name, array in sorted(arrays.items(), key=lambda item: item[0] == 'vectors'):
+            tmp_file = directory / f'.{name}.npy.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.save(f, array)
+            tmp_file.replace(directory / f'{name}.npy')
+
+    @classmethod
+    def load(cls, model, directory, n_probe=16):
+        """ Open an index written by save() for the same model.
+
+        Returns:
+            NearestWords: The index, or None if there is none (or it was built for another vocabulary).
+        """
+
+        directory = Path(directory)
+        if not (directory / 'vectors.npy').exists():
+            return None
+        vectors = np.load(directory / 'vectors.npy', mmap_mode='r')
+        if vectors.shape != model.vectors.shape:
+            return None
+        if not (directory / 'centroids.npy').exists():
+            return cls(model, vectors, n_probe=n_probe)
+        return cls(model, vectors,
+                   np.load(directory / 'centroids.npy'),
+                   np.load(directory / 'offsets.npy'),
+                   np.load(directory / 'order.npy', mmap_mode='r'),
+                   n_probe)
+
+    def most_similar(self, word_sets, topn=3):
+        """ Get the words closest to the centroid of each set of words.
+
+        Args:
+            word_sets (list): Lists of words in the model's vocabulary, e.g. the salient-word triples.
+            topn (int): Words to return per set.
+
+        Returns:
+            list: For each set, up to topn suggestable words that are not in the set, closest first.
+        """
+
+        if not word_sets:
+            return []
+
+        with mt.span('nearest_words'):
+            # One query per set: the normalized mean of its words' unit vectors
+            word_indices = [[self.model.key_to_index[word] for word in words] for words in word_sets]
+            queries = np.zeros((len(word_sets), self.vectors.shape[1]), dtype=np.float32)
+            for query, indices in zip(queries, word_indices):
+                if indices:
+                    query[:] = self._rows_of(indices).sum(axis=0)
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = np.divide(queries, norms, out=np.zeros_like(queries), where=norms > 0)
+
+            # Ask for extra candidates, to make up for the set's own words and unsuggestable words
+            k = topn + max(map(len, word_indices)) + 16
+            if self.centroids is None:
+                candidates = self._search_exact(queries, k)
+            else:
+                candidates = self._search_ivf(queries, k)
+
+            results = []
+            for indices, row in zip(word_indices, candidates):
+                own = set(indices)
+                words = [self.model.index_to_key[idx] for idx in row if idx not in own and self.suggestable[idx]]
+                results.append(words[:topn])
+            return results
+
+    def _rows_of(self, indices):
+        # Rows of some word indices in self.vectors (which are in cluster order when there is an IVF)
+        rows = indices if self.position is None else self.position[indices]
+        return np.asarray(self.vectors[rows])
+
+    def _search_exact(self, queries, k):
+        # Score every row, block by block, keeping the k best of each block; then the k best overall
+        best_scores, best_indices = [], []
+        for start in range(0, len(self.vectors), BLOCK_SIZE):
+            scores = queries @ np.asarray(self.vectors[start:start + BLOCK_SIZE]).T
+            best = top_k(scores, k)
+            best_scores.append(np.take_along_axis(scores, best, axis=1))
+            best_indices.append(best + start)
+        scores, indices = np.concatenate(best_scores, axis=1), np.concatenate(best_indices, axis=1)
+        return np.take_along_axis(indices, top_k(scores, k), axis=1)
+
+    def _search_ivf(self, queries, k):
+        # Score only the rows of the n_probe clusters closest to each query
+        probes = top_k(queries @ self.centroids.T, self.n_probe)
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in lists])
+            scores = np.asarray(self.vectors[rows]) @ query
+            results.append(np.asarray(self.order[rows[top_k(scores[None, :], k)[0]]]))
+        return results
+
+def expand_triples(nearest, triples, n_extra):
+    """ Add related words to each salient-word triple.
+
+    Args:
+        nearest (NearestWords): The index of the model the words come from.
+        triples (list): Lists of words, e.g. the salient-word triples.
+        n_extra (int): Related words to add to each triple.
+
+    Returns:
+        list: The triples, each followed by up to n_extra words closest to it.
+    """
+
+    if n_extra <= 0:
+        return [list(triple) for triple in triples]
+    return [list(triple) + extra for triple, extra in zip(triples, nearest.most_similar(triples, n_extra))]
+
+# One index per process, opened from disk or built once; the build runs at startup, in the background
+_index = None
+_build_lock = threading.Lock()
+_build_thread = None
+_thread_lock = threading.Lock()
+
+# Taken in the index directory while building, so only one process builds it
+LOCK_NAME = 'build.lock'
+
+@contextmanager
+def _directory_locked(directory):
+    # Hold an exclusive lock on the index directory; other processes wait until the index is saved
+    if directory is None or fcntl is None:
+        yield
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / LOCK_NAME, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def get_index(model, directory=None, build=True):
+    """ Get the process-wide index for a model, opening it from directory or building (and saving) it there.
+
+    Building takes a normalized copy of all vectors plus a k-means pass, so it should not happen
+    while a user waits: the app starts it in the background (build_in_background) once the model
+    is loaded, and asks for the index with build=False.
+
+    Args:
+        model (gensim.models.keyedvectors.KeyedVectors): The embedding, e.g. from load_glove.
+        directory (str): Where the index is persisted. Defaults to next to the model's store, if it has one.
+        build (bool): Whether to build the index if it isn't there yet, waiting for a build in progress.
+
+    Returns:
+        NearestWords: The index, or None if it isn't built yet and build is False.
+    """
+
+    global _index
+
+    index = _index
+    if index is not None and index.model is model:
+        return index
+
+    vectors_file = getattr(model, 'vectors_file', None)
+    if directory is None and vectors_file is not None:
+        directory = index_dir(vectors_file)
+    directory = None if directory is None else Path(directory)
+
+    # Without build, only an index that is already saved is opened; a build in progress is not waited for
+    if not build:
+        index = NearestWords.load(model, directory) if directory is not None else None
+        if index is not None:
+            _index = index
+        return index
+
+    with _build_lock, _directory_locked(directory):
+        index = _index
+        if index is None or index.model is not model:
+            # Another process may have saved the index while this one waited for the lock
+            index = NearestWords.load(model, directory) if directory is not None else None
+            if index is None:
+                with mt.span('build_nearest_words'):
+                    index = NearestWords.build(model)
+                if directory is not None:
+                    index.save(directory)
+            _index = index
+        return index
+
+def build_in_background(model, directory=None):
+    """ Start opening or building the index for a model in a background thread; see get_index.
+
+    Calling this again while the thread runs does not start a second one.
+
+    Returns:
+        threading.Thread: The thread.
+    """
+
+    global _build_thread
+
+    with _thread_lock:
+        if _build_thread is None or not _build_thread.is_alive():
+            _build_thread = threading.Thread(target=get_index, args=(model, directory), name='nearest-words-build', daemon=True)
+            _build_thread.start()
+    return _build_thread
+
+
+if __name__ == '__main__':
+    # Build the index ahead of time, e.g. when deploying: python -m src.journal_imager.nearest_words --dim 300
+    import src.journal_imager.load_glove as lg
+
+    parser = argparse.ArgumentParser(description='Build the nearest-words index of the GloVe store.')
+    parser.add_argument('--glove-path', default=None, help='directory of the GloVe embeddings (default: assets/glove.6B)')
+    parser.add_argument('--dim', type=int, choices=[50, 100, 200, 300], default=None, help='default: JOURNAL_IMAGER_GLOVE_DIM, or 50')
+    parser.add_argument('--dtype', choices=lg.DTYPES, default=None, help='default: JOURNAL_IMAGER_GLOVE_DTYPE, or float32')
+    args = parser.parse_args()
+
+    model = lg.load_glove(glove_path=args.glove_path, dim=args.dim, dtype=args.dtype)
+    get_index(model)
+    print(f'Nearest-words index ready in {index_dir(model.vectors_file)}.')
@@ -0,0 +1,187 @@
+import threading
+
+from collections import Counter, OrderedDict
+
+import src.journal_imager.get_salient_words as gsw
+import src.journal_imager.metrics as mt
+import src.journal_imager.tokenize_entries as te
+from src.journal_imager.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# Days kept in the index at most; the least recently used day is dropped first, and rebuilt by set_day when it is needed again
+MAX_DAYS = 64
+
+class _Day:
+    """ The words of one day: how often each occurs, and their vectors stacked in one matrix. """
+
+    def __init__(self, dim):
+        self.texts = Counter()        # entry text -> number of entries with that text
+        self.counts = Counter()       # word -> number of occurrences
+        self.words = []               # distinct words; row i of vectors belongs to words[i]
+        self.rows = {}                # word -> row
+        self.vectors = np.empty((16, dim))
+        self.similarities = None      # cached scores, None when the word set changed
+
+    def add_word(self, word, vector):
+        if len(self.words) == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.rows[word] = len(self.words)
+        self.vectors[len(self.words)] = vector
+        self.words.append(word)
+
+    def remove_word(self, word):
+        # Move the last word into the freed row, so the matrix stays contiguous
+        row, last = self.rows.pop(word), self.words.pop()
+        if last != word:
+            self.words[row] = last
+            self.rows[last] = row
+            self.vectors[row] = self.vectors[len(self.words)]
+
+class SalienceIndex:
+    """ Keeps the per-day token counts and word vectors that surprise scoring needs.
+
+    Entries are added and removed as they are written, so the day's words never have to be
+    re-tokenized when Generate is pressed. Scores are only recomputed for a day whose set of
+    distinct words changed since they were last asked for.
+
+    Until a model is attached with set_model(), only the entry texts are recorded; the words
+    and vectors are then built on first use.
+
+    At most max_days days are kept, so browsing through the journal doesn't grow the index
+    without bound.
+    """
+
+    def __init__(self, model=None, centroid='median', max_days=MAX_DAYS):
+        self.model = model
+        self.centroid = centroid
+        self.max_days = max_days
+        self._texts = OrderedDict()   # date -> Counter of entry texts, kept while there is no model; least recently used first
+        self._days = OrderedDict()    # date -> _Day; least recently used first
+        self._lock = threading.Lock()
+
+    def set_model(self, model):
+        """ Attach the embedding model, building the days recorded so far. """
+        with self._lock:
+            self.model = model
+            pending = {date: day.texts for date, day in self._days.items()}
+            pending.update(self._texts)
+            self._days, self._texts = OrderedDict(), OrderedDict()
+            for date, texts in pending.items():
+                self._set_texts(date, texts)
+                self._touch(date)
+
+    def has_day(self, date):
+        """ Check whether a day is indexed. """
+        return date in self._days or date in self._texts
+
+    def add_entry(self, date, text):
+        """ Add one entry to a day. """
+        with self._lock, mt.span('index_entry'):
+            self._add(date, text)
+            self._touch(date)
+
+    def remove_entry(self, date, text):
+        """ Remove one entry from a day. """
+        with self._lock:
+            self._remove(date, text)
+
+    def set_day(self, date, entries):
+        """ Bring a day in line with its entries, adding and removing only the entries that differ.
+
+        Args:
+            date (str): The day, 'YYYY-MM-DD'.
+            entries (list): Entry texts, or entry dictionaries with an 'Entry' key.
+        """
+        texts = Counter(entry.get('Entry') if isinstance(entry, dict) else entry for entry in entries)
+        texts = Counter({text: count for text, count in texts.items() if isinstance(text, str)})
+        with self._lock:
+            self._set_texts(date, texts)
+            self._touch(date)
+
+    def most_surprising(self, date, n_images, doc_frequency=None):
+        """ Get the most surprising words of a day, like get_salient_words.get_most_surprising_words.
+
+        Args:
+            date (str): The day, 'YYYY-MM-DD'.
+            n_images (int): The number of images the words are for; three words are returned per image.
+            doc_frequency (doc_frequency.DocumentFrequency): If given, words the journal uses on fewer days count as more surprising.
+
+        Returns:
+            list: The most surprising words, most surprising first.
+        """
+        if self.model is None:
+            raise RuntimeError('No model attached to the salience index.')
+
+        with self._lock:
+            day = self._days.get(date)
+            self._touch(date)
+            if day is None or len(day.words) < 2:
+                return list(day.words) if day is not None else []
+
+            # Rescore only if the day's words changed since the last call
+            if day.similarities is None:
+                with mt.span('score'):
+                    vectors = day.vectors[:len(day.words)]
+                    day.similarities = gsw.cosine_similarities(vectors, gsw.leave_one_out_centroids(vectors, self.centroid))
+
+            # The idf weights change with every day of the journal, so they are applied per call (one gather and multiply)
+            scores = gsw.weight_by_idf(day.similarities, day.words, doc_frequency)
+            return [day.words[idx] for idx in gsw.least_similar(scores, n_images * 3)]
+
+    def _touch(self, date):
+        # Mark a day as just used, and drop the least recently used days beyond max_days
+        for days in (self._days, self._texts):
+            if date in days:
+                days.move_to_end(date)
+            while len(days) > self.max_days:
+                days.popitem(last=False)
+
+    def _set_texts(self, date, texts):
+        current = self._days[date].texts if date in self._days else self._texts.get(date, Counter())
+        for text, count in (current - texts).items():
+            for _ in range(count):
+                self._remove(date, text)
+        for text, count in (texts - current).items():
+            for _ in range(count):
+                self._add(date, text)
+        if not texts:
+            self._days.pop(date, None)
+            self._texts.pop(date, None)
+
+    def _add(self, date, text):
+        if self.model is None:
+            self._texts.setdefault(date, Counter())[text] += 1
+            return
+
+        day = self._days.get(date)
+        if day is None:
+            day = self._days[date] = _Day(self.model.vector_size)
+        day.texts[text] += 1
+
+        for word in te.iter_tokens([text], vocabulary=self.model.key_to_index):
+            if day.counts[word] == 0:
+                day.add_word(word, gsw.word_vectors(self.model, [word])[0])
+                day.similarities = None
+            day.counts[word] += 1
+
+    def _remove(self, date, text):
+        if self.model is None:
+            texts = self._texts.get(date)
+            if texts is not None and texts[text] > 0:
+                texts[text] -= 1
+                texts += Counter()  # drop zero counts
+            return
+
+        day = self._days.get(date)
+        if day is None or day.texts[text] == 0:
+            return
+        day.texts[text] -= 1
+        day.texts += Counter()
+
+        for word in te.iter_tokens([text], vocabulary=self.model.key_to_index):
+            day.counts[word] -= 1
+            if day.counts[word] == 0:
+                del day.counts[word]
+                day.remove_word(word)
+                day.similarities = None
@@ -0,0 +1,192 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def make_png(prompt, size=64):
+    """ Make a small, deterministic PNG for a prompt.
+
+    The same prompt always gives the same image: a two-colour gradient whose colours are derived from the prompt's hash.
+
+    Args:
+        prompt (str): The prompt to make the image for.
+        size (int): Width and height of the image, in pixels.
+
+    Returns:
+        bytes: The PNG file contents.
+    """
+
+    digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+    start, end = digest[:3], digest[3:6]
+
+    # One filter byte (0 = none) followed by RGB pixels, per row
+    rows = []
+    for y in range(size):
+        color = bytes(a + (b - a) * y // max(size - 1, 1) for a, b in zip(start, end))
+        rows.append(b'\x00' + color * size)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(b''.join(rows)))
+            + chunk(b'IEND', b''))
+
+def encode_image(png_bytes):
+    """ Encode an image the way the Colab notebook does: the str() of the base64 bytes, i.e. "b'...'".
+
+    Args:
+        png_bytes (bytes): The PNG file contents.
+
+    Returns:
+        str: The encoded image.
+    """
+
+    return str(base64.b64encode(png_bytes))
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Handles /generate (and /generate_batch) requests like the Colab notebook, without a GPU. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        if self.path == '/generate':
+            self.generate(body)
+        elif self.path == '/generate_batch' and self.server.batch:
+            self.generate_batch(body)
+        else:
+            self.send_error(404)
+
+    def generate(self, body):
+        if 'prompt' not in body:
+            self.send_error(400, 'Missing prompt')
+            return
+
+        time.sleep(self.server.image_delay())
+        self.server.requests_served += 1
+        if self.server.image_fails():
+            self.send_error(500, 'Injected failure')
+            return
+        self.send_json({'image': encode_image(make_png(body['prompt']))})
+
+    def generate_batch(self, body):
+        prompts = body.get('prompts')
+        if not isinstance(prompts, list):
+            self.send_error(400, 'Missing prompts')
+            return
+
+        # Stream one JSON line per image, as each one is "ready"
+        self.server.requests_served += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for idx, prompt in enumerate(prompts):
+            time.sleep(self.server.image_delay())
+            result = {'index': idx, 'error': 'Injected failure'} if self.server.image_fails() else {'index': idx, 'image': encode_image(make_png(prompt))}
+            self.send_chunk(json.dumps(result).encode('utf-8') + b'\n')
+        self.send_chunk(b'')
+
+    def send_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_json(self, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class StubServer(ThreadingHTTPServer):
+    """ The stub server, with its settings; randomness comes from one seeded generator, so runs repeat. """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, batch=True, verbose=False, seed=0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.batch = batch
+        self.verbose = verbose
+        self.requests_served = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients that give up (deadlines, cancels) close the connection mid-response; only report that when verbose
+        if self.verbose:
+            super().handle_error(request, client_address)
+
+    def image_delay(self):
+        """ Seconds to spend on one image: the latency plus up to jitter seconds. """
+        if not self.jitter:
+            return self.latency
+        with self._random_lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def image_fails(self):
+        """ Decide whether to fail one image, with probability error_rate. """
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+def start_stub_server(host='127.0.0.1', port=0, latency=0.0, batch=True, verbose=False, jitter=0.0, error_rate=0.0, seed=0):
+    """ Start a stub /generate server in a background thread.
+
+    Args:
+        host (str): The host to listen on.
+        port (int): The port to listen on; 0 picks a free port.
+        latency (float): Seconds to wait per image, standing in for inference time.
+        batch (bool): Whether to serve /generate_batch; without it the server behaves like an older notebook.
+        verbose (bool): Whether to log every request.
+        jitter (float): Up to this many seconds are added to the latency of each image, uniformly at random.
+        error_rate (float): Fraction of images that fail: with a 500 from /generate, or an error line from /generate_batch.
+        seed (int): Seed for the jitter and failures.
+
+    Returns:
+        tuple: The server (call server.shutdown() to stop it) and its base URL.
+    """
+
+    server = StubServer((host, port), latency=latency, jitter=jitter, error_rate=error_rate, batch=batch, verbose=verbose, seed=seed)
+
+    threading.Thread(target=server.serve_forever, name='stub-server', daemon=True).start()
+
+    return server, f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    # Stand-in for the Colab notebook: python -m src.journal_imager.stub_server --port 5000
+    parser = argparse.ArgumentParser(description='Serve deterministic images on /generate, like the Colab notebook.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait per image')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds per image, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of images that fail')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the jitter and failures')
+    parser.add_argument('--no-batch', action='store_true', help='only serve the single-prompt endpoint')
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args.host, args.port, args.latency, batch=not args.no_batch, verbose=True,
+                                    jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    print(f'Stub server running on {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
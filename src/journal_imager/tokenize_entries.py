@@ -0,0 +1,69 @@
+import re
+
+# NLTK's English stopword list, bundled so tokenization never needs nltk.download()
+STOPWORDS = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself yourselves
+he him his himself she she's her hers herself it it's its itself they them their theirs themselves
+what which who whom this that that'll these those am is are was were be been being have has had
+having do does did doing a an the and but if or because as until while of at by for with about
+against between into through during before after above below to from up down in out on off over
+under again further then once here there when where why how all any both each few more most other
+some such no nor not only own same so than too very s t can will just don don't should should've
+now d ll m o re ve y ain aren aren't couldn couldn't didn didn't doesn doesn't hadn hadn't hasn
+hasn't haven haven't isn isn't ma mightn mightn't mustn mustn't needn needn't shan shan't shouldn
+shouldn't wasn wasn't weren weren't won won't wouldn wouldn't
+""".split())
+
+# Same pattern as nltk.tokenize.RegexpTokenizer(r'\w+'): runs of word characters, punctuation dropped
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    """ Split a piece of text into lowercase word tokens.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        generator: The tokens, in order of appearance.
+    """
+
+    return (match.group(0) for match in TOKEN_PATTERN.finditer(text.lower()))
+
+def iter_tokens(entries, vocabulary=None, stopwords=STOPWORDS):
+    """ Stream the content words of journal entries.
+
+    Tokenizing and filtering happen in one pass: a token is only yielded if it
+    is not a stopword and, if a vocabulary is given, is in the vocabulary.
+
+    Args:
+        entries (iterable): Strings, each string representing a journal entry.
+        vocabulary (container): Words to keep, e.g. model.key_to_index. Defaults to keeping all words.
+        stopwords (container): Words to drop. Defaults to the bundled English stopwords.
+
+    Returns:
+        generator: The remaining tokens, in order of appearance, repeats included.
+    """
+
+    for entry in entries:
+        if not isinstance(entry, str):
+            continue
+        for token in tokenize(entry):
+            if token in stopwords:
+                continue
+            if vocabulary is not None and token not in vocabulary:
+                continue
+            yield token
+
+def unique_tokens(entries, vocabulary=None, stopwords=STOPWORDS):
+    """ Get the distinct content words of journal entries.
+
+    Args:
+        entries (iterable): Strings, each string representing a journal entry.
+        vocabulary (container): Words to keep, e.g. model.key_to_index. Defaults to keeping all words.
+        stopwords (container): Words to drop. Defaults to the bundled English stopwords.
+
+    Returns:
+        list: The distinct tokens, in order of first appearance.
+    """
+
+    return list(dict.fromkeys(iter_tokens(entries, vocabulary, stopwords)))
@@ -1,52 +1,229 @@
-import pandas as pd
+import csv
+import io
+import os
 
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
-def update_journal(input_text, entries_path):
-    """ Update journal entries with input text.
-    
+import src.journal_imager.metrics as mt
+from src.journal_imager.lazy import lazy_import
+
+# pandas is only imported when a day is first read
+pd = lazy_import('pandas')
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, writes are still append-only
+    fcntl = None
+
+COLUMNS = ['Time', 'Entry']
+PLACEHOLDER_ENTRY = "No entries yet - add your first entry for today!"
+
+# Records in each entries file, as of the file's (size, modification time), to number appended rows without rereading the file
+_record_counts = {}
+
+@contextmanager
+def _locked(f):
+    # Hold an exclusive lock on an open file, so concurrent workers take turns writing it
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield f
+    finally:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def to_text(value):
+    """ Get a cell as it is stored: missing values (None, or NaN from pandas) become '', anything else its text. """
+    if value is None or value != value:
+        return ''
+    return str(value)
+
+def _to_csv_line(values):
+    # Quote like pandas.DataFrame.to_csv, one record per line
+    line = io.StringIO()
+    csv.writer(line, lineterminator='\n').writerow(values)
+    return line.getvalue().encode('utf-8')
+
+def read_last_entry(f, block_size=4096):
+    """ Read the last entry of an entries file, without reading the whole file.
+
+    Parameters:
+        f (file): The entries file, opened in binary mode.
+        block_size (int): How many bytes to read from the end at a time.
+
+    Returns:
+        str: The last entry's text, or None if the file has no entries.
+    """
+
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    tail = b''
+
+    # Read backwards until the tail holds a full last line
+    while position > 0:
+        step = min(block_size, position)
+        position -= step
+        f.seek(position)
+        tail = f.read(step) + tail
+        if b'\n' in tail.rstrip(b'\r\n'):
+            break
+
+    lines = tail.rstrip(b'\r\n').rsplit(b'\n', 1)
+    if not lines[-1] or (position == 0 and len(lines) == 1):
+        return None  # empty file, or only the header
+
+    record = next(csv.reader([lines[-1].decode('utf-8')]))
+    return record[1] if len(record) > 1 else None
+
+def _count_records(f, entries_file):
+    # Records in an open, locked entries file; only read if it changed since it was last counted (by any process)
+    stat = os.fstat(f.fileno())
+    cached = _record_counts.get(entries_file)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+    f.seek(0)
+    return max(sum(1 for _ in csv.reader(io.StringIO(f.read().decode('utf-8')))) - 1, 0)
+
+def _remember_count(f, entries_file, n_records):
+    stat = os.fstat(f.fileno())
+    _record_counts[entries_file] = ((stat.st_size, stat.st_mtime_ns), n_records)
+
+def append_entry(input_text, entries_path):
+    """ Append an entry to today's journal entries file.
+
+    Only the new record is written: the file is opened in append mode, locked for the
+    duration of the write, and flushed to disk before returning. The check against the
+    previous entry only reads the end of the file.
+
     Parameters:
         input_text (str): Input text to be written to journal entries.
         entries_path (str): Path to journal entries directory.
 
     Returns:
-        dict: Dictionary of today's entries.
+        dict: The appended entry, with its row number in the file (counting from 1) as 'id', or None if
+        nothing was written (empty input, or same as the last entry).
     """
 
+    # Check if input text is empty
+    if input_text is None or len(input_text) < 1:
+        return None
+
+    # Entries are one record per line
+    input_text = ' '.join(input_text.splitlines())
+
     # Get today's date to organize entries
     current_date = datetime.now().strftime('%Y-%m-%d')
-    today_entries_dir = entries_path / current_date
+    today_entries_dir = Path(entries_path) / current_date
     today_entries_dir.mkdir(exist_ok=True)
 
     # Write time and input text to journal_entries file
     today_entries = today_entries_dir / 'entries.csv'
-    current_time = datetime.now().strftime('%H:%M:%S')
+    entry = {'Time': datetime.now().strftime('%H:%M:%S'), 'Entry': input_text}
 
-    # Initialize empty dataframe
-    df = pd.DataFrame(columns=['Time', 'Entry'])
+    with mt.span('append_entry'), open(today_entries, 'a+b') as f, _locked(f):
+        # Check if input text is the same as the last entry
+        if input_text == read_last_entry(f):
+            return None
 
-    # Read in today's entries
-    try:
-        df = pd.read_csv(today_entries)
-    except FileNotFoundError:
-        df = pd.DataFrame({'Time': current_time, 'Entry': "No entries yet - add your first entry for today!"}, index=[0])
+        # Number the row while the file is locked, so appends from other processes are counted too
+        entry['id'] = _count_records(f, today_entries) + 1
 
-    # Check if input text is empty
-    if input_text is None or len(input_text) < 1:  # Check for empty input
-        return df.to_dict('records')
+        # New file: write the header first
+        f.seek(0, os.SEEK_END)
+        record = _to_csv_line([entry['Time'], entry['Entry']])
+        if f.tell() == 0:
+            record = _to_csv_line(COLUMNS) + record
 
-    # Check if input text is the same as the last entry
-    if input_text == df['Entry'].iloc[-1] and len(df) > 1:
-        return df.to_dict('records')
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+        _remember_count(f, today_entries, entry['id'])
+
+    return entry
+
+def read_entries(entries_file):
+    """ Read all entries of a day.
+
+    Parameters:
+        entries_file (str): Path to a day's entries.csv.
 
-    # Write to journal entries file
+    Returns:
+        list: The entries, as dictionaries with 'Time' and 'Entry' keys; every cell is its text, '' if blank.
+    """
+
+    with mt.span('read_entries'):
+        return pd.read_csv(entries_file, dtype=str, keep_default_na=False).to_dict('records')
+
+def write_entries(entries, entries_file):
+    """ Replace all entries of a day, e.g. after entries were deleted or edited.
+
+    Parameters:
+        entries (list): The entries, as dictionaries with 'Time' and 'Entry' keys.
+        entries_file (str): Path to a day's entries.csv.
+
+    Returns:
+        None
+    """
+
+    rewrite_entries(entries_file, lambda current: entries)
+
+def rewrite_entries(entries_file, update):
+    """ Change a day's entries: read them, and write back what update returns, all under the lock appends take.
+
+    No entry appended by another thread or process can get in between the read and the write, so none is lost.
+
+    Parameters:
+        entries_file (str): Path to a day's entries.csv.
+        update (callable): Called with the current entries (dictionaries with 'Time' and 'Entry' keys, as
+            read_entries returns them); returns the new entries. Anything it raises leaves the file as it was.
+
+    Returns:
+        None
+    """
+
+    # Rewrite in place under the lock, so concurrent appends are not lost to a replaced file
+    with mt.span('write_entries'), open(entries_file, 'a+b') as f, _locked(f):
+        f.seek(0, os.SEEK_END)
+        current = []
+        if f.tell() > 0:
+            f.seek(0)
+            # Every cell as the text it is, as read_entries reads it, so blank cells, 'NA' or '007' are written back unchanged
+            current = pd.read_csv(f, encoding='utf-8', dtype=str, keep_default_na=False).to_dict('records')
+        entries = update(current)
+
+        f.seek(0)
+        f.truncate()
+        f.write(_to_csv_line(COLUMNS) +
+                b''.join(_to_csv_line([to_text(entry.get('Time')), to_text(entry.get('Entry'))]) for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+        _remember_count(f, Path(entries_file), len(entries))
+
+def update_journal(input_text, entries_path, storage=None):
+    """ Update journal entries with input text.
+    
+    Parameters:
+        input_text (str): Input text to be written to journal entries.
+        entries_path (str): Path to journal entries directory.
+        storage (CsvStorage or SqliteStorage): Storage backend from journal_storage. Defaults to the entries.csv files in entries_path.
+
+    Returns:
+        dict: Dictionary of today's entries.
+    """
+
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    placeholder = [{'Time': datetime.now().strftime('%H:%M:%S'), 'Entry': PLACEHOLDER_ENTRY}]
+
+    if storage is not None:
+        storage.append_entry(input_text)
+        return storage.read_day(current_date) if storage.has_entries(current_date) else placeholder
+
+    append_entry(input_text, entries_path)
+
+    # Read in today's entries
     try:
-        df = pd.read_csv(today_entries)
-        df.loc[len(df)] = {'Time': current_time, 'Entry': input_text}
+        return read_entries(Path(entries_path) / current_date / 'entries.csv')
     except FileNotFoundError:
-        df = pd.DataFrame({'Time': current_time, 'Entry': input_text}, index=[0])
-    finally:
-        df.to_csv(today_entries, index=False)
-
-    return df.to_dict('records')
\ No newline at end of file
+        return placeholder
@@ -0,0 +1,177 @@
+import base64
+import os
+import re
+import threading
+from pathlib import Path
+
+from src.journal_imager.lazy import lazy_import
+
+# PIL is only needed for thumbnails and the rare non-PNG image
+Image = lazy_import('PIL.Image')
+features = lazy_import('PIL.features')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Start of the image in a /generate response body: {"image": "b'<base64>'"}
+_IMAGE_START = re.compile(rb'"image"\s*:\s*"(b\')?')
+
+# The base64 alphabet has no quotes, so the first quote ends the image
+_IMAGE_END = re.compile(rb'[\'"]')
+
+class ImageWriter:
+    """ Decodes base64 image data chunk by chunk straight into a file.
+
+    The data goes to a temporary file next to img_path, which replaces img_path only once
+    the whole image is written, so a half-written image is never visible. PNG data is
+    written as-is; anything else (which the backend shouldn't send) is converted to PNG.
+    """
+
+    def __init__(self, img_path):
+        self.img_path = Path(img_path)
+        self.tmp_path = self.img_path.with_name(f'.{self.img_path.name}.{threading.get_ident()}.part')
+        self.file = open(self.tmp_path, 'wb')
+        self.pending = b''   # base64 characters left over from the last chunk (fewer than 4)
+        self.head = b''      # first decoded bytes, until the signature can be checked
+        self.is_png = None
+
+    def write_base64(self, data):
+        """ Decode and write a chunk of base64 data; chunks don't have to line up with 4-character groups. """
+        data = self.pending + data.translate(None, b'\\\r\n ')
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        if usable:
+            self._write(base64.b64decode(data[:usable]))
+
+    def _write(self, decoded):
+        if self.is_png is None:
+            self.head += decoded
+            if len(self.head) < len(PNG_SIGNATURE):
+                return
+            self.is_png = self.head.startswith(PNG_SIGNATURE)
+            decoded, self.head = self.head, b''
+        self.file.write(decoded)
+
+    def commit(self):
+        """ Finish the image and move it into place. """
+        if self.pending:
+            self._write(base64.b64decode(self.pending + b'=' * (-len(self.pending) % 4)))
+        if self.head:
+            self.file.write(self.head)
+        self.file.close()
+
+        if not self.is_png:
+            # Not a PNG: fall back to converting it, like the app always did
+            with Image.open(self.tmp_path) as img:
+                img.load()
+            img.save(self.tmp_path, format='PNG')
+
+        os.replace(self.tmp_path, self.img_path)
+
+    def abort(self):
+        """ Throw away the partial image. """
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+def save_image(img_str, img_path):
+    """ Save an image string as sent by the backend.
+
+    Args:
+        img_str (str): The image, as the str() of its base64 bytes, i.e. "b'...'".
+        img_path (str): The path to save the image to.
+
+    Returns:
+        None
+    """
+
+    with ImageWriter(img_path) as writer:
+        writer.write_base64(img_str[2::].rstrip("'").encode('ascii'))
+
+def save_image_stream(chunks, img_path):
+    """ Save the image from a /generate response body, while it is being received.
+
+    Only the current chunk is held in memory: the base64 data is decoded into the file
+    as it arrives, instead of first parsing the whole JSON body.
+
+    Args:
+        chunks (iterable): The response body, as chunks of bytes (e.g. response.iter_content()).
+        img_path (str): The path to save the image to.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the body has no complete "image".
+    """
+
+    buffer = b''
+    with ImageWriter(img_path) as writer:
+        chunks = iter(chunks)
+
+        # Skip ahead to the start of the image
+        for chunk in chunks:
+            buffer += chunk
+            match = _IMAGE_START.search(buffer)
+            # Without the b' prefix in view yet, wait for more data: it may be split across chunks
+            if match is not None and (match.group(1) is not None or len(buffer) >= match.end() + 2):
+                buffer = buffer[match.end():]
+                break
+        else:
+            raise ValueError('No image in response.')
+
+        # Decode until the closing quote
+        for chunk in _prepend(buffer, chunks):
+            end = _IMAGE_END.search(chunk)
+            if end is not None:
+                writer.write_base64(chunk[:end.start()])
+                return
+            writer.write_base64(chunk)
+
+        raise ValueError('Response ended in the middle of the image.')
+
+def thumbnail_format():
+    """ Get the format thumbnails are saved in: WebP if this Pillow can write it, otherwise JPEG.
+
+    Returns:
+        tuple: The Pillow format name and the file suffix, e.g. ('WEBP', '.webp').
+    """
+
+    return ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+def save_thumbnail(img_path, thumb_path, max_size=320, quality=80):
+    """ Save a downscaled copy of an image, for previews.
+
+    Args:
+        img_path (str): The full-size image.
+        thumb_path (str): Where to save the thumbnail; its format is thumbnail_format().
+        max_size (int): Longest side of the thumbnail, in pixels. Smaller images keep their size.
+        quality (int): Encoder quality, 1-100.
+
+    Returns:
+        None
+    """
+
+    thumb_path = Path(thumb_path)
+    tmp_path = thumb_path.with_name(f'.{thumb_path.name}.{threading.get_ident()}.part')
+    with Image.open(img_path) as img:
+        # draft() lets JPEG sources decode at a reduced size; thumbnail() keeps the aspect ratio
+        img.draft('RGB', (max_size, max_size))
+        img = img.convert('RGB')
+        img.thumbnail((max_size, max_size))
+        img.save(tmp_path, format=thumbnail_format()[0], quality=quality)
+    os.replace(tmp_path, thumb_path)
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
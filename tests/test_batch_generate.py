@@ -0,0 +1,100 @@
+import unittest
+import tempfile
+import json
+import numpy as np
+
+from pathlib import Path
+from unittest import mock
+from src.journal_imager import batch_generate as bg
+from src.journal_imager import image_cache as ic
+from src.journal_imager.batch_generate import run_batch, MANIFEST_NAME, PENDING_NAME
+from src.journal_imager.get_salient_words import get_most_surprising_words
+from src.journal_imager.journal_storage import CsvStorage
+from src.journal_imager.stub_server import start_stub_server
+
+class TestBatchGenerate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+
+        # Keep the image cache out of the package directory
+        self.patch_cache_dir = mock.patch.object(ic, 'CACHE_DIR', self.tmp_path / 'cache')
+        self.patch_cache_dir.start()
+
+        # A small embedding, and three days of entries
+        rng = np.random.default_rng(0)
+        self.vocabulary = [f'word{chr(97 + idx)}' for idx in range(26)]
+        self.glove_path = self.tmp_path / 'glove'
+        self.glove_path.mkdir()
+        with open(self.glove_path / 'glove.6B.50d.txt', 'w') as f:
+            for word in self.vocabulary:
+                f.write(word + ' ' + ' '.join(f'{value:.4f}' for value in rng.normal(size=8)) + '\n')
+
+        self.entries_path = self.tmp_path / 'journal_entries'
+        self.entries_path.mkdir()
+        self.storage = CsvStorage(self.entries_path)
+        self.dates = ['2023-06-01', '2023-06-02', '2023-06-03']
+        for date in self.dates:
+            self.storage.write_day(date, [{'Time': '09:00:00', 'Entry': ' '.join(rng.choice(self.vocabulary, size=8))}
+                                          for _ in range(3)])
+
+        self.output_path = self.tmp_path / 'gen_images'
+        self.server, self.url = start_stub_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.patch_cache_dir.stop()
+        self.tmp_dir.cleanup()
+
+    def run_batch(self, dates, workers=0):
+        return run_batch(self.url, dates, self.entries_path, self.output_path, n_images=2, workers=workers, concurrency=3,
+                         glove_options={'glove_path': self.glove_path})
+
+    # Test that every day gets its images and a manifest (days scored in worker processes), and that a rerun only redoes days whose prompts changed
+    def test_run_batch_and_resume(self):
+        counts = self.run_batch(self.dates, workers=2)
+
+        self.assertEqual(counts, {'days': 3, 'days_skipped': 0, 'images': 6, 'failed': 0})
+        for date in self.dates:
+            self.assertEqual(sorted(path.name for path in (self.output_path / date).glob('*.png')), ['image_1.png', 'image_2.png'])
+            self.assertEqual(len(json.loads((self.output_path / date / MANIFEST_NAME).read_text())['prompts']), 2)
+
+        served = self.server.requests_served
+        self.assertEqual(self.run_batch(self.dates)['days_skipped'], 3)
+        self.assertEqual(self.server.requests_served, served)
+
+        # Words are weighted by how many days use them, so changing one day can change the words of others too
+        self.storage.write_day('2023-06-02', [{'Time': '10:00:00', 'Entry': 'worda wordb wordc wordd wordx wordy wordz'}])
+        before = {date: (self.output_path / date / MANIFEST_NAME).read_text() for date in self.dates}
+        counts = self.run_batch(self.dates)
+        changed = [date for date in self.dates if (self.output_path / date / MANIFEST_NAME).read_text() != before[date]]
+        self.assertIn('2023-06-02', changed)
+        self.assertEqual((counts['days_skipped'], counts['images']), (3 - len(changed), 2 * len(changed)))
+
+    # Test that an interrupted day only requests its missing images on the next run
+    def test_resume_partial_day(self):
+        self.run_batch(self.dates[:1])
+        day_dir = self.output_path / self.dates[0]
+        manifest = (day_dir / MANIFEST_NAME).read_text()
+        (day_dir / MANIFEST_NAME).rename(day_dir / PENDING_NAME)
+        (day_dir / 'image_2.png').unlink()
+
+        counts = self.run_batch(self.dates[:1])
+
+        self.assertEqual(counts['images'], 1)
+        self.assertEqual((day_dir / MANIFEST_NAME).read_text(), manifest)
+        self.assertFalse((day_dir / PENDING_NAME).exists())
+
+    # Test that the batch weights words by the journal's document frequencies, like the app
+    def test_day_prompts_doc_frequency(self):
+        self.run_batch(self.dates[:1])
+        table = bg._worker['doc_frequency']
+
+        self.assertEqual(table.n_days, len(self.dates))
+        texts = [entry['Entry'] for entry in self.storage.read_day(self.dates[0])]
+        words = get_most_surprising_words(texts, bg._worker['model'], 2, doc_frequency=table)
+        self.assertEqual(bg.day_prompts(self.dates[0], 2, '')[1], [', '.join(words[i:i+3]) for i in range(0, 6, 3)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+
+from datetime import datetime
+from src.journal_imager.date_index import DateIndex
+from src.journal_imager.journal_storage import CsvStorage, SqliteStorage
+
+class TestDateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.today = datetime.now().strftime('%Y-%m-%d')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_storage(self, storage):
+        storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first day'}])
+        index = DateIndex(storage)
+        self.assertEqual(index.dates(), ['2023-06-01'])
+
+        # Unchanged dates give the same options list, without listing the dates again
+        options = index.options(include=self.today)
+        self.assertEqual(options, [{'label': self.today, 'value': self.today}, {'label': '2023-06-01', 'value': '2023-06-01'}])
+        self.assertIs(index.options(include=self.today), options)
+
+        # A new day through add()
+        storage.append_entry('walked the dog')
+        index.add(self.today)
+        self.assertEqual(index.dates(), [self.today, '2023-06-01'])
+
+        # A day added behind the index's back is noticed through the storage's dates version
+        storage.write_day('2023-06-02', [{'Time': '09:00:00', 'Entry': 'second day'}])
+        self.assertEqual(index.dates(), [self.today, '2023-06-02', '2023-06-01'])
+
+    # Test the index over entries.csv files
+    def test_csv_storage(self):
+        self.check_storage(CsvStorage(self.tmp_dir.name))
+
+    # Test the index over SQLite, where a day without entries disappears
+    def test_sqlite_storage(self):
+        storage = SqliteStorage(f'{self.tmp_dir.name}/journal.db')
+        self.check_storage(storage)
+
+        index = DateIndex(storage)
+        storage.write_day('2023-06-02', [])
+        self.assertEqual(index.dates(), [self.today, '2023-06-01'])
+
+if __name__ == '__main__':
+    unittest.main()
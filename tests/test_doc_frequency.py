@@ -0,0 +1,92 @@
+import unittest
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from gensim.models import KeyedVectors
+from src.journal_imager.doc_frequency import DocumentFrequency, load_or_build
+from src.journal_imager.get_salient_words import get_most_surprising_words
+from src.journal_imager.journal_storage import CsvStorage
+
+class TestDocumentFrequency(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.entries_path = Path(self.tmp_dir.name)
+        self.storage = CsvStorage(self.entries_path)
+
+        rng = np.random.default_rng(0)
+        self.model = KeyedVectors(4)
+        self.model.add_vectors(['coffee', 'work', 'cat', 'volcano', 'piano'], rng.normal(size=(5, 4)).astype(np.float32))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def counts(self, table):
+        return {word: int(table.counts[idx]) for word, idx in self.model.key_to_index.items()}
+
+    # Test counting days per word as entries are added, edited and deleted
+    def test_incremental_updates(self):
+        table = DocumentFrequency(self.model)
+        table.add_entry('2023-06-01', 'Coffee, then work')
+        table.add_entry('2023-06-01', 'more coffee')
+        table.add_entry('2023-06-02', 'coffee and the cat')
+
+        self.assertEqual(self.counts(table), {'coffee': 2, 'work': 1, 'cat': 1, 'volcano': 0, 'piano': 0})
+
+        table.set_day('2023-06-01', ['a volcano'])
+        table.set_day('2023-06-02', [])
+
+        self.assertEqual(self.counts(table), {'coffee': 0, 'work': 0, 'cat': 0, 'volcano': 1, 'piano': 0})
+        self.assertEqual(table.n_days, 1)
+
+    # Test that the table is built from storage, saved, and on the next load only brought up to date
+    def test_load_or_build(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'coffee and work'}])
+        self.storage.write_day('2023-06-02', [{'Time': '09:00:00', 'Entry': 'coffee and a cat'}])
+        path = self.entries_path / 'doc_frequency.npz'
+
+        table = load_or_build(self.storage, self.model, path)
+        self.assertTrue(path.exists())
+        self.assertEqual(self.counts(table)['coffee'], 2)
+
+        self.storage.write_day('2023-06-03', [{'Time': '09:00:00', 'Entry': 'coffee at the piano'}])
+        table = load_or_build(self.storage, self.model, path)
+
+        self.assertEqual(self.counts(table), {'coffee': 3, 'work': 1, 'cat': 1, 'volcano': 0, 'piano': 1})
+        self.assertEqual(table.n_days, 3)
+
+        # A different vocabulary starts over
+        other = KeyedVectors(4)
+        other.add_vectors(['coffee', 'cat'], np.ones((2, 4), dtype=np.float32))
+        self.assertIsNone(DocumentFrequency.load(other, path))
+
+    # Test that a day changed after the table was saved (e.g. by another worker) is counted again on the next load or sync
+    def test_sync_changed_day(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'coffee'}])
+        path = self.entries_path / 'doc_frequency.npz'
+        table = load_or_build(self.storage, self.model, path)
+
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'coffee'}, {'Time': '10:00:00', 'Entry': 'work'}])
+        self.assertEqual(self.counts(load_or_build(self.storage, self.model, path))['work'], 1)
+
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'the cat'}])
+        table.sync(self.storage)
+        self.assertEqual(self.counts(table), {'coffee': 0, 'work': 0, 'cat': 1, 'volcano': 0, 'piano': 0})
+
+    # Test that a word written every day loses to a rarer word that is about as surprising
+    def test_weighting(self):
+        model = KeyedVectors(2)
+        model.add_vectors(['coffee', 'cat', 'dog', 'horse', 'piano'],
+                          np.array([[0, 1], [1, 0], [1, 0.1], [1, -0.1], [0.1, 1]], dtype=np.float32))
+        table = DocumentFrequency(model)
+        for day in range(1, 10):
+            table.add_entry(f'2023-06-{day:02d}', 'coffee')
+        table.add_entry('2023-06-09', 'piano')
+
+        entries = ['coffee with the cat', 'a dog, a horse and a piano']
+        self.assertEqual(get_most_surprising_words(entries, model, 1, centroid='mean')[0], 'coffee')
+        self.assertEqual(get_most_surprising_words(entries, model, 1, centroid='mean', doc_frequency=table)[0], 'piano')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from flask import Flask, send_from_directory
+from PIL import Image
+from src.journal_imager import gallery as gl
+
+class TestGallery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.img_dir = Path(self.tmp_dir.name) / 'gen_images' / '2023-06-01'
+        self.img_dir.mkdir(parents=True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_image(self, name, color):
+        Image.new('RGB', (640, 640), color).save(self.img_dir / name)
+        return self.img_dir / name
+
+    # Test that an added image gets a content-hashed link and thumbnail, listed in the manifest
+    def test_add_image(self):
+        entry = gl.add_image(self.write_image('image_1.png', 'red'))
+
+        self.assertRegex(entry['full'], r'^gallery/image_1\.[0-9a-f]{16}\.png$')
+        self.assertRegex(entry['thumb'], r'^gallery/image_1\.[0-9a-f]{16}\.(webp|jpg)$')
+        self.assertEqual((self.img_dir / entry['full']).read_bytes(), (self.img_dir / 'image_1.png').read_bytes())
+        with Image.open(self.img_dir / entry['thumb']) as thumb:
+            self.assertEqual(thumb.size, (320, 320))
+        self.assertEqual(gl.day_images(self.img_dir), [entry])
+
+        # A new image of the same name gets new names, and the old files go
+        new_entry = gl.add_image(self.write_image('image_1.png', 'blue'))
+        self.assertNotEqual(new_entry['full'], entry['full'])
+        self.assertFalse((self.img_dir / entry['thumb']).exists())
+        self.assertEqual(gl.day_images(self.img_dir), [new_entry])
+
+    # Test that the manifest is read once, in natural order, and that older days get one on first use
+    def test_day_images(self):
+        for idx in (1, 2, 10):
+            self.write_image(f'image_{idx}.png', 'red')
+
+        images = gl.day_images(self.img_dir)
+
+        self.assertEqual([image['name'] for image in images], ['image_1.png', 'image_2.png', 'image_10.png'])
+        self.assertTrue((self.img_dir / gl.MANIFEST_NAME).exists())
+        self.assertIs(gl.day_images(self.img_dir), images)
+        self.assertEqual(gl.day_images(self.img_dir.parent / '2023-06-02'), [])
+
+    # Test that images added by several processes at once all end up in the manifest
+    def test_add_image_processes(self):
+        img_paths = [self.write_image(f'image_{idx}.png', 'red') for idx in range(1, 9)]
+
+        with ProcessPoolExecutor(4) as executor:
+            list(executor.map(gl.add_image, img_paths))
+
+        self.assertEqual([image['name'] for image in gl.day_images(self.img_dir)],
+                         [img_path.name for img_path in img_paths])
+        self.assertEqual(list(self.img_dir.glob('.*')), [])
+
+    # Test that clearing a day removes its images, gallery files and manifest
+    def test_clear_day(self):
+        gl.add_image(self.write_image('image_1.png', 'red'))
+
+        gl.clear_day(self.img_dir)
+
+        self.assertEqual(list(self.img_dir.iterdir()), [])
+        self.assertEqual(gl.day_images(self.img_dir), [])
+
+    # Test that only content-hashed files are served as immutable
+    def test_cache_headers(self):
+        entry = gl.add_image(self.write_image('image_1.png', 'red'))
+        server = Flask(__name__)
+        server.add_url_rule('/assets/<path:path>', 'assets',
+                            lambda path: send_from_directory(Path(self.tmp_dir.name), path))
+        gl.install(server)
+        client = server.test_client()
+
+        response = client.get(f"/assets/gen_images/2023-06-01/{entry['thumb']}")
+        self.assertEqual(response.headers['Cache-Control'], gl.IMMUTABLE)
+        response.close()
+
+        response = client.get('/assets/gen_images/2023-06-01/image_1.png')
+        self.assertNotEqual(response.headers.get('Cache-Control'), gl.IMMUTABLE)
+        response.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+import unittest
+import tempfile
+import itertools
+import threading
+import time
+
+from pathlib import Path
+from unittest import mock
+from PIL import Image
+from src.journal_imager import generate_image as gi
+from src.journal_imager import image_cache as ic
+from src.journal_imager.stub_server import start_stub_server
+
+class TestGenerateImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.img_dir = Path(self.tmp_dir.name)
+
+        # Keep the image cache out of the package directory
+        self.cache_dir = self.img_dir / 'cache'
+        self.patch_cache_dir = mock.patch.object(ic, 'CACHE_DIR', self.cache_dir)
+        self.patch_cache_dir.start()
+
+    def tearDown(self):
+        self.patch_cache_dir.stop()
+        self.tmp_dir.cleanup()
+
+    # Test that a single image is written as a PNG
+    def test_generate_image(self):
+        server, url = start_stub_server()
+        try:
+            gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png')
+        finally:
+            server.shutdown()
+
+        with Image.open(self.img_dir / 'image.png') as img:
+            self.assertEqual(img.format, 'PNG')
+
+    # Test that the requests are sent concurrently over the same session
+    def test_generate_images_concurrently(self):
+        server, url = start_stub_server(latency=0.3)
+        prompts = [f'photo of {word}' for word in ('cat', 'dog', 'cow', 'owl')]
+        img_paths = [self.img_dir / f'image_{idx}.png' for idx in range(len(prompts))]
+        arrived = []
+        try:
+            start = time.perf_counter()
+            completed = gi.generate_images(url, prompts, 7.5, 50, img_paths, max_workers=4, batch=False,
+                                           on_image=lambda idx, path: arrived.append(idx))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+
+        self.assertEqual(sorted(completed), sorted(img_paths))
+        self.assertEqual(sorted(arrived), [0, 1, 2, 3])
+        self.assertLess(elapsed, 4 * 0.3)
+        self.assertIs(gi.get_session(url), gi.get_session(url))
+
+    # Test that all prompts go out in one request when the backend has a batch endpoint
+    def test_generate_images_batch(self):
+        server, url = start_stub_server()
+        prompts = [f'photo of {word}' for word in ('cat', 'dog', 'cow')]
+        img_paths = [self.img_dir / f'image_{idx}.png' for idx in range(len(prompts))]
+        arrived = []
+        try:
+            completed = gi.generate_images(url, prompts, 7.5, 50, img_paths,
+                                           on_image=lambda idx, path: arrived.append(idx))
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, img_paths)
+        self.assertEqual(arrived, [0, 1, 2])
+        self.assertEqual(server.requests_served, 1)
+        for img_path in img_paths:
+            with Image.open(img_path) as img:
+                self.assertEqual(img.format, 'PNG')
+
+    # Test the fallback to the single-prompt endpoint when the backend has no batch endpoint
+    def test_generate_images_batch_fallback(self):
+        server, url = start_stub_server(batch=False)
+        prompts = [f'photo of {word}' for word in ('cat', 'dog', 'cow')]
+        img_paths = [self.img_dir / f'image_{idx}.png' for idx in range(len(prompts))]
+        try:
+            completed = gi.generate_images(url, prompts, 7.5, 50, img_paths)
+            self.assertIn(url, gi._batch_unsupported)
+            gi.generate_images(url, prompts, 7.5, 50, img_paths, cache=False)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(sorted(completed), img_paths)
+        self.assertEqual(server.requests_served, 6)
+
+    # Test that repeat renders are served from the cache without contacting the backend
+    def test_generate_images_cached(self):
+        server, url = start_stub_server()
+        prompts = [f'photo of {word}' for word in ('cat', 'dog')]
+        first_paths = [self.img_dir / f'first_{idx}.png' for idx in range(len(prompts))]
+        second_paths = [self.img_dir / f'second_{idx}.png' for idx in range(len(prompts))]
+        try:
+            gi.generate_images(url, prompts, 7.5, 50, first_paths)
+            served = server.requests_served
+            for img_path in first_paths:
+                img_path.unlink()
+            completed = gi.generate_images(url, prompts, 7.5, 50, second_paths)
+            gi.generate_images(url, prompts, 8.0, 50, second_paths)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(served, 1)
+        self.assertEqual(completed, second_paths)
+        self.assertEqual(server.requests_served, 2)
+
+    # Test that images missing the overall deadline are abandoned instead of waited for
+    def test_generate_images_deadline(self):
+        server, url = start_stub_server(latency=1.0)
+        try:
+            start = time.perf_counter()
+            completed = gi.generate_images(url, ['photo of cat'], 7.5, 50, [self.img_dir / 'image.png'], deadline=0.1)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, [])
+        self.assertLess(elapsed, 1.0)
+
+    # Test that the deadline covers the batch request, and that the images it delivered before the deadline are kept
+    def test_generate_images_batch_deadline(self):
+        server, url = start_stub_server()
+        img_paths = [self.img_dir / f'image_{idx}.png' for idx in range(3)]
+        arrived = []
+        try:
+            with mock.patch.object(server, 'image_delay', side_effect=itertools.chain([0.0], itertools.repeat(1.0))):
+                start = time.perf_counter()
+                completed = gi.generate_images(url, ['photo of cat', 'photo of dog', 'photo of cow'], 7.5, 50, img_paths,
+                                               deadline=0.5, on_image=lambda idx, path: arrived.append(idx))
+                elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, img_paths[:1])
+        self.assertEqual(arrived, [0])
+        self.assertLess(elapsed, 1.0)
+
+    # Test that when the batch breaks off, only the images it did not deliver are requested again, and reported once
+    def test_generate_images_batch_partial(self):
+        server, url = start_stub_server()
+        img_paths = [self.img_dir / f'image_{idx}.png' for idx in range(3)]
+        arrived = []
+        try:
+            with mock.patch.object(server, 'image_delay', side_effect=itertools.chain([0.0, 1.0], itertools.repeat(0.0))):
+                completed = gi.generate_images(url, ['photo of cat', 'photo of dog', 'photo of cow'], 7.5, 50, img_paths,
+                                               timeout=(1, 0.5), cache=False, on_image=lambda idx, path: arrived.append(idx))
+        finally:
+            server.shutdown()
+
+        self.assertEqual(sorted(completed), img_paths)
+        self.assertEqual(sorted(arrived), [0, 1, 2])
+        self.assertEqual(server.requests_served, 3)
+
+    # Test that cancelling abandons pending images
+    def test_generate_images_cancel(self):
+        server, url = start_stub_server(latency=1.0)
+        cancel = threading.Event()
+        threading.Timer(0.1, cancel.set).start()
+        try:
+            start = time.perf_counter()
+            completed = gi.generate_images(url, ['photo of cat', 'photo of dog'], 7.5, 50,
+                                           [self.img_dir / 'cat.png', self.img_dir / 'dog.png'], batch=False, cancel=cancel)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, [])
+        self.assertLess(elapsed, 1.0)
+
+    # Test that failed requests are skipped
+    def test_generate_images_backend_error(self):
+        server, url = start_stub_server()
+        try:
+            completed = gi.generate_images(url + '/missing', ['photo of cat'], 7.5, 50, [self.img_dir / 'image.png'])
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, [])
+        self.assertFalse((self.img_dir / 'image.png').exists())
+
+    # Test that failures injected by the stub server are skipped, by both the batch and the single-prompt endpoint
+    def test_generate_images_injected_errors(self):
+        server, url = start_stub_server(error_rate=1.0, jitter=0.01)
+        try:
+            completed = gi.generate_images(url, ['photo of cat', 'photo of dog'], 7.5, 50,
+                                           [self.img_dir / 'cat.png', self.img_dir / 'dog.png'], cache=False, retries=0)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(completed, [])
+        self.assertEqual(server.requests_served, 3)
+
+    # Test that transient errors are retried after a backoff
+    def test_generate_image_retries(self):
+        server, url = start_stub_server()
+        try:
+            with mock.patch.object(server, 'image_fails', side_effect=[True, True, False]), mock.patch.object(gi, 'BACKOFF', 0.01):
+                gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(server.requests_served, 3)
+        self.assertTrue((self.img_dir / 'image.png').exists())
+
+    # Test that a slow backend is given up on at the deadline, rather than after the read timeout
+    def test_generate_image_deadline(self):
+        server, url = start_stub_server(latency=1.0)
+        try:
+            start = time.perf_counter()
+            with self.assertRaises(gi.requests.Timeout):
+                gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False, deadline=0.2)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+
+        self.assertLess(elapsed, 0.8)
+        self.assertFalse((self.img_dir / 'image.png').exists())
+
+    # Test that a slow request is hedged with a duplicate, whose image is used, and that the loser leaves no file behind
+    def test_generate_image_hedged(self):
+        server, url = start_stub_server()
+        try:
+            with mock.patch.object(server, 'image_delay', side_effect=[1.0, 0.0]):
+                start = time.perf_counter()
+                gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False, hedge_after=0.1)
+                elapsed = time.perf_counter() - start
+            time.sleep(1.2)
+        finally:
+            server.shutdown()
+
+        self.assertLess(elapsed, 0.8)
+        self.assertEqual(server.requests_served, 2)
+        self.assertEqual([path.name for path in self.img_dir.iterdir() if path.is_file()], ['image.png'])
+
+    # Test that the hedge delay is a high percentile of the recent latencies, once there are enough of them
+    def test_hedge_delay(self):
+        url = 'http://hedge.test'
+        for seconds in range(1, gi.HEDGE_MIN_SAMPLES):
+            gi.record_latency(url, seconds)
+        self.assertIsNone(gi.hedge_delay(url))
+
+        for seconds in range(gi.HEDGE_MIN_SAMPLES, 101):
+            gi.record_latency(url, seconds)
+        self.assertEqual(gi.hedge_delay(url), 96)
+
+    # Test that the circuit breaker stops requests to a failing backend, and lets one through after the reset time
+    def test_circuit_breaker(self):
+        server, url = start_stub_server(error_rate=1.0)
+        try:
+            for _ in range(gi.BREAKER_FAILURES):
+                with self.assertRaises(gi.requests.HTTPError):
+                    gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False, retries=0)
+            with self.assertRaises(gi.BackendUnavailable):
+                gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+            self.assertEqual(server.requests_served, gi.BREAKER_FAILURES)
+
+            breaker = gi.get_breaker(url)
+            breaker.reset_after = 0.1
+            time.sleep(0.2)
+            server.error_rate = 0.0
+            gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(server.requests_served, gi.BREAKER_FAILURES + 1)
+
+    # Test that a trial request failing with an error that is not a requests one opens the breaker again, not leaving it half-open
+    def test_circuit_breaker_trial_error(self):
+        server, url = start_stub_server()
+        breaker = gi.get_breaker(url)
+        breaker.reset_after = 0.1
+        try:
+            for _ in range(gi.BREAKER_FAILURES):
+                breaker.record_failure()
+            time.sleep(0.2)
+
+            with mock.patch.object(gi, 'save_image_stream', side_effect=ValueError('not an image')):
+                with self.assertRaises(ValueError):
+                    gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+            self.assertEqual(breaker.state, 'open')
+            with self.assertRaises(gi.BackendUnavailable):
+                gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+
+            time.sleep(0.2)
+            gi.generate_image(url, 'photo of cat', 7.5, 50, self.img_dir / 'image.png', cache=False)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(server.requests_served, 2)
+
+    # Test that a trial whose outcome is never recorded lets another one through after the reset time
+    def test_circuit_breaker_stuck_trial(self):
+        breaker = gi.CircuitBreaker(failures=1, reset_after=0.1)
+        breaker.record_failure()
+        time.sleep(0.2)
+
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.2)
+        self.assertTrue(breaker.allow())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import threading
+import time
+
+from unittest import mock
+from src.journal_imager import generation_jobs as gj
+
+def wait_until_finished(job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not gj.get_job(job_id).finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return gj.get_job(job_id).progress()
+
+class TestGenerationJobs(unittest.TestCase):
+
+    # Test that progress is reported image by image
+    def test_progress(self):
+        step = threading.Event()
+
+        def work(job):
+            job.set_total(2)
+            job.image_done(0, 'image_1.png')
+            step.wait(5)
+            job.image_done(1, 'image_2.png')
+
+        job_id = gj.submit_job(work)
+        while gj.get_job(job_id).progress()['completed'] == []:
+            time.sleep(0.01)
+
+        self.assertEqual(gj.get_job(job_id).progress(), {'status': 'running', 'total': 2, 'completed': ['image_1.png'], 'error': None})
+
+        step.set()
+        self.assertEqual(wait_until_finished(job_id)['status'], 'done')
+        self.assertEqual(gj.get_job(job_id).progress()['completed'], ['image_1.png', 'image_2.png'])
+
+    # Test that cancelling stops a job that checks job.cancelled
+    def test_cancel(self):
+        started = threading.Event()
+
+        def work(job):
+            started.set()
+            while not job.cancelled:
+                time.sleep(0.01)
+
+        job_id = gj.submit_job(work)
+        started.wait(5)
+
+        self.assertTrue(gj.cancel_job(job_id))
+        self.assertEqual(wait_until_finished(job_id)['status'], 'cancelled')
+        self.assertFalse(gj.cancel_job(job_id))
+
+    # Test that errors are reported instead of raised
+    def test_failure(self):
+        def work(job):
+            raise ConnectionError('backend unreachable')
+
+        progress = wait_until_finished(gj.submit_job(work))
+
+        self.assertEqual(progress['status'], 'failed')
+        self.assertEqual(progress['error'], 'backend unreachable')
+
+    # Test that finished jobs can be pruned at any moment of another job finishing
+    def test_prune_while_finishing(self):
+        wait_until_finished(gj.submit_job(lambda job: None))
+        errors = []
+
+        def prune_and_time():
+            # Another job's _prune() gets in just as this one takes its finish time
+            try:
+                gj._prune()
+            except Exception as e:
+                errors.append(e)
+            return time.time()
+
+        with mock.patch.object(gj, 'time', mock.Mock(time=prune_and_time)):
+            self.assertEqual(wait_until_finished(gj.submit_job(lambda job: None))['status'], 'done')
+
+        self.assertEqual(errors, [])
+
+    # Test that unknown jobs are reported as such
+    def test_unknown_job(self):
+        self.assertIsNone(gj.get_job('missing'))
+        self.assertFalse(gj.cancel_job('missing'))
+
+if __name__ == '__main__':
+    unittest.main()
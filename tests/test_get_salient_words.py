@@ -0,0 +1,105 @@
+import unittest
+import numpy as np
+
+from gensim.models import KeyedVectors
+from scipy import spatial, stats
+from src.journal_imager.get_salient_words import leave_one_out_centroids, cosine_similarities, get_most_surprising_words, get_most_surprising_words_range
+
+class TestLeaveOneOutCentroids(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.matrices = [rng.normal(size=(n, 5)) for n in (2, 3, 4, 7, 10)]
+        # Ties within columns should not change the result
+        self.matrices.append(np.round(rng.normal(size=(9, 5))))
+
+    # Test the vectorized median against one np.median per left-out row
+    def test_median(self):
+        for vectors in self.matrices:
+            expected = [np.median(np.delete(vectors, i, axis=0), axis=0) for i in range(len(vectors))]
+            np.testing.assert_allclose(leave_one_out_centroids(vectors, 'median'), expected)
+
+    # Test the vectorized mean against one np.mean per left-out row
+    def test_mean(self):
+        for vectors in self.matrices:
+            expected = [np.mean(np.delete(vectors, i, axis=0), axis=0) for i in range(len(vectors))]
+            np.testing.assert_allclose(leave_one_out_centroids(vectors, 'mean'), expected)
+
+    # Test the vectorized trimmed mean against scipy's trim_mean per left-out row
+    def test_trimmed_mean(self):
+        for vectors in self.matrices:
+            expected = [stats.trim_mean(np.delete(vectors, i, axis=0), 0.2, axis=0) for i in range(len(vectors))]
+            np.testing.assert_allclose(leave_one_out_centroids(vectors, 'trimmed_mean', trim=0.2), expected)
+
+    # Test ValueError handling
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            leave_one_out_centroids(np.ones((1, 3)))
+        with self.assertRaises(ValueError):
+            leave_one_out_centroids(np.ones((3, 3)), 'mode')
+
+class TestCosineSimilarities(unittest.TestCase):
+
+    # Test against scipy's pairwise cosine distance
+    def test_cosine_similarities(self):
+        rng = np.random.default_rng(1)
+        vectors, others = rng.normal(size=(6, 4)), rng.normal(size=(6, 4))
+        expected = [1 - spatial.distance.cosine(u, v) for u, v in zip(vectors, others)]
+        np.testing.assert_allclose(cosine_similarities(vectors, others), expected)
+
+    # Test that zero vectors give a similarity of 0 instead of nan
+    def test_zero_vector(self):
+        similarities = cosine_similarities(np.zeros((1, 3)), np.ones((1, 3)))
+        np.testing.assert_array_equal(similarities, [0])
+
+class TestGetMostSurprisingWords(unittest.TestCase):
+
+    def setUp(self):
+        # Animals point one way, 'volcano' points the other
+        self.model = KeyedVectors(3)
+        self.model.add_vectors(
+            ['cat', 'dog', 'horse', 'cow', 'volcano', 'the'],
+            np.array([[1, 0.1, 0], [1, 0, 0.1], [1, 0.1, 0.1], [1, 0, 0], [-1, 1, 0], [0, 0, 1]], dtype=np.float32)
+        )
+
+    # Test that the odd word out is the most surprising, and stopwords/unknown words are ignored
+    def test_most_surprising_word(self):
+        entries = ["The cat and the dog", "A horse, a cow and a volcano!", "zyzzyva"]
+        words = get_most_surprising_words(entries, self.model, 1)
+
+        self.assertEqual(words[0], 'volcano')
+        self.assertNotIn('the', words)
+        self.assertEqual(len(words), 3)
+
+    # Test that there is nothing to rank with fewer than two words
+    def test_too_few_words(self):
+        self.assertEqual(get_most_surprising_words(["the zyzzyva"], self.model, 2), [])
+        self.assertEqual(get_most_surprising_words(["a volcano"], self.model, 2), ['volcano'])
+
+class TestGetMostSurprisingWordsRange(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.vocabulary = [f'word{idx}' for idx in range(50)]
+        self.model = KeyedVectors(6)
+        self.model.add_vectors(self.vocabulary, rng.normal(size=(50, 6)).astype(np.float32))
+        self.entries = [' '.join(rng.choice(self.vocabulary[:30], size=6)) for _ in range(200)] + ['word40 word41']
+
+    # Test against the weighted leave-one-out mean computed per word, with the entries streamed from a generator
+    def test_against_brute_force(self):
+        tokens = ' '.join(self.entries).split()
+        words = list(dict.fromkeys(tokens))
+        similarities = []
+        for word in words:
+            rest = [self.model[token] for token in tokens if token != word]
+            similarities.append(1 - spatial.distance.cosine(self.model[word], np.mean(rest, axis=0)))
+        expected = [words[idx] for idx in np.argsort(similarities, kind='stable')[:6]]
+
+        self.assertEqual(get_most_surprising_words_range((entry for entry in self.entries), self.model, 2, block_size=7), expected)
+
+    # Test that there is nothing to rank with fewer than two words
+    def test_too_few_words(self):
+        self.assertEqual(get_most_surprising_words_range(iter(["word1 word1", "the zyzzyva"]), self.model, 1), ['word1'])
+
+if __name__ == '__main__':
+    unittest.main()
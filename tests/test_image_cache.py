@@ -0,0 +1,53 @@
+import unittest
+import tempfile
+import os
+
+from pathlib import Path
+from src.journal_imager.image_cache import cache_key, get_cached_image, put_cached_image, evict
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmp_dir.name) / 'cache'
+        self.img_path = Path(self.tmp_dir.name) / 'image.png'
+        self.img_path.write_bytes(b'x' * 100)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    # Test that every parameter is part of the key
+    def test_cache_key(self):
+        key = cache_key('photo of cat', 7.5, 50, 'https://a.ngrok-free.app')
+
+        self.assertEqual(key, cache_key('photo of cat', 7.5, 50, 'https://a.ngrok-free.app'))
+        self.assertNotEqual(key, cache_key('photo of dog', 7.5, 50, 'https://a.ngrok-free.app'))
+        self.assertNotEqual(key, cache_key('photo of cat', 8, 50, 'https://a.ngrok-free.app'))
+        self.assertNotEqual(key, cache_key('photo of cat', 7.5, 49, 'https://a.ngrok-free.app'))
+        self.assertNotEqual(key, cache_key('photo of cat', 7.5, 50, 'https://b.ngrok-free.app'))
+
+    # Test a miss, then a hit after the image is added
+    def test_get_and_put(self):
+        out_path = Path(self.tmp_dir.name) / 'out.png'
+
+        self.assertFalse(get_cached_image('abc', out_path, self.cache_dir))
+        put_cached_image('abc', self.img_path, self.cache_dir)
+        self.img_path.unlink()
+
+        self.assertTrue(get_cached_image('abc', out_path, self.cache_dir))
+        self.assertEqual(out_path.read_bytes(), b'x' * 100)
+
+    # Test that the least recently used images are evicted first
+    def test_evict_least_recently_used(self):
+        for idx, key in enumerate(['old', 'used', 'new']):
+            put_cached_image(key, self.img_path, self.cache_dir)
+            os.utime(self.cache_dir / (key + '.png'), (idx, idx))
+
+        # Using 'used' makes it the most recent
+        get_cached_image('used', Path(self.tmp_dir.name) / 'out.png', self.cache_dir)
+
+        self.assertEqual(evict(self.cache_dir, max_bytes=200), 1)
+        self.assertEqual(sorted(path.stem for path in self.cache_dir.glob('*.png')), ['new', 'used'])
+
+if __name__ == '__main__':
+    unittest.main()
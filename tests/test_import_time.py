@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from pathlib import Path
+
+# Dependencies that are only needed once the model is loaded or words are scored
+DEFERRED_MODULES = ('gensim', 'scipy', 'pandas', 'numpy', 'PIL.Image')
+
+# Seconds the app's own modules may take to import, not counting their dependencies
+OWN_IMPORT_BUDGET = float(os.environ.get('JOURNAL_IMAGER_IMPORT_BUDGET', '0.5'))
+
+class TestImportTime(unittest.TestCase):
+
+    # Test that importing the app leaves the heavy dependencies unimported, within the import-time budget
+    def test_app_import(self):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import src.journal_imager.app'],
+                                cwd=Path(__file__).parent.parent,
+                                env={**os.environ, 'JOURNAL_IMAGER_PRELOAD_MODEL': '0'},
+                                capture_output=True, text=True, check=True)
+
+        # Lines look like "import time:   self [us] | cumulative | name", with the name indented by depth
+        imports = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and not line.endswith('imported package'):
+                self_us, _, name = line[len('import time:'):].split('|')
+                if self_us.strip().isdigit():
+                    imports[name.strip()] = int(self_us) / 1e6
+
+        self.assertIn('src.journal_imager.app', imports)
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, imports)
+        own = sum(seconds for name, seconds in imports.items() if name.startswith('src.journal_imager'))
+        self.assertLess(own, OWN_IMPORT_BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
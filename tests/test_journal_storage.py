@@ -0,0 +1,233 @@
+import os
+import unittest
+import tempfile
+
+from pathlib import Path
+from datetime import datetime
+from src.journal_imager.journal_storage import CsvStorage, SqliteStorage, StaleRowsError, diff_rows, get_storage, migrate_csv_to_sqlite
+
+class StorageContract:
+    """ Tests every storage backend has to pass; subclasses provide make_storage(). """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.entries_path = Path(self.tmp_dir.name)
+        self.storage = self.make_storage()
+        self.today = datetime.now().strftime('%Y-%m-%d')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    # Test appending, including skipping empty and repeated entries
+    def test_append_entry(self):
+        self.assertFalse(self.storage.has_entries(self.today))
+        self.assertIsNotNone(self.storage.append_entry('walked the dog'))
+        self.assertIsNone(self.storage.append_entry('walked the dog'))
+        self.assertIsNone(self.storage.append_entry(''))
+        self.assertIsNotNone(self.storage.append_entry('fed the cat'))
+
+        self.assertTrue(self.storage.has_entries(self.today))
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day(self.today)], ['walked the dog', 'fed the cat'])
+
+    # Test replacing a day, listing dates and reading a date range
+    def test_write_day_and_ranges(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first day'}])
+        self.storage.write_day('2023-06-03', [{'Time': '10:00:00', 'Entry': 'third day'}, {'Time': '11:00:00', 'Entry': 'later'}])
+        self.storage.write_day('2023-07-01', [{'Time': '12:00:00', 'Entry': 'next month'}])
+
+        self.assertEqual(self.storage.list_dates(), ['2023-07-01', '2023-06-03', '2023-06-01'])
+        self.assertEqual(self.storage.read_day('2023-06-02'), [])
+        self.assertEqual([(entry['Date'], entry['Entry']) for entry in self.storage.read_range('2023-06-01', '2023-06-30')],
+                         [('2023-06-01', 'first day'), ('2023-06-03', 'third day'), ('2023-06-03', 'later')])
+
+        self.storage.write_day('2023-06-03', [{'Time': '11:00:00', 'Entry': 'later'}])
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day('2023-06-03')], ['later'])
+
+    # Test that the dates version changes when a day is added or removed, and not for more entries on a day
+    def test_dates_version(self):
+        version = self.storage.dates_version()
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first day'}])
+        self.assertNotEqual(self.storage.dates_version(), version)
+
+        version = self.storage.dates_version()
+        self.storage.append_entry('walked the dog')
+        self.assertNotEqual(self.storage.dates_version(), version)
+
+        version = self.storage.dates_version()
+        self.storage.append_entry('fed the cat')
+        self.assertEqual(self.storage.dates_version(), version)
+
+    # Test that a day's version changes when its entries do, and only then
+    def test_day_versions(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first day'}])
+        self.storage.write_day('2023-06-02', [{'Time': '09:00:00', 'Entry': 'second day'}])
+        versions = self.storage.day_versions()
+        self.assertEqual(sorted(versions), ['2023-06-01', '2023-06-02'])
+
+        row_id = self.storage.read_day('2023-06-01', ids=True)[0]['id']
+        self.storage.update_rows('2023-06-01', [], {row_id: {'Time': '09:00:00', 'Entry': 'first day, edited'}})
+        self.assertNotEqual(self.storage.day_versions()['2023-06-01'], versions['2023-06-01'])
+        self.assertEqual(self.storage.day_versions()['2023-06-02'], versions['2023-06-02'])
+
+        self.storage.append_entry('walked the dog')
+        self.assertIn(self.today, self.storage.day_versions())
+
+    # Test deleting and editing rows by id, as diffed from a table
+    def test_update_rows(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first'},
+                                              {'Time': '10:00:00', 'Entry': 'second'},
+                                              {'Time': '11:00:00', 'Entry': 'third'}])
+        stored = {entry['id']: entry for entry in self.storage.read_day('2023-06-01', ids=True)}
+        rows = [dict(entry) for entry in stored.values()]
+        del rows[0]
+        rows[1]['Entry'] = 'third, edited'
+
+        deleted, edited = diff_rows(stored, rows)
+        self.assertEqual(diff_rows(stored, list(stored.values())), ([], {}))
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(list(edited.values()), [{'Time': '11:00:00', 'Entry': 'third, edited'}])
+
+        self.storage.update_rows('2023-06-01', deleted, edited)
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day('2023-06-01')], ['second', 'third, edited'])
+
+    # Test that appended entries get the id they are read back with, also when another worker appended in between
+    def test_append_entry_id(self):
+        self.storage.append_entry('walked the dog')
+        entry = self.storage.append_entry('fed the cat')
+        self.assertEqual(self.storage.read_day(self.today, ids=True)[-1], entry)
+
+        self.make_storage().append_entry('watered the plants')
+        entry = self.storage.append_entry('read a book')
+        self.assertEqual(self.storage.read_day(self.today, ids=True)[-1], entry)
+
+    # Test that entries appended after a day was read survive deleting and editing its rows
+    def test_update_rows_keeps_appended(self):
+        self.storage.append_entry('walked the dog')
+        self.storage.append_entry('fed the cat')
+        stored = {entry['id']: entry for entry in self.storage.read_day(self.today, ids=True)}
+        self.storage.append_entry('watered the plants')
+
+        first, second = stored
+        self.storage.update_rows(self.today, [first], {second: {'Time': stored[second]['Time'], 'Entry': 'fed the cats'}}, stored)
+
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day(self.today)], ['fed the cats', 'watered the plants'])
+
+    # Test that appends, this tab's (added to its table and stored entries) or another tab's (in neither), are not taken for edits
+    def test_diff_rows_after_append(self):
+        self.storage.append_entry('walked the dog')
+        entries = self.storage.read_day(self.today, ids=True)
+        self.storage.append_entry('fed the cat')
+        entry = self.storage.append_entry('watered the plants')
+
+        stored = {row['id']: row for row in entries + [entry]}
+        self.assertEqual(diff_rows(stored, [dict(row) for row in entries + [entry]]), ([], {}))
+
+    # Test that an edit of a row another tab deleted is refused, and changes nothing
+    def test_update_rows_stale(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first'},
+                                              {'Time': '10:00:00', 'Entry': 'second'},
+                                              {'Time': '11:00:00', 'Entry': 'third'}])
+        stored = {entry['id']: entry for entry in self.storage.read_day('2023-06-01', ids=True)}
+        row_id = list(stored)[1]
+
+        self.storage.update_rows('2023-06-01', [row_id], {}, dict(stored))
+        with self.assertRaises(StaleRowsError):
+            self.storage.update_rows('2023-06-01', [], {row_id: {'Time': '10:00:00', 'Entry': 'second, edited'}}, stored)
+
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day('2023-06-01')], ['first', 'third'])
+
+    # Test that deleting a row keeps the other rows' text as it is, blank and 'NA' included
+    def test_update_rows_keeps_text(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': ''},
+                                              {'Time': '10:00:00', 'Entry': 'NA'},
+                                              {'Time': '11:00:00', 'Entry': '007'},
+                                              {'Time': '12:00:00', 'Entry': 'deleted'}])
+        stored = {entry['id']: entry for entry in self.storage.read_day('2023-06-01', ids=True)}
+        row_ids = list(stored)
+
+        self.storage.update_rows('2023-06-01', [row_ids[3]], {row_ids[1]: {'Time': '10:30:00', 'Entry': 'NA'}}, stored)
+
+        self.assertEqual(self.storage.read_day('2023-06-01'), [{'Time': '09:00:00', 'Entry': ''},
+                                                               {'Time': '10:30:00', 'Entry': 'NA'},
+                                                               {'Time': '11:00:00', 'Entry': '007'}])
+
+    # Test text search across days
+    def test_search(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'Walked the dog in the park'}])
+        self.storage.write_day('2023-06-02', [{'Time': '09:00:00', 'Entry': 'Rainy day, no park'}])
+
+        self.assertEqual([entry['Date'] for entry in self.storage.search('park')], ['2023-06-02', '2023-06-01'])
+        self.assertEqual([entry['Date'] for entry in self.storage.search('dog')], ['2023-06-01'])
+        self.assertEqual(self.storage.search('volcano'), [])
+
+class TestCsvStorage(StorageContract, unittest.TestCase):
+
+    def make_storage(self):
+        return CsvStorage(self.entries_path)
+
+    # Test that row numbers read before another tab's deletion are not applied to the rows that moved into their place
+    def test_update_rows_renumbered(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first'},
+                                              {'Time': '10:00:00', 'Entry': 'second'},
+                                              {'Time': '11:00:00', 'Entry': 'third'}])
+        stored = {entry['id']: entry for entry in self.storage.read_day('2023-06-01', ids=True)}
+
+        self.storage.update_rows('2023-06-01', [2], {}, stored)
+        with self.assertRaises(StaleRowsError):
+            self.storage.update_rows('2023-06-01', [], {3: {'Time': '11:00:00', 'Entry': 'third, edited'}}, stored)
+        with self.assertRaises(StaleRowsError):
+            self.storage.update_rows('2023-06-01', [2], {}, stored)
+
+        self.assertEqual([entry['Entry'] for entry in self.storage.read_day('2023-06-01')], ['first', 'third'])
+
+    # Test that files written next to the day directories, like the document-frequency table, leave the dates' version as it was
+    def test_dates_version_other_files(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first day'}])
+        version = self.storage.dates_version()
+
+        tmp_file = self.entries_path / '.doc_frequency.npz.tmp'
+        tmp_file.write_bytes(b'table')
+        os.replace(tmp_file, self.entries_path / 'doc_frequency.npz')
+
+        self.assertEqual(self.storage.dates_version(), version)
+
+class TestSqliteStorage(StorageContract, unittest.TestCase):
+
+    def make_storage(self):
+        return SqliteStorage(self.entries_path / 'journal.db')
+
+    # Test that missing values are stored as empty text, as in entries.csv, rather than 'None'
+    def test_missing_values(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': None}, {'Time': None, 'Entry': float('nan')}])
+        row_id = self.storage.read_day('2023-06-01', ids=True)[0]['id']
+        self.storage.update_rows('2023-06-01', [], {row_id: {'Time': '10:00:00', 'Entry': None}})
+
+        self.assertEqual(self.storage.read_day('2023-06-01'), [{'Time': '10:00:00', 'Entry': ''}, {'Time': '', 'Entry': ''}])
+
+    # Test that the search index follows edits, and that FTS query syntax in the text is harmless
+    def test_search_index_updates(self):
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'dog'}])
+        self.storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'cat'}])
+
+        self.assertEqual(self.storage.search('dog'), [])
+        self.assertEqual(len(self.storage.search('cat')), 1)
+        self.assertEqual(self.storage.search('cat" OR "dog'), [])
+
+class TestMigration(unittest.TestCase):
+
+    # Test copying the CSV tree into SQLite, twice
+    def test_migrate_csv_to_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_storage = CsvStorage(tmp_dir)
+            csv_storage.write_day('2023-06-01', [{'Time': '09:00:00', 'Entry': 'first, with a comma'}])
+            csv_storage.write_day('2023-06-02', [{'Time': '09:00:00', 'Entry': 'second'}, {'Time': '10:00:00', 'Entry': 'third'}])
+
+            self.assertEqual(migrate_csv_to_sqlite(tmp_dir), 3)
+            self.assertEqual(migrate_csv_to_sqlite(tmp_dir), 0)
+
+            sqlite_storage = get_storage(tmp_dir, 'sqlite')
+            self.assertEqual(sqlite_storage.list_dates(), csv_storage.list_dates())
+            self.assertEqual(sqlite_storage.read_day('2023-06-01'), csv_storage.read_day('2023-06-01'))
+
+if __name__ == '__main__':
+    unittest.main()
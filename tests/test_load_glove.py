@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from src.journal_imager.load_glove import compile_glove, open_glove, load_glove
+from src.journal_imager.get_salient_words import word_vectors
+
+class TestLoadGlove(unittest.TestCase):
+
+    def setUp(self):
+        # Write a tiny GloVe-style text file
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.glove_path = Path(self.tmp_dir.name)
+        self.words = ['the', 'cat', 'sat']
+        self.vectors = np.arange(12, dtype=np.float32).reshape(3, 4) / 4
+        with open(self.glove_path / 'glove.6B.50d.txt', 'w') as f:
+            for word, vector in zip(self.words, self.vectors):
+                f.write(word + ' ' + ' '.join(str(value) for value in vector) + '\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    # Test that the compiled store round-trips the text file
+    def test_compile_and_open(self):
+        vectors_file, vocab_file = compile_glove(self.glove_path / 'glove.6B.50d.txt')
+        model = open_glove(vectors_file, vocab_file)
+
+        self.assertIsInstance(model.vectors, np.memmap)
+        self.assertEqual(model.vectors.dtype, np.float32)
+        self.assertEqual(model.index_to_key, self.words)
+        np.testing.assert_array_equal(model['cat'], self.vectors[1])
+
+        del model
+
+    # Test that load_glove compiles on first use and does not need the text file afterwards
+    def test_load_glove_compiles_once(self):
+        load_glove(self.glove_path)
+        (self.glove_path / 'glove.6B.50d.txt').unlink()
+
+        model = load_glove(self.glove_path)
+
+        self.assertIn('sat', model.key_to_index)
+        np.testing.assert_array_equal(model['sat'], self.vectors[2])
+
+        del model
+
+    # Test the float16 and int8 stores and the vocabulary cut, read back through word_vectors
+    def test_compact_stores(self):
+        for dtype, tolerance in (('float16', 1e-3), ('int8', 0.02)):
+            vectors_file, vocab_file = compile_glove(self.glove_path / 'glove.6B.50d.txt', dtype=dtype, max_words=2)
+            model = open_glove(vectors_file, vocab_file)
+
+            self.assertEqual(vectors_file.name, f'glove.6B.50d.top2.{dtype}.npy')
+            self.assertEqual(model.vectors.dtype, np.dtype(dtype))
+            self.assertEqual(model.index_to_key, self.words[:2])
+            np.testing.assert_allclose(word_vectors(model, ['the', 'cat']), self.vectors[:2], atol=tolerance)
+
+            del model
+
+    # Test choosing the vector size and storage type in load_glove
+    def test_load_glove_variant(self):
+        (self.glove_path / 'glove.6B.50d.txt').rename(self.glove_path / 'glove.6B.300d.txt')
+
+        model = load_glove(self.glove_path, dim=300, dtype='int8')
+
+        self.assertTrue((self.glove_path / 'glove.6B.300d.int8.npy').exists())
+        self.assertEqual(model.vector_scales.shape, (3,))
+        np.testing.assert_allclose(word_vectors(model, ['sat']), self.vectors[2:], atol=0.02)
+
+        del model
+
+if __name__ == '__main__':
+    unittest.main()
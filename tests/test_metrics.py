@@ -0,0 +1,72 @@
+import unittest
+import tempfile
+
+from pathlib import Path
+import flask
+
+import src.journal_imager.metrics as mt
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.was_enabled = mt.is_enabled()
+        mt.reset()
+
+    def tearDown(self):
+        mt.enable(self.was_enabled)
+        mt.reset()
+
+    # Test that disabled spans record nothing
+    def test_disabled_span(self):
+        mt.enable(False)
+        with mt.span('tokenize'):
+            pass
+        self.assertIsNone(mt.get_histogram('tokenize'))
+
+    # Test that enabled spans and timed functions add to their stage's histogram
+    def test_span_and_timed(self):
+        mt.enable()
+        for _ in range(3):
+            with mt.span('tokenize'):
+                pass
+
+        @mt.timed('score')
+        def score(x):
+            return x * 2
+
+        self.assertEqual(score(2), 4)
+        self.assertEqual(mt.get_histogram('tokenize').count, 3)
+        self.assertEqual(mt.get_histogram('score').count, 1)
+
+    # Test the Prometheus text format: cumulative buckets ending in +Inf, then sum and count
+    def test_render(self):
+        mt.observe('load_glove', 0.003)
+        mt.observe('load_glove', 0.2)
+        mt.observe('load_glove', 500)
+
+        lines = mt.render().splitlines()
+        self.assertIn('# TYPE journal_imager_stage_seconds histogram', lines)
+        self.assertIn('journal_imager_stage_seconds_bucket{stage="load_glove",le="0.001"} 0', lines)
+        self.assertIn('journal_imager_stage_seconds_bucket{stage="load_glove",le="0.005"} 1', lines)
+        self.assertIn('journal_imager_stage_seconds_bucket{stage="load_glove",le="0.25"} 2', lines)
+        self.assertIn('journal_imager_stage_seconds_bucket{stage="load_glove",le="+Inf"} 3', lines)
+        self.assertIn('journal_imager_stage_seconds_count{stage="load_glove"} 3', lines)
+
+    # Test the /metrics route, request timing and the per-request profile dumps
+    def test_install(self):
+        mt.enable()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            server = flask.Flask(__name__)
+            server.add_url_rule('/hello', 'hello', lambda: 'hello')
+            mt.install(server, profile_dir=profile_dir)
+
+            client = server.test_client()
+            self.assertEqual(client.get('/hello').data, b'hello')
+            response = client.get('/metrics')
+
+            self.assertEqual(response.mimetype, 'text/plain')
+            self.assertIn('stage="http_request"', response.get_data(as_text=True))
+            self.assertEqual(len(list(Path(profile_dir).glob('*_hello-*.prof'))), 1)
+
+if __name__ == '__main__':
+    unittest.main()
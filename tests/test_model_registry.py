@@ -0,0 +1,57 @@
+import unittest
+import threading
+import time
+
+from unittest import mock
+import src.journal_imager.model_registry as mr
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        mr.unload_model()
+
+    def tearDown(self):
+        mr.unload_model()
+
+    # Test that concurrent callers share a single load
+    def test_get_model_loads_once(self):
+        calls = []
+
+        def slow_load():
+            calls.append(1)
+            time.sleep(0.05)
+            return object()
+
+        with mock.patch.object(mr.lg, 'load_glove', side_effect=slow_load):
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(mr.get_model())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(id(model) for model in results)), 1)
+
+    # Test that preloading makes the model ready without a caller waiting on it
+    def test_preload_model(self):
+        model = object()
+
+        with mock.patch.object(mr.lg, 'load_glove', return_value=model):
+            self.assertEqual(mr.model_status(), 'not loaded')
+            mr.preload_model().join()
+
+        self.assertTrue(mr.is_model_ready())
+        self.assertEqual(mr.model_status(), 'ready')
+        self.assertIs(mr.get_model(), model)
+
+    # Test that a failed preload is reported and can be retried
+    def test_preload_model_failure(self):
+        with mock.patch.object(mr.lg, 'load_glove', side_effect=OSError('no embeddings')):
+            mr.preload_model().join()
+
+        self.assertFalse(mr.is_model_ready())
+        self.assertEqual(mr.model_status(), 'failed: no embeddings')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import tempfile
+import numpy as np
+
+from gensim.models import KeyedVectors
+from pathlib import Path
+from src.journal_imager import nearest_words as nw
+from src.journal_imager.nearest_words import NearestWords, expand_triples
+
+class TestNearestWords(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocabulary = [f'word{chr(97 + idx // 26)}{chr(97 + idx % 26)}' for idx in range(2000)] + ['the', '1999']
+        self.model = KeyedVectors(16)
+        self.model.add_vectors(self.vocabulary, rng.normal(size=(len(self.vocabulary), 16)).astype(np.float32))
+        self.triples = [list(rng.choice(self.vocabulary[:2000], size=3, replace=False)) for _ in range(6)]
+
+    def brute_force(self, words, topn):
+        # Cosine similarity of every word to the mean of the words' unit vectors
+        unit = self.model.vectors / np.linalg.norm(self.model.vectors, axis=1, keepdims=True)
+        query = unit[[self.model.key_to_index[word] for word in words]].sum(axis=0)
+        order = np.argsort(-(unit @ query), kind='stable')
+        candidates = [self.vocabulary[idx] for idx in order if self.vocabulary[idx] not in words]
+        return [word for word in candidates if word.isalpha() and word != 'the'][:topn]
+
+    # Test that exact search matches a brute-force scan, without the set's own words or unsuggestable words
+    def test_exact(self):
+        index = NearestWords.build(self.model, n_lists=0)
+
+        self.assertEqual(index.most_similar(self.triples, 5), [self.brute_force(triple, 5) for triple in self.triples])
+
+    # Test that the IVF index finds most of the true neighbours, and all of them when every cluster is probed
+    def test_ivf(self):
+        index = NearestWords.build(self.model, n_lists=20)
+
+        index.n_probe = 20
+        self.assertEqual(index.most_similar(self.triples, 5), [self.brute_force(triple, 5) for triple in self.triples])
+
+        index.n_probe = 8
+        found = [set(words) & set(self.brute_force(triple, 5)) for triple, words in zip(self.triples, index.most_similar(self.triples, 5))]
+        self.assertGreaterEqual(sum(map(len, found)), 20)
+
+    # Test that a saved index is memory-mapped back and answers the same
+    def test_save_and_load(self):
+        index = NearestWords.build(self.model, n_lists=20)
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(directory)
+            loaded = NearestWords.load(self.model, directory)
+
+            self.assertIsInstance(loaded.vectors, np.memmap)
+            self.assertEqual(loaded.most_similar(self.triples, 3), index.most_similar(self.triples, 3))
+
+            del loaded
+
+    # Test adding related words to triples
+    def test_expand_triples(self):
+        index = NearestWords.build(self.model, n_lists=0)
+
+        expanded = expand_triples(index, self.triples, 2)
+
+        self.assertEqual([words[:3] for words in expanded], self.triples)
+        self.assertEqual([words[3:] for words in expanded], [self.brute_force(triple, 2) for triple in self.triples])
+        self.assertEqual(expand_triples(index, self.triples, 0), self.triples)
+
+    # Test that without build the index is only opened once the background build saved it, and that no temporary files are left
+    def test_get_index_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(nw.get_index(self.model, directory, build=False))
+
+            nw.build_in_background(self.model, directory).join()
+            index = nw.get_index(self.model, directory, build=False)
+
+            self.assertIsNotNone(index)
+            self.assertIs(nw.get_index(self.model, directory), index)
+            self.assertEqual(sorted(path.name for path in Path(directory).iterdir() if path.suffix == '.tmp'), [])
+
+            del index
+            nw._index = None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import numpy as np
+
+from gensim.models import KeyedVectors
+from src.journal_imager.get_salient_words import get_most_surprising_words
+from src.journal_imager.salience_index import SalienceIndex
+
+class TestSalienceIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocabulary = [f'word{idx}' for idx in range(40)]
+        self.model = KeyedVectors(8)
+        self.model.add_vectors(self.vocabulary, rng.normal(size=(40, 8)).astype(np.float32))
+        self.entries = [' '.join(rng.choice(self.vocabulary, size=5)) for _ in range(12)]
+
+    # Test that adding entries one by one gives the same words as scoring from scratch
+    def test_add_entries(self):
+        index = SalienceIndex(self.model)
+        for entry in self.entries:
+            index.add_entry('2023-06-01', entry)
+
+        self.assertEqual(sorted(index.most_surprising('2023-06-01', 2)),
+                         sorted(get_most_surprising_words(self.entries, self.model, 2)))
+
+    # Test that removing entries undoes adding them
+    def test_remove_entries(self):
+        index = SalienceIndex(self.model)
+        for entry in self.entries:
+            index.add_entry('2023-06-01', entry)
+        for entry in self.entries[6:]:
+            index.remove_entry('2023-06-01', entry)
+
+        self.assertEqual(sorted(index.most_surprising('2023-06-01', 2)),
+                         sorted(get_most_surprising_words(self.entries[:6], self.model, 2)))
+
+    # Test syncing a day with a changed list of entries, and that scores are only recomputed when words change
+    def test_set_day(self):
+        index = SalienceIndex(self.model)
+        index.set_day('2023-06-01', [{'Time': '09:00:00', 'Entry': entry} for entry in self.entries])
+        index.most_surprising('2023-06-01', 1)
+        scores = index._days['2023-06-01'].similarities
+
+        index.set_day('2023-06-01', self.entries)
+        self.assertIs(index._days['2023-06-01'].similarities, scores)
+
+        index.set_day('2023-06-01', self.entries[1:])
+        self.assertEqual(sorted(index.most_surprising('2023-06-01', 2)),
+                         sorted(get_most_surprising_words(self.entries[1:], self.model, 2)))
+
+        index.set_day('2023-06-01', [])
+        self.assertFalse(index.has_day('2023-06-01'))
+
+    # Test that only the most recently used days are kept
+    def test_max_days(self):
+        index = SalienceIndex(self.model, max_days=2)
+        index.set_day('2023-06-01', self.entries[:4])
+        index.set_day('2023-06-02', self.entries[4:8])
+        index.most_surprising('2023-06-01', 1)
+        index.set_day('2023-06-03', self.entries[8:])
+
+        self.assertTrue(index.has_day('2023-06-01'))
+        self.assertFalse(index.has_day('2023-06-02'))
+        self.assertTrue(index.has_day('2023-06-03'))
+
+    # Test that entries recorded before the model is attached are indexed once it is
+    def test_set_model_later(self):
+        index = SalienceIndex()
+        for entry in self.entries:
+            index.add_entry('2023-06-01', entry)
+        index.remove_entry('2023-06-01', self.entries[0])
+        index.set_model(self.model)
+
+        self.assertEqual(sorted(index.most_surprising('2023-06-01', 2)),
+                         sorted(get_most_surprising_words(self.entries[1:], self.model, 2)))
+
+if __name__ == '__main__':
+    unittest.main()
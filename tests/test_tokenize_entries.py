@@ -0,0 +1,35 @@
+import unittest
+
+from unittest import mock
+from src.journal_imager.tokenize_entries import STOPWORDS, tokenize, iter_tokens, unique_tokens
+
+class TestTokenizeEntries(unittest.TestCase):
+
+    # Test that tokens are lowercased and punctuation is dropped
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize("Today, I walked the DOG!")), ['today', 'i', 'walked', 'the', 'dog'])
+
+    # Test that stopwords and out-of-vocabulary words are filtered out in one pass
+    def test_iter_tokens(self):
+        entries = ["I walked the dog.", "The dog barked at a zyzzyva"]
+        vocabulary = {'walked', 'dog', 'barked', 'the'}
+
+        self.assertEqual(list(iter_tokens(entries)), ['walked', 'dog', 'dog', 'barked', 'zyzzyva'])
+        self.assertEqual(list(iter_tokens(entries, vocabulary)), ['walked', 'dog', 'dog', 'barked'])
+
+    # Test that repeats are removed, keeping the order of first appearance
+    def test_unique_tokens(self):
+        self.assertEqual(unique_tokens(["dog cat", "cat bird dog"]), ['dog', 'cat', 'bird'])
+
+    # Test that missing entries (e.g. NaN from an empty CSV cell) are skipped
+    def test_non_string_entries(self):
+        self.assertEqual(unique_tokens(["dog", float('nan'), None]), ['dog'])
+
+    # Test that tokenizing never touches nltk or the network
+    def test_offline(self):
+        self.assertIsInstance(STOPWORDS, frozenset)
+        with mock.patch('socket.socket', side_effect=AssertionError('network access')):
+            self.assertEqual(unique_tokens(["we went to the beach"]), ['went', 'beach'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,92 +1,121 @@
 import unittest
-import shutil
+import tempfile
+import threading
 
 from pathlib import Path
 from datetime import datetime
-from src.journal_imager.update_journal import update_journal
+from src.journal_imager.update_journal import update_journal, append_entry, read_entries, read_last_entry, rewrite_entries, write_entries, PLACEHOLDER_ENTRY
 
 class TestUpdateJournal(unittest.TestCase):
 
+    def setUp(self):
+        # Create journal_entries directory
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_entries_dir = Path(self.tmp_dir.name)
+        current_date = datetime.now().strftime('%Y-%m-%d')
+        self.today_entries = self.journal_entries_dir / current_date / 'entries.csv'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
     # Test normal functionality, no exising journal entries
     def test_update_journal_no_entries(self):
-        
+
         # Input text
         input_text = 'test_1'
 
-        # Create journal_entries directory if it doesn't exist
-        journal_entries_dir = Path.home() / 'journal_entries'
-        journal_entries_dir.mkdir(exist_ok=True)
+        # Write input text to journal_entries file
+        entries = update_journal(input_text, self.journal_entries_dir)
 
-        # Create today directory if it doesn't exist
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        today_entries_dir = journal_entries_dir / current_date
-        today_entries_dir.mkdir(exist_ok=True)
+        # Should be the header plus one record
+        self.assertEqual([entry['Entry'] for entry in entries], [input_text])
+        self.assertEqual(self.today_entries.read_text().splitlines()[0], 'Time,Entry')
+        self.assertEqual(self.today_entries.read_text().splitlines()[1].split(',', 1)[1], input_text)
 
-        # Write input text to journal_entries file
-        today_entries = today_entries_dir / 'entries.txt'
-        update_journal(input_text)
+    # Test normal functionality, exising journal entries
+    def test_update_journal_existing_entries(self):
+        update_journal('test_1', self.journal_entries_dir)
+        entries = update_journal('test_2, with a comma and "quotes"', self.journal_entries_dir)
 
-        # Read output text
-        with open(today_entries, 'r') as f:
-            output_text = f.read()
-        
-        # Remove journal_entries directory
-        shutil.rmtree(today_entries_dir)
-        
-        # Should be input_text + '\n' + '\n'
-        self.assertEqual(input_text + '\n' + '\n', output_text)
+        self.assertEqual([entry['Entry'] for entry in entries], ['test_1', 'test_2, with a comma and "quotes"'])
 
-    # # Test normal functionality, exising journal entries, couldn't figure this one out for now
-    # def test_update_journal_existing_entries(self):
-    #     input_text = 'test_2'
+    # Test TypeError handling
+    def test_update_journal_type_error(self):
 
-    #     journal_entries_dir = Path.home() / 'journal_entries'
+        # Input "text"
+        entries = update_journal(None, self.journal_entries_dir)
 
-    #     current_date = datetime.now().strftime('%Y-%m-%d')
-    #     today_entries_dir = journal_entries_dir / current_date
-    #     today_entries_dir.mkdir(exist_ok=True)
+        # Should show the placeholder entry, without writing anything
+        self.assertEqual([entry['Entry'] for entry in entries], [PLACEHOLDER_ENTRY])
+        self.assertFalse(self.today_entries.exists())
 
-    #     today_entries = today_entries_dir / 'entries.txt'
+    # Test that repeating the last entry is not written twice
+    def test_append_entry_duplicate(self):
+        self.assertIsNotNone(append_entry('test_1', self.journal_entries_dir))
+        self.assertIsNone(append_entry('test_1', self.journal_entries_dir))
+        self.assertIsNotNone(append_entry('test_2', self.journal_entries_dir))
+        self.assertIsNotNone(append_entry('test_1', self.journal_entries_dir))
 
-    #     with open(today_entries, 'r') as f:
-    #         existing_text = f.read()
-        
-    #     update_journal(input_text)
+        self.assertEqual([entry['Entry'] for entry in read_entries(self.today_entries)], ['test_1', 'test_2', 'test_1'])
 
-    #     with open(today_entries, 'r') as f:
-    #         output_text = f.read()
+    # Test that the last entry is found when it is longer than one read block
+    def test_read_last_entry(self):
+        append_entry('short', self.journal_entries_dir)
+        append_entry('long ' * 100, self.journal_entries_dir)
 
-    #     self.assertEqual(existing_text + input_text + '\n' + '\n', output_text)
+        with open(self.today_entries, 'rb') as f:
+            self.assertEqual(read_last_entry(f, block_size=16), 'long ' * 100)
 
+    # Test that concurrent writers don't lose or interleave entries
+    def test_append_entry_concurrent(self):
+        threads = [threading.Thread(target=append_entry, args=(f'test_{idx}', self.journal_entries_dir)) for idx in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-    # Test TypeError handling
-    def test_update_journal_type_error(self):
-        
-        # Input text
-        input_text = None
+        entries = read_entries(self.today_entries)
+        self.assertEqual(sorted(entry['Entry'] for entry in entries), sorted(f'test_{idx}' for idx in range(20)))
 
-        # Create journal_entries directory if it doesn't exist
-        journal_entries_dir = Path.home() / 'journal_entries'
-        journal_entries_dir.mkdir(exist_ok=True)
+    # Test that rewriting a day keeps the file appendable
+    def test_write_entries(self):
+        append_entry('test_1', self.journal_entries_dir)
+        append_entry('test_2', self.journal_entries_dir)
 
-        # Create today directory if it doesn't exist
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        today_entries_dir = journal_entries_dir / current_date
-        today_entries_dir.mkdir(exist_ok=True)
+        write_entries([entry for entry in read_entries(self.today_entries) if entry['Entry'] != 'test_1'], self.today_entries)
+        append_entry('test_3', self.journal_entries_dir)
+
+        self.assertEqual([entry['Entry'] for entry in read_entries(self.today_entries)], ['test_2', 'test_3'])
+
+    # Test that rewriting a day keeps the other rows' text as it is: no 'nan' for blank or 'NA' cells, no numbers for '007'
+    def test_rewrite_entries_text(self):
+        for text in ('test_1', 'NA', '007', 'None', 'test_2'):
+            append_entry(text, self.journal_entries_dir)
+
+        rewrite_entries(self.today_entries, lambda entries: [{**entries[0], 'Entry': None}] + entries[1:-1])
+
+        lines = self.today_entries.read_text(encoding='utf-8').splitlines()
+        self.assertEqual([line.split(',', 1)[1] for line in lines], ['Entry', '', 'NA', '007', 'None'])
+        rewrite_entries(self.today_entries, lambda entries: entries)
+        self.assertEqual(self.today_entries.read_text(encoding='utf-8').splitlines(), lines)
 
-        # Write input "text" to journal_entries file
-        today_entries = today_entries_dir / 'entries.txt'
-        update_journal(input_text)
+    # Test that entries appended while the day is being edited are not lost to the rewrite
+    def test_rewrite_entries_concurrent(self):
+        append_entry('test_edited', self.journal_entries_dir)
 
-       # Read output text
-        with open(today_entries, 'r') as f:
-            output_text = f.read()
+        def edit_first(entries):
+            return [{**entries[0], 'Entry': entries[0]['Entry'] + '!'}] + entries[1:]
 
-        # Remove journal_entries directory
-        shutil.rmtree(today_entries_dir)
+        threads = [threading.Thread(target=append_entry, args=(f'test_{idx}', self.journal_entries_dir)) for idx in range(20)]
+        threads += [threading.Thread(target=rewrite_entries, args=(self.today_entries, edit_first)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        # Should be empty string
-        self.assertEqual('', output_text)
+        entries = [entry['Entry'] for entry in read_entries(self.today_entries)]
+        self.assertEqual(entries[0], 'test_edited!!!!!')
+        self.assertEqual(sorted(entries[1:]), sorted(f'test_{idx}' for idx in range(20)))
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
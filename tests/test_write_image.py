@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import io
+import json
+
+from pathlib import Path
+from PIL import Image
+from src.journal_imager.stub_server import make_png, encode_image
+from src.journal_imager.write_image import save_image, save_image_stream, save_thumbnail
+
+class TestWriteImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.img_path = Path(self.tmp_dir.name) / 'image.png'
+        self.png = make_png('photo of cat')
+        self.body = json.dumps({'image': encode_image(self.png)}).encode('utf-8')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def chunked(self, data, size):
+        return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+    # Test that the PNG is written byte for byte, whatever the chunk boundaries
+    def test_save_image_stream(self):
+        for size in (1, 3, 7, 64, 1 << 20):
+            save_image_stream(self.chunked(self.body, size), self.img_path)
+            self.assertEqual(self.img_path.read_bytes(), self.png)
+
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [self.img_path])
+
+    # Test that thumbnails are downscaled with the aspect ratio kept
+    def test_save_thumbnail(self):
+        Image.new('RGB', (800, 400), 'red').save(self.img_path)
+        thumb_path = Path(self.tmp_dir.name) / 'thumb.webp'
+
+        save_thumbnail(self.img_path, thumb_path, max_size=200)
+
+        with Image.open(thumb_path) as thumb:
+            self.assertEqual(thumb.size, (200, 100))
+        self.assertLess(thumb_path.stat().st_size, self.img_path.stat().st_size)
+
+    # Test saving an image string that was already parsed (e.g. from a batch response line)
+    def test_save_image(self):
+        save_image(encode_image(self.png), self.img_path)
+        self.assertEqual(self.img_path.read_bytes(), self.png)
+
+    # Test that other formats are still converted to PNG
+    def test_save_image_not_png(self):
+        jpeg = io.BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(jpeg, format='JPEG')
+        body = json.dumps({'image': encode_image(jpeg.getvalue())}).encode('utf-8')
+
+        save_image_stream(self.chunked(body, 5), self.img_path)
+
+        with Image.open(self.img_path) as img:
+            self.assertEqual(img.format, 'PNG')
+
+    # Test that an incomplete response leaves no file behind
+    def test_save_image_stream_incomplete(self):
+        with self.assertRaises(ValueError):
+            save_image_stream([b'{"error": "out of memory"}'], self.img_path)
+        with self.assertRaises(ValueError):
+            save_image_stream([self.body[:len(self.body) // 2]], self.img_path)
+
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [])
+
+if __name__ == '__main__':
+    unittest.main()